@@ -0,0 +1,10 @@
+"""
+pytest的全局设置，测试在utils/classobjects_Test下面
+
+导入utils的时候就会初始化pygame的声音，没有声卡和显示器的环境（CI）得先换成dummy
+"""
+
+import os
+
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
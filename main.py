@@ -17,9 +17,10 @@ import warnings
 import traceback
 import threading
 import functools
+import multiprocessing
 from queue import Queue
 from typing import Optional, Union, List, Tuple, Dict, Callable, Literal, Type
-from shutil import copytree, rmtree, copy as shutil_copy
+from shutil import rmtree, copy as shutil_copy
 from concurrent.futures import ThreadPoolExecutor
 from types import TracebackType
 from typing import Mapping, Any, Iterable
@@ -90,7 +91,8 @@ from utils.classobjects import (
     CLIENT_UPDATE_LOG,
     DEFAULT_CLASS_KEY
 )
-from utils.classobjects import Chunk, UserDataBase
+from utils.classobjects import Chunk, UserDataBase, ArchiveStorage
+from utils.recovery import create_snapshot, restore_snapshot, read_manifest
 from utils.consts import (
     app_style,
     app_stylesheet,
@@ -2368,30 +2370,31 @@ class ClassWindow(ClassObj, MainClassWindow.Ui_MainWindow, MyMainWindow):
                     "）"
                 ))
             loading_screen.show()
-            finished = False
-            def _set_finished():
-                nonlocal finished
-                finished = True
             Base.log("I", "保存当前存档", "MainWindow.save")
             self.last_save_from_action = time.time()
-            Thread(
-                target=lambda: (
-                    self.save_current_settings(),
-                    self.save_data(self.save_path),
-                    self.save_quick_command_config(),
-                    self.show_tip(
-                        "提示",
-                        "保存成功",
-                        icon=InfoBarIcon.SUCCESS,
-                        duration=2500,
-                        further_info="保存成功，没什么好说的",
-                    ),
-                    Base.log("I", "存档保存完成", "MainWindow.save"),
-                    _set_finished()
-                )
-            ).start()
-            wait_until(lambda: finished)
+            # 快照在这里拍，写入在后台，等的时候界面照常响应
+            future = self.save_data_async(self.save_path)
+            self.save_current_settings()
+            self.save_quick_command_config()
+            wait_until(future.done)
             loading_screen.close()
+            if future.exception() is None:
+                self.show_tip(
+                    "提示",
+                    "保存成功",
+                    icon=InfoBarIcon.SUCCESS,
+                    duration=2500,
+                    further_info="保存成功，没什么好说的",
+                )
+                Base.log("I", "存档保存完成", "MainWindow.save")
+            else:
+                self.show_tip(
+                    "警告",
+                    "保存失败，请查看日志",
+                    icon=InfoBarIcon.WARNING,
+                    duration=8000,
+                    further_info=f"详细信息：\n\n{future.exception()!r}",
+                )
 
 
     def refresh_hint_widget(self, mode: int = 0):
@@ -2544,35 +2547,65 @@ class ClassWindow(ClassObj, MainClassWindow.Ui_MainWindow, MyMainWindow):
             self.is_loading_all_history = False
         if self.is_loading_all_history:
             Base.log("I", "还正在加载历史记录", "MainWindow.show_all_history")
-        finished = False
-
-        def _load_history():
-            nonlocal finished
-            self.show_tip("提示", "正在保存当前数据以保证完整性", duration=2000)
-            self.save_data()
-            self.show_tip("提示", "历史记录正在加载中，请稍等", duration=2000)
-            self.config_data(
-                os.path.abspath(f"chunks/{self.current_user}"),
-                load_full_histories=True,
-                reset_current=False,
-                strict=True,
-            )
-            finished = True
-
         self.is_loading_all_history = True
-        Thread(target=_load_history, name="HistoryLoader").start()
+        self.show_tip("提示", "正在保存当前数据以保证完整性", duration=2000)
+        # 列表只读索引，点进去的时候才加载那一周
+        future = self.save_data_async(self.save_path)
+        wait_until(future.done)
+        chunk = Chunk(self.save_path)
+        catalog = chunk.history_catalog()
         self.is_loading_all_history = False
-        wait_until(lambda: finished)
+
+        def _format_time(t: float) -> str:
+            lt = time.localtime(t)
+            return (
+                f"{lt.tm_year}/{lt.tm_mon}/{lt.tm_mday} "
+                f"{lt.tm_hour}:{lt.tm_min:02}:{lt.tm_sec:02}"
+            )
+
+        def _forget_history(history_uuid: str):
+            for key, history in list(self.history_data.items()):
+                if history.uuid == history_uuid:
+                    self.history_data.pop(key)
+
+        def _del_earliest():
+            entry = catalog[0]
+            chunk.del_history(entry.uuid)
+            _forget_history(entry.uuid)
+            self.insert_action_history_info(
+                f"删除{_format_time(entry.time)}的记录",
+                self.show_all_history,
+                (201, 94, 232, 235, 176, 252),
+                40,
+            )
+            self.information("提示", "删除成功，请重新加载此窗口！")
+            view.close()
+
+        def _del_all():
+            self.insert_action_history_info(
+                f"删除所有的历史记录（{len(catalog)}）",
+                self.show_all_history,
+                (142, 30, 114, 246, 139, 219),
+                40,
+            )
+            for entry in catalog:
+                chunk.del_history(entry.uuid)
+            self.history_data.clear()
+            self.information("提示", "删除成功，请重新加载此窗口！")
+            view.close()
+
         view = ListView(
             self,
             self,
             "所有历史记录",
             [
                 (
-                    f"位于{time.localtime(history.time).tm_year}/{time.localtime(history.time).tm_mon}/{time.localtime(history.time).tm_mday} {time.localtime(history.time).tm_hour}:{time.localtime(history.time).tm_min:02}:{time.localtime(history.time).tm_sec:02}的历史记录",
-                    lambda h=history: self.show_classes_history(h.classes),
+                    f"位于{_format_time(entry.time)}的历史记录",
+                    lambda e=entry: self.show_classes_history(
+                        chunk.open_history(e.uuid).classes
+                    ),
                 )
-                for history in self.history_data.values()
+                for entry in catalog
             ],
         )
         view.setCommands(
@@ -2582,68 +2615,27 @@ class ClassWindow(ClassObj, MainClassWindow.Ui_MainWindow, MyMainWindow):
                     lambda: (
                         self.question_if_exec(
                             "警告",
-                            "最早的一次记录来自于"
-                            f"{time.localtime(list(self.history_data)[0]).tm_year}/"
-                            f"{time.localtime(list(self.history_data)[0]).tm_mon}/"
-                            f"{time.localtime(list(self.history_data)[0]).tm_mday} "
-                            f"{time.localtime(list(self.history_data)[0]).tm_hour}:"
-                            f"{time.localtime(list(self.history_data)[0]).tm_min:02}:"
-                            f"{time.localtime(list(self.history_data)[0]).tm_sec:02};\n"
+                            f"最早的一次记录来自于{_format_time(catalog[0].time)};\n"
                             "接下来的操作将会彻底删除这个时间段的记录，此操作不可逆！\n\n"
                             "你确定要删除吗？",
-                            lambda: (
-                                Chunk(self.save_path, None).del_history(
-                                    list(self.history_data.values())[0].uuid
-                                ),
-                                self.history_data.pop(list(self.history_data)[0]),
-                                self.insert_action_history_info(
-                                    "删除"
-                                    f"{time.localtime(list(self.history_data)[0]).tm_year}/"
-                                    f"{time.localtime(list(self.history_data)[0]).tm_mon}/"
-                                    f"{time.localtime(list(self.history_data)[0]).tm_mday} "
-                                    f"{time.localtime(list(self.history_data)[0]).tm_hour}:"
-                                    f"{time.localtime(list(self.history_data)[0]).tm_min:02}:"
-                                    f"{time.localtime(list(self.history_data)[0]).tm_sec:02}的记录",
-                                    self.show_all_history,
-                                    (201, 94, 232, 235, 176, 252),
-                                    40,
-                                ),
-                                self.information(
-                                    "提示", "删除成功，请重新加载此窗口！"
-                                ),
-                                view.close(),
-                            ),
+                            _del_earliest,
                         )
-                        if len(self.history_data)
+                        if catalog
                         else (self.information("提示", "没有历史记录可以删除..."))
                     ),
                 ),
                 (
                     "删除所有记录",
                     lambda: (
-                        (
-                            self.question_if_exec(
-                                "警告",
-                                "你确定要删除所有记录吗？\n"
-                                "接下来的操作将会彻底删除所有记录，没错，是所有，请慎重！\n\n"
-                                f"当前共有{len(self.history_data)}条历史记录, "
-                                "你确定要删除吗？",
-                                lambda: (
-                                    self.insert_action_history_info(
-                                        f"删除所有的历史记录（{len(self.history_data)}）",
-                                        self.show_all_history,
-                                        (142, 30, 114, 246, 139, 219),
-                                        40,
-                                    ),
-                                    self.history_data.clear(),
-                                    self.information(
-                                        "提示", "删除成功，请重新加载此窗口！"
-                                    ),
-                                    view.close(),
-                                ),
-                            )
+                        self.question_if_exec(
+                            "警告",
+                            "你确定要删除所有记录吗？\n"
+                            "接下来的操作将会彻底删除所有记录，没错，是所有，请慎重！\n\n"
+                            f"当前共有{len(catalog)}条历史记录, "
+                            "你确定要删除吗？",
+                            _del_all,
                         )
-                        if len(self.history_data)
+                        if catalog
                         else (self.information("提示", "没有历史记录可以删除..."))
                     ),
                 ),
@@ -3051,12 +3043,18 @@ class ClassWindow(ClassObj, MainClassWindow.Ui_MainWindow, MyMainWindow):
             Base.log("I", "正在对数据文件进行备份...", "MainWindow.script_backup")
             try:
                 p = self.backup_path + f"dataonly/b_{today_and_time}"
+                # 没变过的文件链接到上一个还原点，只复制变了的
+                previous = RecoveryPoint.latest(infof, mode)
+                Chunk.save_pipeline.wait()
                 for i in range(6):
                     try:
-                        copytree("chunks", p + "/chunks")
+                        with Chunk.save_task_mutex:
+                            Chunk.relase_connections()
+                            create_snapshot("chunks", p, previous)
                     except OSError as e:
                         if i > 4:
                             raise e
+                        rmtree(p, ignore_errors=True)
                     else:
                         break
 
@@ -3070,16 +3068,24 @@ class ClassWindow(ClassObj, MainClassWindow.Ui_MainWindow, MyMainWindow):
         if mode == "all":
             Base.log("I", "正在对完整程序进行备份...", "MainWindow.script_backup")
             try:
-                copytree(os.getcwd(), "backup_tmp")
+                p = self.backup_path + f"full/b_{today_and_time}"
+                previous = RecoveryPoint.latest(infof, mode)
+                Chunk.save_pipeline.wait()
                 for i in range(6):
                     try:
-                        copytree(
-                            "backup_tmp", self.backup_path + f"full/b_{today_and_time}"
-                        )
-                        rmtree("backup_tmp")
+                        with Chunk.save_task_mutex:
+                            Chunk.relase_connections()
+                            create_snapshot(
+                                os.getcwd(),
+                                p,
+                                previous,
+                                exclude=(self.backup_path, "backup_tmp"),
+                                prefix="",
+                            )
                     except OSError as e:
                         if i > 4:
                             raise e
+                        rmtree(p, ignore_errors=True)
                     else:
                         break
 
@@ -3219,6 +3225,14 @@ class UpdateThread(QThread):
         self.last_group_list = [g for g in self.main_window.target_class.groups]
         self.lastest_score: Dict[int, float] = {}
         self.lastest_grp_score: Dict[str, float] = {}
+        self.last_version = -1
+        "上次刷新时班级侦测器的数据版本号"
+        self.last_class_obs: Optional[ClassStatusObserver] = None
+        "上次刷新时的班级侦测器，换了班级侦测器也会换，新的版本号可能正好和上次的一样"
+        self.last_refresh = 0.0
+        "上次刷新按钮的时间"
+        self.refresh_interval = 5.0
+        "数据没变的时候多久强制刷新一次按钮（秒）"
 
     def update_stu_btns(self):
         "更新主窗口的学生按钮"
@@ -3545,8 +3559,7 @@ class UpdateThread(QThread):
                         time.sleep(10)
                         self.main_window.save_data()
                         self.main_window.save_current_settings()
-                        while self.main_window.auto_saving:
-                            time.sleep(0.1)
+                        Chunk.save_pipeline.wait()
                         update()
 
                     except (OSError, IOError) as e:
@@ -3657,6 +3670,20 @@ class UpdateThread(QThread):
         while self.main_window.is_running:
             try:
                 self.detect_newday()
+                class_obs = self.main_window.class_obs
+                version = class_obs.version
+                if (
+                    class_obs is self.last_class_obs
+                    and version == self.last_version
+                    and time.time() - self.last_refresh < self.refresh_interval
+                    and not self.first_loop
+                ):
+                    # 数据没变就不刷新按钮了，等侦测器的版本号变化
+                    class_obs.wait_for_change(version, 0.5)
+                    continue
+                self.last_class_obs = class_obs
+                self.last_version = version
+                self.last_refresh = time.time()
                 try:
                     self.update_stu_btns()
                     self.update_grp_btns()
@@ -3724,6 +3751,22 @@ class RecoveryPoint:
         self.time = time.time()
         self.stat = stat
 
+    @staticmethod
+    def latest(
+        points: Dict[float, "RecoveryPoint"], mode: Literal["all", "only_data"]
+    ) -> Optional[str]:
+        """
+        找最近一个还在、带清单的同模式还原点，新的还原点可以链接它里面没变过的文件
+
+        :param points: 所有还原点
+        :param mode: 模式
+        :return: 还原点路径，没有就是None
+        """
+        for _, point in sorted(points.items(), key=lambda item: item[0], reverse=True):
+            if point.mode == mode and read_manifest(point.path) is not None:
+                return point.path
+        return None
+
     def get_data_path(self, current_user: str):
         """
         获取数据路径
@@ -3747,35 +3790,19 @@ class RecoveryPoint:
         Base.log("I", "还原点模式：" + self.mode, "RecoveryPoint.load_onlydata")
         Base.log("I", "还原点时间：" + str(self.time), "RecoveryPoint.load_onlydata")
         Base.log("I", "当前用户：" + current_user, "RecoveryPoint.load_onlydata")
-        wait_until(lambda: ClassWindow.main_instance.auto_saving)
+        Chunk.save_pipeline.wait()
         self.load_onlydata(ClassWindow.main_instance.current_user)
         ClassWindow.main_instance.stop()
-        rmtree(ClassWindow.main_instance.save_path)
-
-        def _copy():
-            for root, dirs, files in os.walk(self.get_data_path(ClassWindow.main_instance.current_user)):
-                for file in files:
-                    os.makedirs(
-                        os.path.join(
-                            ClassWindow.main_instance.save_path,
-                            os.path.relpath(
-                                root, self.get_data_path(ClassWindow.main_instance.current_user)
-                            ),
-                        ),
-                        exist_ok=True,
-                    )
-                    shutil_copy(
-                        os.path.join(root, file),
-                        os.path.join(
-                            ClassWindow.main_instance.save_path,
-                            os.path.relpath(
-                                root, self.get_data_path(ClassWindow.main_instance.current_user)
-                            ),
-                            file,
-                        ),
-                    )
-
-        _copy()
+        Chunk.save_pipeline.wait()
+        # 先还原到存档旁边再整个换过来，中途断电的话下次打开存档的时候会接着换完；
+        # 存档里面和还原点一样的文件直接链接，只复制变了的
+        storage = ArchiveStorage.open(ClassWindow.main_instance.save_path)
+        storage.restore_from(
+            self.get_data_path(ClassWindow.main_instance.current_user),
+            lambda source, target: restore_snapshot(
+                self.path, os.path.relpath(source, self.path), target, storage.path
+            ),
+        )
         Base.log(
             "I",
             f"将文件从{self.get_data_path(ClassWindow.main_instance.current_user)}"
@@ -3784,8 +3811,6 @@ class RecoveryPoint:
         )
         QMessageBox.information(ClassWindow.main_instance, "恢复成功", "恢复成功，请重新启动程序")
 
-        wait_until(lambda: not ClassWindow.main_instance.auto_saving)
-        _copy()  # 我就不信保存两次还能失败
         pid = os.getpid()  # 获取当前进程的PID
         os.kill(pid, signal.SIGTERM)  # 发送终止信号给当前进程（什么抽象关闭方法）
 
@@ -3822,11 +3847,14 @@ def main():
     Base.log("I", f"程序结束，返回值：{stat}", "MainThread")
     Base.log("I", "等待自动保存...", "MainThread")
     wait_until(lambda: not ClassWindow.main_instance.auto_saving)
+    Chunk.save_pipeline.wait()
     Base.log("I", "自动保存完成，趋势", "MainThread")
     return stat
 
 
 if __name__ == "__main__":
+    # 打包之后多进程加载历史记录（Chunk.history_workers）要这个
+    multiprocessing.freeze_support()
     return_code = main()
     sys.exit(return_code)
 
@@ -7,6 +7,7 @@
 from .consts import *
 from .algorithm import *
 from .basetypes import *
+from .codec import *
 from .classdatatypes import *
 from .classobjects import *
 from .logger import *
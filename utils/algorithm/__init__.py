@@ -7,12 +7,16 @@ from .datatypes import *
 from .high_precision import *
 from .keyorder import *
 from .numeric import *
+from .rankindex import *
+from .prefixtree import *
 
 # except ImportError:
 #     from datatypes import *
 #     from high_precision import *
 #     from keyorder import *
 #     from numeric import *
+#     from rankindex import *
+#     from prefixtree import *
 
 if __name__ == "__main__":
     print(Int8(127) + Int8(1))
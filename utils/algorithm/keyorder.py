@@ -80,6 +80,8 @@ class SupportsKeyOrdering(ABC):
         你学废了吗？
     """
 
+    __slots__ = ()  # 不然用了__slots__的子类（比如Student）还是会有__dict__
+
 
 _Template = TypeVar("_Template", bound=SupportsKeyOrdering)
 """
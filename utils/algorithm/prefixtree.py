@@ -0,0 +1,153 @@
+"""
+前缀和线段树所在文件
+"""
+
+from typing import List, Optional, Tuple
+
+__all__ = ["PrefixExtremaTree"]
+
+
+_Node = Tuple[float, float, int, float, int]
+# (区间和, 区间内最大前缀和, 最大前缀和的位置, 区间内最小前缀和, 最小前缀和的位置)
+
+_EMPTY: _Node = (0.0, float("-inf"), -1, float("inf"), -1)
+
+
+def _combine(left: _Node, right: _Node) -> _Node:
+    s1, mx1, p1, mn1, q1 = left
+    s2, mx2, p2, mn2, q2 = right
+    # 相等的时候取左边的，也就是最早出现的那个
+    if mx1 >= s1 + mx2:
+        mx, p = mx1, p1
+    else:
+        mx, p = s1 + mx2, p2
+    if mn1 <= s1 + mn2:
+        mn, q = mn1, q1
+    else:
+        mn, q = s1 + mn2, q2
+    return (s1 + s2, mx, p, mn, q)
+
+
+class PrefixExtremaTree:
+    """
+    维护一串数的前缀和最大值/最小值的线段树。
+
+    改某一个位置的值和在末尾追加都是O(log n)（追加偶尔要扩容，均摊下来也差不多），
+    整串的最大/最小前缀和是O(1)。
+
+    >>> tree = PrefixExtremaTree([1, 2, -5, 3])
+    >>> tree.max_prefix()   # 前缀和最大是3，在位置1
+    (3.0, 1)
+    >>> tree.set(1, 0)
+    >>> tree.min_prefix()
+    (-4.0, 2)
+    """
+
+    def __init__(self, values: Optional[List[float]] = None):
+        """
+        构造函数。
+
+        :param values: 初始的值
+        """
+        self._values: List[float] = [float(v) for v in values or ()]
+        self._size = 1
+        self._tree: List[_Node] = []
+        self._prefix: Optional[List[float]] = None
+        self._rebuild()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def _rebuild(self) -> None:
+        size = 1
+        while size < len(self._values):
+            size *= 2
+        self._size = size
+        tree = [_EMPTY] * (2 * size)
+        for i, v in enumerate(self._values):
+            tree[size + i] = (v, v, i, v, i)
+        for i in range(size - 1, 0, -1):
+            tree[i] = _combine(tree[2 * i], tree[2 * i + 1])
+        self._tree = tree
+
+    def _refresh(self, pos: int) -> None:
+        v = self._values[pos]
+        i = self._size + pos
+        self._tree[i] = (v, v, pos, v, pos)
+        i //= 2
+        while i:
+            self._tree[i] = _combine(self._tree[2 * i], self._tree[2 * i + 1])
+            i //= 2
+
+    def append(self, value: float) -> int:
+        """
+        在末尾追加一个值。
+
+        :param value: 值
+        :return: 新值的位置
+        """
+        value = float(value)
+        self._values.append(value)
+        if self._prefix is not None:
+            self._prefix.append((self._prefix[-1] if self._prefix else 0.0) + value)
+        if len(self._values) > self._size:
+            self._rebuild()
+        else:
+            self._refresh(len(self._values) - 1)
+        return len(self._values) - 1
+
+    def set(self, pos: int, value: float) -> None:
+        """
+        修改某个位置的值。
+
+        :param pos: 位置
+        :param value: 新的值
+        """
+        value = float(value)
+        if self._values[pos] == value:
+            return
+        self._values[pos] = value
+        self._prefix = None
+        self._refresh(pos)
+
+    def get(self, pos: int) -> float:
+        "获取某个位置的值"
+        return self._values[pos]
+
+    @property
+    def total(self) -> float:
+        "所有值的和"
+        return self._tree[1][0] if self._values else 0.0
+
+    def max_prefix(self) -> Tuple[float, int]:
+        """
+        最大的前缀和。
+
+        :return: (最大前缀和, 位置)，同样大的取最早的，没有值就是(-inf, -1)
+        """
+        node = self._tree[1] if self._values else _EMPTY
+        return node[1], node[2]
+
+    def min_prefix(self) -> Tuple[float, int]:
+        """
+        最小的前缀和。
+
+        :return: (最小前缀和, 位置)，同样小的取最早的，没有值就是(inf, -1)
+        """
+        node = self._tree[1] if self._values else _EMPTY
+        return node[3], node[4]
+
+    def prefix_sums(self) -> List[float]:
+        """
+        每个位置的前缀和（会缓存起来，只有追加的话不用重新算）。
+
+        :return: 前缀和的列表，不要修改
+        """
+        if self._prefix is None:
+            prefix: List[float] = []
+            total = 0.0
+            for v in self._values:
+                total += v
+                prefix.append(total)
+            self._prefix = prefix
+        return self._prefix
@@ -0,0 +1,245 @@
+"""
+排名索引所在文件
+"""
+
+import threading
+from bisect import bisect_left, insort
+from typing import Any, Callable, Dict, Generic, Iterable, Iterator, List, Tuple, TypeVar
+
+__all__ = ["RankIndex"]
+
+_T = TypeVar("_T")
+
+
+class RankIndex(Generic[_T]):
+    """
+    一直保持排好序的排名索引。
+
+    里面是一个按 (-分数, key) 排好的列表，分数高的在前面，同分的按key从小到大。
+    某个对象分数变了调一下``update``就行，不用整个重新排序。
+
+    >>> index = RankIndex(students, score=lambda s: s.score, key=lambda s: s.num)
+    >>> index.rank_of(student)          # 名次（计算重复名次，1-2-2-3）
+    >>> index.rank_of(student, False)   # 名次（不计算重复名次，1-2-2-4）
+    >>> index.top(3)                    # 前三名
+    >>> index.window(1, 5)              # 名次在1到5之间的
+
+    复杂度：
+
+    - ``rank_of``是O(log n)，``window``是O(log² n)，返回列表的那些再加上结果的长度
+    - ``add``/``remove``/``update``/``rekey``是O(n)：二分找位置是O(log n)，
+      但是在列表中间插入和删除要挪后面的元素。一个班也就几十个人，挪一下比整个重新排序快得多，
+      真要上几万个对象的话得换成分块的有序列表之类的结构
+    """
+
+    def __init__(
+        self,
+        items: Iterable[_T] = (),
+        score: Callable[[_T], float] = lambda o: o.score,
+        key: Callable[[_T], Any] = lambda o: o.num,
+    ):
+        """
+        排名索引构造函数。
+
+        :param items: 一开始就放进去的对象
+        :param score: 取分数的函数
+        :param key: 取唯一标识的函数（同分的时候也按这个排）
+        """
+        self.score = score
+        "取分数的函数"
+        self.key = key
+        "取唯一标识的函数"
+        self.lock = threading.RLock()
+        "索引的锁"
+        self._order: List[Tuple[float, Any]] = []
+        self._objects: Dict[Any, Tuple[Tuple[float, Any], _T]] = {}
+        self._distinct: List[float] = []
+        self._distinct_count: Dict[float, int] = {}
+        for item in items:
+            self.add(item)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __contains__(self, item: _T) -> bool:
+        entry = self._objects.get(self.key(item))
+        return entry is not None and entry[1] is item
+
+    def __iter__(self) -> Iterator[_T]:
+        "按名次从高到低遍历"
+        with self.lock:
+            return iter([self._objects[k][1] for _, k in self._order])
+
+    def __repr__(self):
+        return f"RankIndex({len(self)} items)"
+
+    def __deepcopy__(self, memo: dict) -> "RankIndex[_T]":
+        # 复制出来的是个空索引，用到的时候会按新的对象重新建
+        return RankIndex(score=self.score, key=self.key)
+
+    def __reduce__(self):
+        return (RankIndex, ())
+
+    def add(self, item: _T) -> None:
+        """
+        加入一个对象，key相同的旧对象会被替换掉。
+
+        :param item: 对象
+        """
+        with self.lock:
+            k = self.key(item)
+            if k in self._objects:
+                self._discard(k)
+            sort_key = (-self.score(item), k)
+            insort(self._order, sort_key)
+            self._objects[k] = (sort_key, item)
+            neg = sort_key[0]
+            count = self._distinct_count.get(neg, 0)
+            if not count:
+                insort(self._distinct, neg)
+            self._distinct_count[neg] = count + 1
+
+    def remove(self, item: _T) -> bool:
+        """
+        删除一个对象。
+
+        :param item: 对象
+        :return: 是否删掉了（对象不在里面就是False）
+        """
+        with self.lock:
+            if item not in self:
+                return False
+            self._discard(self.key(item))
+            return True
+
+    def _discard(self, k: Any) -> None:
+        sort_key, _ = self._objects.pop(k)
+        del self._order[bisect_left(self._order, sort_key)]
+        neg = sort_key[0]
+        count = self._distinct_count[neg] - 1
+        if count:
+            self._distinct_count[neg] = count
+        else:
+            del self._distinct_count[neg]
+            del self._distinct[bisect_left(self._distinct, neg)]
+
+    def update(self, item: _T) -> bool:
+        """
+        对象的分数变了之后调用，重新放到该在的位置。
+
+        :param item: 对象
+        :return: 对象是否在索引里
+        """
+        with self.lock:
+            entry = self._objects.get(self.key(item))
+            if entry is None or entry[1] is not item:
+                return False
+            if entry[0][0] != -self.score(item):
+                self.add(item)
+            return True
+
+    def rekey(self, item: _T, old_key: Any) -> bool:
+        """
+        对象的key变了之后调用。
+
+        :param item: 对象
+        :param old_key: 原来的key
+        :return: 对象是否在索引里
+        """
+        with self.lock:
+            entry = self._objects.get(old_key)
+            if entry is None or entry[1] is not item:
+                return False
+            self._discard(old_key)
+            self.add(item)
+            return True
+
+    def _rank_at(self, pos: int, dumplicate: bool) -> int:
+        neg = self._order[pos][0]
+        if dumplicate:
+            return bisect_left(self._distinct, neg) + 1
+        return bisect_left(self._order, (neg,)) + 1
+
+    def rank_of(self, item: _T, dumplicate: bool = True) -> int:
+        """
+        获取对象的名次。
+
+        :param item: 对象
+        :param dumplicate: 是否计算重复名次（1-2-2-3），否则是1-2-2-4
+        :raise KeyError: 对象不在索引里
+        :return: 名次
+        """
+        with self.lock:
+            entry = self._objects[self.key(item)]
+            neg = entry[0][0]
+            if dumplicate:
+                return bisect_left(self._distinct, neg) + 1
+            return bisect_left(self._order, (neg,)) + 1
+
+    def lowest_rank(self, dumplicate: bool = True) -> int:
+        """
+        最后一名的名次，没有对象就是0。
+
+        :param dumplicate: 是否计算重复名次
+        """
+        with self.lock:
+            if not self._order:
+                return 0
+            return self._rank_at(len(self._order) - 1, dumplicate)
+
+    def top(self, k: int) -> List[_T]:
+        """
+        前k个对象（不管并列）。
+
+        :param k: 个数
+        """
+        with self.lock:
+            return [self._objects[key][1] for _, key in self._order[: max(k, 0)]]
+
+    def _first_pos(self, rank: int, dumplicate: bool) -> int:
+        # 名次随着位置单调不减，二分找第一个名次>=rank的位置
+        lo, hi = 0, len(self._order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._rank_at(mid, dumplicate) < rank:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(
+        self, lowest: int, highest: int, dumplicate: bool = True
+    ) -> List[Tuple[int, _T]]:
+        """
+        名次在[lowest, highest]之间的对象。
+
+        :param lowest: 名次下限（数字小的那头）
+        :param highest: 名次上限
+        :param dumplicate: 是否计算重复名次
+        :return: List[Tuple[名次, 对象]]
+        """
+        with self.lock:
+            start = self._first_pos(lowest, dumplicate)
+            end = self._first_pos(highest + 1, dumplicate)
+            return [
+                (self._rank_at(pos, dumplicate), self._objects[self._order[pos][1]][1])
+                for pos in range(start, end)
+            ]
+
+    def ranking(self, dumplicate: bool = True) -> List[Tuple[int, _T]]:
+        """
+        完整的排名表。
+
+        :param dumplicate: 是否计算重复名次
+        :return: List[Tuple[名次, 对象]]，名次从高到低
+        """
+        with self.lock:
+            result: List[Tuple[int, _T]] = []
+            last = None
+            rank = 0
+            for pos, (neg, k) in enumerate(self._order):
+                if neg != last:
+                    rank = rank + 1 if dumplicate else pos + 1
+                    last = neg
+                result.append((rank, self._objects[k][1]))
+            return result
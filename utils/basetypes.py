@@ -10,6 +10,7 @@ import psutil
 import threading
 import ctypes
 import copy
+from typing import Any, Dict, List, Optional, Tuple
 
 from .logger import Logger, logger
 
@@ -17,6 +18,7 @@ from .logger import Logger, logger
 
 __all__ = [
     "ModifyingError",
+    "intern_uuid",
     "DataObject",
     "Object",
     "Base",
@@ -28,6 +30,16 @@ def gen_uuid(length: int = 32) -> str:
     "生成一个长32位的uuid"
     return "".join([str(random.choice("0123456789abcdef")) for _ in range(length)])
 
+
+def intern_uuid(value: Any) -> Any:
+    """
+    驻留uuid字符串，同一个uuid在内存里面只留一份。
+
+    从数据库读出来的每条记录里面的uuid都是新的字符串（对象自己的、引用别人的、缓存的键），
+    驻留之后比较的时候也能直接比地址。不是``str``（``None``、``UUIDKind``这些）就原样返回。
+    """
+    return sys.intern(value) if type(value) is str else value
+
 os.makedirs(os.path.abspath("log"), exist_ok=True)
 
 if not os.path.isdir("log"):
@@ -38,17 +50,83 @@ class ModifyingError(Exception):
     "修改出现错误。"
 
 
+_slot_names: Dict[type, Tuple[str, ...]] = {}
+"每个类（包括父类）声明的所有__slots__"
+
+
+def slot_names(cls: type) -> Tuple[str, ...]:
+    "获取一个类（包括父类）声明的所有__slots__（按声明的顺序），不包括``__dict__``和``__weakref__``"
+    try:
+        return _slot_names[cls]
+    except KeyError:
+        pass
+    names: Dict[str, None] = {}
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name in slots:
+            if name in ("__dict__", "__weakref__"):
+                continue
+            if name.startswith("__") and not name.endswith("__"):
+                name = f"_{klass.__name__.lstrip('_')}{name}"
+            names[name] = None
+    _slot_names[cls] = tuple(names)
+    return _slot_names[cls]
+
+
 class DataObject(object):
 
+    # 子类可以用__slots__省内存（学生、分数修改记录这些一个存档里面有几万个），
+    # 所以这里和Object都不能有__dict__
+    __slots__ = ()
+
     def copy(self):
         "给自己复制一次，两个对象不会互相影响"
         return copy.deepcopy(self)
 
+    def state_items(self) -> List[Tuple[str, Any]]:
+        "对象的所有属性（``__dict__``和``__slots__``里面的都算）"
+        items = [
+            (name, getattr(self, name))
+            for name in slot_names(type(self))
+            if hasattr(self, name)
+        ]
+        items.extend(getattr(self, "__dict__", {}).items())
+        return items
+
+    def update_state(self, other: "DataObject") -> None:
+        "把另一个同类型对象的属性全部搬过来（不经过property，不会触发修改记录）"
+        for name, value in other.state_items():
+            if name in slot_names(type(self)):
+                object.__setattr__(self, name, value)
+            else:
+                self.__dict__[name] = value
+
+    def __setstate__(self, state):
+        # 复制/反序列化用，state可能是__dict__、(__dict__, __slots__)，
+        # 或者是这个类加__slots__之前存下来的__dict__
+        if isinstance(state, tuple) and len(state) == 2:
+            dict_state, slot_state = state
+        else:
+            dict_state, slot_state = state, None
+        slots = slot_names(type(self))
+        instance_dict = getattr(self, "__dict__", None)
+        for mapping in (dict_state, slot_state):
+            for name, value in (mapping or {}).items():
+                if name in slots:
+                    object.__setattr__(self, name, value)
+                elif instance_dict is not None:
+                    instance_dict[name] = value
+                else:
+                    # 以前存的属性现在变成property了
+                    setattr(self, name, value)
+
     def __repr__(self):
         "返回这个对象的表达式"
         return (
             f"{self.__class__.__name__}"
-            f"({', '.join([f'{k}={v!r}' for k, v in self.__dict__.items() if not k.startswith('_')])})"
+            f"({', '.join([f'{k}={v!r}' for k, v in self.state_items() if not k.startswith('_')])})"
         )
         # 我个人认为不要把下划线开头的变量输出出来（不过只以一个下划线开头的还得考虑考虑）
 
@@ -56,10 +134,17 @@ class DataObject(object):
 class Object(DataObject):
     "一个基础类"
 
+    # _uuid不能放进这里的__slots__：主窗口同时继承了ClassObj和QMainWindow，
+    # 这里有slot的话两边的实例布局会冲突，所以用了__slots__的子类要自己声明"_uuid"
+    __slots__ = ()
+
+    _uuid: Optional[str] = None
+    "对象的UUID，没生成的时候是None（存在实例的__dict__或者子类的_uuid slot里面）"
+
     @property
     def uuid(self):
         "获取对象的UUID"
-        if not hasattr(self, "_uuid") or not getattr(self, "_uuid"):
+        if not getattr(self, "_uuid", None):  # 子类的slot没赋值的时候是AttributeError
             self._uuid = gen_uuid()
 
         return self._uuid
@@ -67,7 +152,7 @@ class Object(DataObject):
     @uuid.setter
     def uuid(self, value):
         "设置对象的UUID"
-        self._uuid = value
+        self._uuid = intern_uuid(value)
 
     @uuid.deleter
     def uuid(self):
@@ -77,6 +162,15 @@ class Object(DataObject):
     def refresh_uuid(self):
         self._uuid = gen_uuid()
 
+    def ensure_uuid(self) -> str:
+        "uuid是用到的时候才生成的，还没有的话现在就生成，返回uuid"
+        return self.uuid
+
+    def __reduce_ex__(self, protocol):
+        # 复制之前先把uuid定下来，不然复制出来的几个对象会各自生成不一样的uuid
+        self.ensure_uuid()
+        return super().__reduce_ex__(protocol)
+
 
 class Base(Logger, Object):
     "工具基层"
@@ -133,6 +227,7 @@ class SysMemTracer:
 
     def __enter__(self):
         self.start()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop()
@@ -153,7 +248,7 @@ class SysMemTracer:
 
     def _trace(self):
         "追踪"
-        while True:
+        while self._running:
             self.current_usage = self._get_memory_usage()
             if self.record_data:
                 self.data[time.time()] = self.current_usage
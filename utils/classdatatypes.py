@@ -6,8 +6,11 @@ import base64
 import copy
 import time
 import json
+import weakref
+import threading
 import traceback
 from queue import Queue
+from collections.abc import MutableMapping
 from typing import (
     Union,
     TypeVar,
@@ -22,6 +25,8 @@ from typing import (
     List,
     overload,
     Iterable,
+    Set,
+    NamedTuple,
 )
 
 
@@ -29,12 +34,19 @@ import pickle  # pylint: disable=unused-import
 import dill as pickle  # pylint: disable=shadowed-import
 
 
-from utils.basetypes import Base, Object
+from utils.basetypes import Base, Object, intern_uuid
 from utils.consts import inf, debug, runtime_flags
-from utils.algorithm import SupportsKeyOrdering, OrderedKeyList, Stack
+from utils.algorithm import (
+    SupportsKeyOrdering,
+    OrderedKeyList,
+    Stack,
+    RankIndex,
+    PrefixExtremaTree,
+)
 from utils.functions.prompts import send_notice as _send_notice
 from utils.functions.numbers import utc
 from utils.events.event import EventSignal, EventType
+from utils.codec import decode_record, pack_time, unpack_time
 
 
 def send_notice(
@@ -59,7 +71,8 @@ ClassDataType = Union[
 
 
 _UT = TypeVar("_UT")
-
+_KT = TypeVar("_KT")
+_VT = TypeVar("_VT")
 
 
 
@@ -79,6 +92,7 @@ class DataProperty(property):
             return
         ClassDataObj.has_unsaved_changes = True
         ClassDataObj.has_unprocessed_data = True
+        ClassDataObj.mark_dirty(instance)
         return super().__set__(instance, value)
 
     def __delete__(self, instance):
@@ -108,6 +122,124 @@ class UUIDKind(Generic[_UT], str):
         return self.uuid
 
 
+class LazyObjectDict(MutableMapping, Generic[_KT, _VT]):
+    """
+    延迟加载的字典，值在第一次被访问的时候才会真正加载。
+
+    还没加载的值需要有``uuid``属性和``load()``方法（见``utils.dataloader.DataKind``）。
+    复制或者序列化的时候会先全部加载，得到的是普通的dict。
+    """
+
+    def __init__(self, refs: Optional[Iterable[Tuple[_KT, Any]]] = None):
+        """
+        构建一个延迟加载的字典。
+
+        :param refs: 还没加载的键值对，值为带有load()方法的引用
+        """
+        self._data: Dict[_KT, Any] = {}
+        self._unloaded: set = set()
+        for key, ref in refs or ():
+            self._data[key] = ref
+            self._unloaded.add(key)
+
+    def __getitem__(self, key: _KT) -> _VT:
+        value = self._data[key]
+        if key in self._unloaded:
+            value = value.load()
+            self._data[key] = value
+            self._unloaded.discard(key)
+        return value
+
+    def __setitem__(self, key: _KT, value: _VT) -> None:
+        self._data[key] = value
+        self._unloaded.discard(key)
+
+    def __delitem__(self, key: _KT) -> None:
+        del self._data[key]
+        self._unloaded.discard(key)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __reversed__(self):
+        return reversed(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._data
+
+    def __repr__(self) -> str:
+        return (
+            f"LazyObjectDict(total={len(self._data)}, unloaded={len(self._unloaded)})"
+        )
+
+    def __deepcopy__(self, memo: dict) -> Dict[_KT, _VT]:
+        result = {}
+        memo[id(self)] = result
+        for key, value in self.items():
+            result[copy.deepcopy(key, memo)] = copy.deepcopy(value, memo)
+        return result
+
+    def __reduce__(self):
+        return (dict, (self.items(),))
+
+    @property
+    def unloaded_count(self) -> int:
+        "还没加载的对象数量"
+        return len(self._unloaded)
+
+    def load_all(self) -> None:
+        "把所有还没加载的对象都加载了"
+        for key in list(self._unloaded):
+            self[key]  # pylint: disable=pointless-statement
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self) -> List[_VT]:
+        self.load_all()
+        return list(self._data.values())
+
+    def items(self) -> List[Tuple[_KT, _VT]]:
+        self.load_all()
+        return list(self._data.items())
+
+    def copy(self) -> "LazyObjectDict[_KT, _VT]":
+        "浅复制，不会触发加载"
+        obj = LazyObjectDict()
+        obj._data = self._data.copy()
+        obj._unloaded = self._unloaded.copy()
+        return obj
+
+    def loaded_values(self) -> List[_VT]:
+        "获取已经加载了的值（不会触发加载）"
+        return [v for k, v in self._data.items() if k not in self._unloaded]
+
+    def raw_items(self) -> List[Tuple[_KT, Any, bool]]:
+        "获取所有的键、值（或者没加载的引用）以及是否已经加载（不会触发加载）"
+        return [(k, v, k not in self._unloaded) for k, v in self._data.items()]
+
+
+def _raw_items(mapping: Dict[_KT, _VT]) -> List[Tuple[_KT, Any, bool]]:
+    "获取字典的键、值和是否已经加载，对于LazyObjectDict不会触发加载"
+    if isinstance(mapping, LazyObjectDict):
+        return mapping.raw_items()
+    return [(k, v, True) for k, v in mapping.items()]
+
+
+class TemplateValues(NamedTuple):
+    "分数修改模板里面会被分数修改记录沿用的几个值"
+
+    title: str
+    "标题"
+    desc: str
+    "描述"
+    mod: float
+    "修改分数"
+
+
 class ClassDataObj(Base):
     "班级数据对象"
 
@@ -120,6 +252,27 @@ class ClassDataObj(Base):
     has_unprocessed_data = False
     "是否有未处理的数据"
 
+    dirty_objects: Dict[int, "ClassDataType"] = {}
+    "修改过但是还没保存的对象，dirty_objects[id(对象)] = 对象"
+
+    @staticmethod
+    def mark_dirty(*objs: "ClassDataType") -> None:
+        "把对象标记为已修改，下次增量保存的时候会写入"
+        for obj in objs:
+            ClassDataObj.dirty_objects[id(obj)] = obj
+
+    @staticmethod
+    def is_dirty(obj: "ClassDataType") -> bool:
+        "对象是否在上次保存之后被修改过"
+        return id(obj) in ClassDataObj.dirty_objects
+
+    @staticmethod
+    def pop_dirty_objects() -> Dict[int, "ClassDataType"]:
+        "取出当前所有修改过的对象，并清空记录"
+        dirty = ClassDataObj.dirty_objects
+        ClassDataObj.dirty_objects = {}
+        return dirty
+
     class OpreationError(Exception):
         "修改出现错误。"
 
@@ -129,6 +282,13 @@ class ClassDataObj(Base):
     ]
     "加载uuid的函数，传入一个uuid和数据类型，返回一个ClassDataType，在utils.dataloader里面实现"
 
+    LazyLoadUUID: Optional[
+        Callable[[UUIDKind[ClassDataType], Type[ClassDataType]], Any]
+    ] = None
+    """延迟加载uuid的函数，传入一个uuid和数据类型，返回一个带有load()方法的引用，在utils.dataloader里面实现
+
+    为None的时候学生的历史记录和成就会直接全部加载"""
+
     # Tip:如果需要在类型标注中使用尚未定义的类，可以用引号括起来
     class Student(Object, SupportsKeyOrdering):
         "一个学牲"
@@ -148,6 +308,27 @@ class ClassDataObj(Base):
         dummy: "Student" = None
         "空学生"
 
+        __slots__ = (
+            "_name",
+            "_num",
+            "_score",
+            "_belongs_to",
+            "_highest_score",
+            "_lowest_score",
+            "_total_score",
+            "_last_reset",
+            "_highest_score_cause_time",
+            "_lowest_score_cause_time",
+            "history",
+            "achievements",
+            "belongs_to_group",
+            "_last_reset_info",
+            "archive_uuid",
+            "_score_timeline",
+            "_uuid",
+            "__weakref__",
+        )
+
         @staticmethod
         def new_dummy():
             "返回一个空学生"
@@ -325,7 +506,9 @@ class ClassDataObj(Base):
             # if abs(val) > 1024:
                 # Base.log("E", "更改学号失败：学号过大了，不合理", "Student.name.setter")
                 # raise ClassDataObj.OpreationError(f"请求更改的学号{val}过大了, 无法设置")
+            orig = self._num
             self._num = val
+            ClassDataObj.Class.notify_num_changed(self, orig)
             Base.log("D", "更改完成！", "Student.name.setter")
 
         @num.deleter
@@ -346,6 +529,7 @@ class ClassDataObj(Base):
                 self.highest_score = self.score
             if self.score < self.lowest_score:
                 self.lowest_score = self.score
+            ClassDataObj.Class.notify_score_changed(self)
 
         @score.deleter
         def score(self):
@@ -405,6 +589,9 @@ class ClassDataObj(Base):
             self.highest_score_cause_time = 0.0
             self.lowest_score_cause_time = 0.0
             self.last_reset = time.time()
+            EventSignal.emit(
+                ClassObjectEvents.StudentScoreReset, default_arguments=((self,), {})
+            )
             self.history: Dict[int, ScoreModification] = dict()
             self.achievements = dict()
             return returnval
@@ -431,14 +618,41 @@ class ClassDataObj(Base):
             :param reset_achievments: 是否重置成就
             :return: Tuple[当前分数, 历史最高分, 历史最低分,
             Dict[分数变动时间utc*1000, 分数变动记录], Dict[成就达成时间utc*1000, 成就]"""
-            self.last_reset_info = copy.deepcopy(self)
+            snapshot = self.snapshot()
+            self.last_reset_info = snapshot
             score, highest, lowest, history = self.reset_score()
             achievements = None
             if reset_achievments:
                 achievements = self.reset_achievements()
+            else:
+                # 成就字典还要接着用，快照自己拿一份
+                snapshot.achievements = dict(snapshot.achievements)
+            # 旧的记录现在只在快照里面了，让它们指向快照
+            for modification in snapshot.history.values():
+                modification.target = snapshot
+            if reset_achievments:
+                for achievement in snapshot.achievements.values():
+                    achievement.target = snapshot
             self.refresh_uuid()
             return (score, highest, lowest, history, achievements)
 
+        def snapshot(self, detach_records: bool = False) -> "Student":
+            """获取学生当前状态的快照（写时复制）。
+
+            只复制学生本身，分数修改记录、成就和上次重置的信息都是直接引用的，
+            所以之后要改这些字典的时候得先换成新的（``reset_score``和``reset_achievements``就是这么做的）。
+
+            :param detach_records: 是否把分数修改记录和成就的字典也复制一层（不复制里面的对象），
+                后台保存的时候用，这样之后再往学生身上加记录也不会影响到快照
+            :return: 快照，uuid和现在的学生一样"""
+            self.ensure_uuid()
+            snapshot = copy.copy(self)
+            snapshot._score_timeline = None
+            if detach_records:
+                snapshot.history = self.history.copy()
+                snapshot.achievements = self.achievements.copy()
+            return snapshot
+
         def get_group(self, class_obs: "ClassStatusObserver") -> "Group":
             """获取学生所在小组。
 
@@ -446,51 +660,45 @@ class ClassDataObj(Base):
             :return: Group对象"""
             return class_obs.classes[self._belongs_to].groups[self.belongs_to_group]
 
+        @property
+        def score_timeline(self) -> "ScoreTimeline":
+            """分数变化的前缀和/最值记录，用来快速撤回和画折线图
+
+            history被整个换掉或者数量对不上的时候会重新建"""
+            timeline: Optional[ScoreTimeline] = getattr(self, "_score_timeline", None)
+            if timeline is None or not timeline.synced_with(self.history):
+                timeline = ScoreTimeline(self.history)
+                self._score_timeline = timeline
+            return timeline
+
         def get_dumplicated_ranking(self, class_obs: "ClassStatusObserver") -> int:
             """获取学生在班级中计算重复名次的排名。
 
             :param class_obs: 班级侦测器
             :return: 排名"""
-            if self._belongs_to != class_obs.class_id:
-                raise ValueError(
-                    "但是从理论层面来讲"
-                    f"你不应该把{repr(class_obs.class_id)}的侦测器"
-                    f"给一个{repr(self._belongs_to)}的学生"
-                )
-
-            else:
-                ranking_data: List[Tuple[int, "Student"]] = (
-                    class_obs.rank_non_dumplicate
-                )
-                for index, student in ranking_data:
-                    if student.num == self.num:
-                        return index
-            raise ValueError(
-                f"你确定这个学生({self.belongs_to})在这个班({class_obs.class_id})？"
-            )
+            return self._get_ranking(class_obs)
 
         def get_non_dumplicated_ranking(self, class_obs: "ClassStatusObserver") -> int:
             """获取学生在班级中计算非重复名次的排名。
 
             :param class_obs: 班级侦测器
             :return: 排名"""
+            return self._get_ranking(class_obs)
+
+        def _get_ranking(self, class_obs: "ClassStatusObserver") -> int:
+            # 两个一直都是按rank_non_dumplicate算的，保持原样
             if self._belongs_to != class_obs.class_id:
                 raise ValueError(
                     "但是从理论层面来讲"
                     f"你不应该把{repr(class_obs.class_id)}的侦测器"
                     f"给一个{repr(self._belongs_to)}的学生"
                 )
-
-            else:
-                ranking_data: List[Tuple[int, "Student"]] = (
-                    class_obs.rank_non_dumplicate
-                )
-                for index, student in ranking_data:
-                    if student.num == self.num:
-                        return index
-            raise ValueError(
-                f"你确定这个学生({self.belongs_to})在这个班({class_obs.class_id})？"
-            )
+            try:
+                return class_obs.target_class.rank_of(self, dumplicate=False)
+            except KeyError as e:
+                raise ValueError(
+                    f"你确定这个学生({self.belongs_to})在这个班({class_obs.class_id})？"
+                ) from e
 
         def __add__(
             self, value: Union["Student", float]
@@ -544,62 +752,77 @@ class ClassDataObj(Base):
                 self.total_score += value
                 return self
 
+        def to_dict(self) -> Dict[str, Any]:
+            "将学生转换为字典。"
+            return {
+                "type": self.chunk_type_name,
+                "name": self.name,
+                "num": self.num,
+                "score": float(self.score),
+                "belongs_to": self.belongs_to,
+                "history": [
+                    (h.execute_time_key, h.uuid) if loaded else (k, h.uuid)
+                    for k, h, loaded in _raw_items(self.history)
+                    if not loaded or h.executed  # 没加载的肯定是保存过的已执行的记录
+                ],
+                "last_reset": self.last_reset,
+                "achievements": [
+                    (a.time_key, a.uuid) if loaded else (k, a.uuid)
+                    for k, a, loaded in _raw_items(self.achievements)
+                ],
+                "highest_score": self.highest_score,
+                "lowest_score": self.lowest_score,
+                "highest_score_cause_time": self.highest_score_cause_time,
+                "lowest_score_cause_time": self.lowest_score_cause_time,
+                "belongs_to_group": self.belongs_to_group,
+                "total_score": self.total_score,
+                "last_reset_info": (
+                    self.last_reset_info.uuid if self._last_reset_info else None
+                ),
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
         def to_string(self) -> str:
             "将学生对象转换为JSON格式"
-            return json.dumps(
-                {
-                    "type": self.chunk_type_name,
-                    "name": self.name,
-                    "num": self.num,
-                    "score": float(self.score),
-                    "belongs_to": self.belongs_to,
-                    "history": [
-                        (h.execute_time_key, h.uuid)
-                        for h in self.history.values()
-                        if h.executed
-                    ],
-                    "last_reset": self.last_reset,
-                    "achievements": [
-                        (a.time_key, a.uuid) for a in self.achievements.values()
-                    ],
-                    "highest_score": self.highest_score,
-                    "lowest_score": self.lowest_score,
-                    "highest_score_cause_time": self.highest_score_cause_time,
-                    "lowest_score_cause_time": self.lowest_score_cause_time,
-                    "belongs_to_group": self.belongs_to_group,
-                    "total_score": self.total_score,
-                    "last_reset_info": (
-                        self.last_reset_info.uuid if self._last_reset_info else None
-                    ),
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(string: str) -> "Student":
             "将字符串转换为学生对象。"
-            data = json.loads(string)
+            data = decode_record(string)
             if data["type"] != Student.chunk_type_name:
                 raise TypeError(
                     f"类型不匹配：{data['type']} != {Student.chunk_type_name}"
                 )
+            if ClassDataObj.LazyLoadUUID is not None:
+                history = LazyObjectDict(
+                    (k, ClassDataObj.LazyLoadUUID(v, ScoreModification))
+                    for k, v in data["history"]
+                )
+                achievements = LazyObjectDict(
+                    (k, ClassDataObj.LazyLoadUUID(v, Achievement))
+                    for k, v in data["achievements"]
+                )
+            else:
+                history = {
+                    k: ClassDataObj.LoadUUID(v, ScoreModification)
+                    for k, v in data["history"]
+                }
+                achievements = {
+                    k: ClassDataObj.LoadUUID(v, Achievement)
+                    for k, v in data["achievements"]
+                }
             obj = Student(
                 name=data["name"],
                 num=data["num"],
                 score=Student.score_dtype(data["score"]),
                 belongs_to=data["belongs_to"],
-                history={
-                    k: ClassDataObj.LoadUUID(v, ScoreModification)
-                    for k, v in data["history"]
-                },
+                history=history,
                 last_reset=data["last_reset"],
                 highest_score=data["highest_score"],
                 lowest_score=data["lowest_score"],
-                achievements={
-                    k: ClassDataObj.LoadUUID(v, Achievement)
-                    for k, v in data["achievements"]
-                },
+                achievements=achievements,
                 total_score=data["total_score"],
                 highest_score_cause_time=data["highest_score_cause_time"],
                 lowest_score_cause_time=data["lowest_score_cause_time"],
@@ -614,7 +837,8 @@ class ClassDataObj(Base):
         def inst_from_string(self, string: str):
             "将字符串加载与本身。"
             obj = self.from_string(string)
-            self.__dict__.update(obj.__dict__)
+            self.update_state(obj)
+            ClassDataObj.Class.notify_score_changed(self)
             return self
 
     class SimpleStudent(Student):
@@ -736,26 +960,39 @@ class ClassDataObj(Base):
             "查看一个学生是否在这个小组。"
             return any([s.num == student.num for s in self.members])
 
-        def to_string(self):
+        def snapshot(self, students: Dict[int, "Student"]) -> "Group":
+            """获取小组的快照。
+
+            :param students: 学生到快照的映射，students[id(学生)] = 快照
+            :return: 快照，成员换成了对应的快照"""
+            self.ensure_uuid()
+            snapshot = copy.copy(self)
+            snapshot.leader = students.get(id(self.leader), self.leader)
+            snapshot.members = [students.get(id(s), s) for s in self.members]
+            return snapshot
+
+        def to_dict(self) -> Dict[str, Any]:
+            "将小组转换为字典。"
+            return {
+                "type": self.chunk_type_name,
+                "key": self.key,
+                "name": self.name,
+                "leader": self.leader.uuid,
+                "members": [s.uuid for s in self.members],
+                "belongs_to": self.belongs_to,
+                "further_desc": self.further_desc,
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
+        def to_string(self) -> str:
             "将小组对象转化为字符串。"
-            return json.dumps(
-                {
-                    "type": self.chunk_type_name,
-                    "key": self.key,
-                    "name": self.name,
-                    "leader": self.leader.uuid,
-                    "members": [s.uuid for s in self.members],
-                    "belongs_to": self.belongs_to,
-                    "further_desc": self.further_desc,
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(string: str):
             "将字符串转化为小组对象。"
-            string = json.loads(string)
+            string = decode_record(string)
             if string["type"] != Group.chunk_type_name:
                 raise TypeError(
                     f"类型不匹配：{string['type']} != {Group.chunk_type_name}"
@@ -840,6 +1077,18 @@ class ClassDataObj(Base):
             self.is_visible = is_visible
             self.archive_uuid = ClassDataObj.archive_uuid
 
+        @property
+        def values(self) -> TemplateValues:
+            """模板现在的标题、描述和分数。
+
+            用这个模板的分数修改记录共用同一个，模板被改了之后会换一个新的，
+            已经有的记录还是拿着原来那个，不会跟着变"""
+            values: Optional[TemplateValues] = getattr(self, "_values", None)
+            if values is None or values != (self.title, self.desc, self.mod):
+                values = TemplateValues(self.title, self.desc, self.mod)
+                self._values = values
+            return values
+
         def __repr__(self):
             return (
                 f"ScoreModificationTemplate("
@@ -851,26 +1100,28 @@ class ClassDataObj(Base):
                 f"is_visible={self.is_visible.__repr__()})"
             )
 
-        def to_string(self):
+        def to_dict(self) -> Dict[str, Any]:
+            "将分数加减模板转换为字典。"
+            return {
+                "type": self.chunk_type_name,
+                "key": self.key,
+                "modification": self.mod,
+                "title": self.title,
+                "description": self.desc,
+                "cant_replace": self.cant_replace,
+                "is_visible": self.is_visible,
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
+        def to_string(self) -> str:
             "将分数修改记录对象转为字符串。"
-            return json.dumps(
-                {
-                    "type": self.chunk_type_name,
-                    "key": self.key,
-                    "modification": self.mod,
-                    "title": self.title,
-                    "description": self.desc,
-                    "cant_replace": self.cant_replace,
-                    "is_visible": self.is_visible,
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(string: str):
             "将字符串转化为分数加减模板对象。"
-            string = json.loads(string)
+            string = decode_record(string)
             if string["type"] != ScoreModificationTemplate.chunk_type_name:
                 raise TypeError(
                     f"类型不匹配：{string['type']} != "
@@ -907,6 +1158,22 @@ class ClassDataObj(Base):
         dummy: "ScoreModification" = None
         "空的分数加减操作记录"
 
+        # 一个学期每个班几千条，省掉__dict__能少一大半内存；
+        # 标题、描述和分数没改过的话直接用模板的values（同一个模板的记录共用一个），
+        # 时间压成整数存（见utils.codec.pack_time）
+        __slots__ = (
+            "temp",
+            "_values",
+            "target",
+            "_execute_time",
+            "_create_time",
+            "executed",
+            "archive_uuid",
+            "execute_time_key",
+            "_uuid",
+            "__weakref__",
+        )
+
         @staticmethod
         def new_dummy():
             "返回一个空的分数加减操作"
@@ -940,21 +1207,17 @@ class ClassDataObj(Base):
             if create_time is None:
                 create_time = Base.gettime()
             self.temp = template
-
-            if title == self.temp.title or title is None:
-                self.title = self.temp.title
+            values = template.values
+            if (title is None or title == values.title) and (
+                desc is None or desc == values.desc
+            ) and (mod is None or mod == values.mod):
+                self._values = values
             else:
-                self.title = title
-
-            if desc == self.temp.desc or desc is None:
-                self.desc = self.temp.desc
-            else:
-                self.desc = desc
-
-            if mod == self.temp.mod or mod is None:
-                self.mod = self.temp.mod
-            else:
-                self.mod = mod
+                self._values = TemplateValues(
+                    values.title if title is None else title,
+                    values.desc if desc is None else desc,
+                    values.mod if mod is None else mod,
+                )
             self.target = target
             self.execute_time = execute_time
             self.create_time = create_time
@@ -962,6 +1225,59 @@ class ClassDataObj(Base):
             self.archive_uuid = ClassDataObj.archive_uuid
             self.execute_time_key = 0
 
+        def _set_value(self, **changes) -> None:
+            # 加__slots__之前存的数据是一个一个属性设置回来的，那时候还没有_values
+            values = getattr(self, "_values", None) or self.temp.values
+            values = values._replace(**changes)
+            if values == self.temp.values:
+                values = self.temp.values
+            self._values = values
+
+        @property
+        def title(self) -> str:
+            "标题"
+            return self._values.title
+
+        @title.setter
+        def title(self, value: str):
+            self._set_value(title=value)
+
+        @property
+        def desc(self) -> str:
+            "描述"
+            return self._values.desc
+
+        @desc.setter
+        def desc(self, value: str):
+            self._set_value(desc=value)
+
+        @property
+        def mod(self) -> float:
+            "修改分数"
+            return self._values.mod
+
+        @mod.setter
+        def mod(self, value: float):
+            self._set_value(mod=value)
+
+        @property
+        def execute_time(self) -> Optional[str]:
+            "执行时间"
+            return unpack_time(self._execute_time)
+
+        @execute_time.setter
+        def execute_time(self, value: Optional[str]):
+            self._execute_time = pack_time(value)
+
+        @property
+        def create_time(self) -> Optional[str]:
+            "创建时间"
+            return unpack_time(self._create_time)
+
+        @create_time.setter
+        def create_time(self, value: Optional[str]):
+            self._create_time = pack_time(value)
+
         def __repr__(self):
             return (
                 f"ScoreModification(template={repr(self.temp)}, "
@@ -995,6 +1311,12 @@ class ClassDataObj(Base):
                 self.target.score += self.mod
                 self.executed = True
                 self.target.history[self.execute_time_key] = self
+                ScoreTimeline.on_added(self.target, self)
+                ClassDataObj.mark_dirty(self, self.target)
+                EventSignal.emit(
+                    ClassObjectEvents.StudentScoreChanged,
+                    default_arguments=((self.target,), {}),
+                )
                 return True
 
             except (
@@ -1024,35 +1346,17 @@ class ClassDataObj(Base):
 
             :return: 是否执行成功（bool: 结果, str: 成功/失败原因）
             """
-            if self not in self.target.history.values():
+            timeline = self.target.score_timeline
+            pos = timeline.position_of(self)
+            if pos is None:
                 Base.log("W", "当前操作未执行，无法撤回", "ScoreModification.retract")
                 return False, "并不在本周历史中"
             if self.executed:
                 try:
+                    # 去掉自己之后重新算最高分/最低分
+                    timeline.set_executed(pos, False)
                     if self.mod < 0:
-                        findscore = 0.0
-                        lowestscore = 0.0
-                        lowesttimekey = 0
-                        # 重新计算最高分和最低分
-                        for i in self.target.history:
-                            tmp: ScoreModification = self.target.history[i]
-
-                            if (
-                                tmp.execute_time_key != self.execute_time_key
-                                and tmp.executed
-                            ):  # 排除自身
-                                findscore += tmp.mod
-
-                            if (
-                                lowestscore > findscore
-                                and tmp.execute_time_key != self.execute_time_key
-                            ):
-                                lowesttimekey = tmp.execute_time_key
-                                lowestscore = findscore
-
-                        if self.execute_time_key == lowesttimekey:
-                            lowestscore = 0
-
+                        lowestscore, lowesttimekey = timeline.lowest()
                         if self.target.lowest_score_cause_time != lowesttimekey:
                             self.target.lowest_score_cause_time = lowesttimekey
 
@@ -1060,25 +1364,7 @@ class ClassDataObj(Base):
                             self.target.lowest_score = lowestscore
 
                     else:
-                        findscore = 0.0
-                        highestscore = 0.0
-                        highesttimekey = 0
-                        for i in self.target.history:
-                            tmp: ScoreModification = self.target.history[i]
-                            if (
-                                tmp.execute_time_key != self.execute_time_key
-                                and tmp.executed
-                            ):
-                                findscore += tmp.mod
-
-                            if (
-                                highestscore < findscore
-                                and tmp.execute_time_key != self.execute_time_key
-                            ):
-                                highesttimekey = tmp.execute_time_key
-                                highestscore = findscore
-                        if self.execute_time_key == highesttimekey:
-                            highestscore = 0
+                        highestscore, highesttimekey = timeline.highest()
                         if self.target.highest_score_cause_time != highesttimekey:
                             self.target.highest_score_cause_time = highesttimekey
 
@@ -1088,6 +1374,11 @@ class ClassDataObj(Base):
                     self.target.score -= self.mod
                     self.executed = False
                     self.execute_time = None
+                    ClassDataObj.mark_dirty(self, self.target)
+                    EventSignal.emit(
+                        ClassObjectEvents.StudentScoreChanged,
+                        default_arguments=((self.target,), {}),
+                    )
                     del self
                     return True, "操作成功完成"
                 except (
@@ -1099,6 +1390,7 @@ class ClassDataObj(Base):
                     OverflowError,
                     ZeroDivisionError,
                 ) as exception:
+                    timeline.invalidate()
                     if debug:
                         raise exception
                     Base.log(
@@ -1114,29 +1406,31 @@ class ClassDataObj(Base):
                 Base.log("W", "操作并未执行，无需撤回", "ScoreModification.retract")
                 return False, "操作并未执行, 无需撤回"
 
-        def to_string(self):
+        def to_dict(self) -> Dict[str, Any]:
+            "将分数修改记录转换为字典。"
+            return {
+                "type": self.chunk_type_name,
+                "template": self.temp.uuid,
+                "target": self.target.uuid,
+                "title": self.title,
+                "mod": self.mod,
+                "desc": self.desc,
+                "executed": self.executed,
+                "create_time": self.create_time,
+                "execute_time": self.execute_time,
+                "execute_time_key": self.execute_time_key,
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
+        def to_string(self) -> str:
             "将分数修改记录对象转为字符串。"
-            return json.dumps(
-                {
-                    "type": self.chunk_type_name,
-                    "template": self.temp.uuid,
-                    "target": self.target.uuid,
-                    "title": self.title,
-                    "mod": self.mod,
-                    "desc": self.desc,
-                    "executed": self.executed,
-                    "create_time": self.create_time,
-                    "execute_time": self.execute_time,
-                    "execute_time_key": self.execute_time_key,
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(string: str):
             "将字符串转换为分数修改对象。"
-            d = json.loads(string)
+            d = decode_record(string)
             if d["type"] != ScoreModification.chunk_type_name:
                 raise ValueError(
                     f"类型不匹配：{d['type']} != "
@@ -1153,14 +1447,14 @@ class ClassDataObj(Base):
                 desc=d["desc"],
             )
             obj.uuid = d["uuid"]
-            obj.archive_uuid = d["archive_uuid"]
+            obj.archive_uuid = intern_uuid(d["archive_uuid"])
             obj.execute_time_key = d["execute_time_key"]
             return obj
 
         def inst_from_string(self, string: str):
             "将字符串加载与本身。"
             obj = self.from_string(string)
-            self.__dict__.update(obj.__dict__)
+            self.update_state(obj)
             return self
 
     class HomeworkRule(Object, SupportsKeyOrdering):
@@ -1201,26 +1495,28 @@ class ClassDataObj(Base):
             self.rule_mapping = rule_mapping
             self.archive_uuid = ClassDataObj.archive_uuid
 
-        def to_string(self):
+        def to_dict(self) -> Dict[str, Any]:
+            "将作业规则转换为字典。"
+            return {
+                "type": self.chunk_type_name,
+                "key": self.key,
+                "subject_name": self.subject_name,
+                "ruler": self.ruler,
+                "rule_mapping": dict(
+                    [(n, t.uuid) for n, t in self.rule_mapping.items()]
+                ),
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
+        def to_string(self) -> str:
             "将作业规则对象转为字符串。"
-            return json.dumps(
-                {
-                    "type": self.chunk_type_name,
-                    "key": self.key,
-                    "subject_name": self.subject_name,
-                    "ruler": self.ruler,
-                    "rule_mapping": dict(
-                        [(n, t.uuid) for n, t in self.rule_mapping.items()]
-                    ),
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(s: str):
             "从字符串加载作业规则对象。"
-            d = json.loads(s)
+            d = decode_record(s)
             if d["type"] != HomeworkRule.chunk_type_name:
                 raise ValueError(
                     f"类型不匹配：{d['type']} != "
@@ -1236,7 +1532,7 @@ class ClassDataObj(Base):
                 },
             )
             obj.uuid = d["uuid"]
-            obj.archive_uuid = d["archive_uuid"]
+            obj.archive_uuid = intern_uuid(d["archive_uuid"])
             return obj
 
         def inst_from_string(self, string: str):
@@ -1332,14 +1628,118 @@ class ClassDataObj(Base):
             # Tip:避免除以零错误
             return self.student_total_score / max(self.student_count, 1)
 
+        rank_indexes: "weakref.WeakValueDictionary[int, RankIndex[Student]]" = (
+            weakref.WeakValueDictionary()
+        )
+        "学生到所在班级排名索引的映射，rank_indexes[id(学生)] = 排名索引"
+
+        rank_index_lock = threading.RLock()
+        "建排名索引和更新排名索引用的锁"
+
+        @staticmethod
+        def notify_score_changed(student: "Student") -> None:
+            """学生分数变了，更新学生所在班级的排名索引。
+
+            :param student: 学生
+            """
+            index = ClassDataObj.Class.rank_indexes.get(id(student))
+            if index is not None:
+                with ClassDataObj.Class.rank_index_lock:
+                    index.update(student)
+
+        @staticmethod
+        def notify_num_changed(student: "Student", orig: int) -> None:
+            """学生学号变了，更新学生所在班级的排名索引。
+
+            :param student: 学生
+            :param orig: 原来的学号
+            """
+            index = ClassDataObj.Class.rank_indexes.get(id(student))
+            if index is not None:
+                with ClassDataObj.Class.rank_index_lock:
+                    index.rekey(student, orig)
+
+        @property
+        def rank_index(self) -> RankIndex["Student"]:
+            """学生的排名索引，按(分数, 学号)排好序，分数变了会自己更新
+
+            学生增减要调``index_student``/``unindex_student``，人数对不上的话第一次访问会重新建一遍"""
+            index: Optional[RankIndex[Student]] = self.__dict__.get("_rank_index")
+            if index is not None and len(index) == len(self.students):
+                return index
+            with ClassDataObj.Class.rank_index_lock:
+                index = self.__dict__.get("_rank_index")
+                if index is None or len(index) != len(self.students):
+                    index = RankIndex(
+                        list(self.students.values()),
+                        score=lambda s: s.score,
+                        key=lambda s: s.num,
+                    )
+                    for stu in index:
+                        ClassDataObj.Class.rank_indexes[id(stu)] = index
+                    self._rank_index = index
+            return index
+
+        def index_student(self, student: "Student") -> None:
+            """学生加进班级之后调用，排名索引已经建好的话直接放进去。
+
+            只看人数的话，先删一个再加一个索引就发现不了变化了
+
+            :param student: 学生
+            """
+            index: Optional[RankIndex[Student]] = self.__dict__.get("_rank_index")
+            if index is None:
+                return
+            with ClassDataObj.Class.rank_index_lock:
+                index.add(student)
+                ClassDataObj.Class.rank_indexes[id(student)] = index
+
+        def unindex_student(self, student: "Student") -> None:
+            """学生从班级里面删掉之后调用，把学生从排名索引里面拿掉。
+
+            :param student: 学生
+            """
+            index: Optional[RankIndex[Student]] = self.__dict__.get("_rank_index")
+            if index is None:
+                return
+            with ClassDataObj.Class.rank_index_lock:
+                index.remove(student)
+                if ClassDataObj.Class.rank_indexes.get(id(student)) is index:
+                    del ClassDataObj.Class.rank_indexes[id(student)]
+
+        def rank_of(self, student: "Student", dumplicate: bool = True) -> int:
+            """获取学生的名次。
+
+            :param student: 学生
+            :param dumplicate: 是否计算重复名次（1-2-2-3），否则是1-2-2-4
+            :raise KeyError: 学生不在这个班
+            :return: 名次
+            """
+            return self.rank_index.rank_of(student, dumplicate)
+
+        def top_students(self, k: int) -> List["Student"]:
+            """分数最高的k个学生（同分按学号）。
+
+            :param k: 人数
+            """
+            return self.rank_index.top(k)
+
+        def students_in_rank_range(
+            self, lowest: int, highest: int, dumplicate: bool = True
+        ) -> List[Tuple[int, "Student"]]:
+            """名次在[lowest, highest]之间的学生。
+
+            :param lowest: 名次下限（数字小的那头）
+            :param highest: 名次上限
+            :param dumplicate: 是否计算重复名次
+            :return: List[Tuple[名次, 学生]]
+            """
+            return self.rank_index.window(lowest, highest, dumplicate)
+
         @property
         def stu_score_ord(self):
             "学生分数排序，这个不常用"
-            return dict(
-                enumerate(
-                    sorted(list(self.students.values()), key=lambda a: a.score), start=1
-                )
-            )
+            return dict(enumerate(reversed(list(self.rank_index)), start=1))
 
         @property
         def rank_non_dumplicate(self):
@@ -1356,22 +1756,7 @@ class ClassDataObj(Base):
                 (5, Student(name="某个学生", score=9,   ...)),
                 (7, Student(name="某个学生", score=1,   ...))
             ]"""
-            stu_list = self.students.values()
-            stu_list = sorted(stu_list, key=lambda s: s.score, reverse=True)
-            stu_list2: List[Tuple[int, "Student"]] = []
-            last = inf
-            last_ord = 0
-            cur_ord = 0
-            for stu in stu_list:
-                cur_ord += 1
-                if stu.score == last:
-                    _ord = last_ord
-                else:
-                    _ord = cur_ord
-                    last_ord = cur_ord
-                stu_list2.append((_ord, stu))
-                last = stu.score
-            return stu_list2
+            return self.rank_index.ranking(dumplicate=False)
 
         @property
         def rank_dumplicate(self):
@@ -1388,30 +1773,58 @@ class ClassDataObj(Base):
                 (4, Student(name="某个学生", score=9,   ...)),
                 (5, Student(name="某个学生", score=1,   ...))
             ]"""
-            stu_list = self.students.values()
-            stu_list = sorted(stu_list, key=lambda s: s.score, reverse=True)
-            stu_list2: List[Tuple[int, "Student"]] = []
-            last = inf
-            last_ord = 0
-            for stu in stu_list:
-                if stu.score != last:
-                    last_ord += 1
-                    last = stu.score
-                stu_list2.append((last_ord, stu))
-                
-            return stu_list2
+            return self.rank_index.ranking(dumplicate=True)
 
         def reset(self) -> "Class":
-            "重置班级"
-            class_orig = copy.deepcopy(self)
+            """重置班级
+
+            :return: 重置前的班级快照（学生是各自的``last_reset_info``）"""
             Base.log("W", f" -> 重置班级：{self.name} ({self.key})")
+            students: Dict[int, Student] = {}
             for s in self.students.values():
                 s.reset()
+                students[id(s)] = s.last_reset_info
+            class_orig = self.snapshot(students)
             self.refresh_uuid()
             return class_orig
 
-        def to_string(self) -> str:
-            "将班级对象转换为字符串。"
+        def snapshot(
+            self,
+            students: Optional[Dict[int, "Student"]] = None,
+            detach_records: bool = False,
+        ) -> "Class":
+            """获取班级的快照（写时复制）。
+
+            班级、小组和学生会复制一层，分数修改记录和成就都是直接引用的。
+
+            :param students: 已经有快照的学生，students[id(学生)] = 快照，没有的会现拍一个
+            :param detach_records: 现拍的学生快照是否复制记录字典，见``Student.snapshot``
+            :return: 快照"""
+            students = dict(students or {})
+            for s in self.students.values():
+                if id(s) not in students:
+                    students[id(s)] = s.snapshot(detach_records)
+            self.ensure_uuid()
+            snapshot = copy.copy(self)
+            snapshot.__dict__.pop("_rank_index", None)
+            snapshot.students = {
+                num: students[id(s)] for num, s in self.students.items()
+            }
+            snapshot.groups = {
+                key: g.snapshot(students) for key, g in self.groups.items()
+            }
+            snapshot.cleaning_mapping = {
+                day: {
+                    role: [students.get(id(s), s) for s in members]
+                    for role, members in mapping.items()
+                }
+                for day, mapping in self.cleaning_mapping.items()
+            }
+            snapshot.homework_rules = copy.copy(self.homework_rules)
+            return snapshot
+
+        def to_dict(self) -> Dict[str, Any]:
+            "将班级转换为字典。"
             if hasattr(self, "cleaing_mapping") and not hasattr(
                 self, "cleaning_mapping"
             ):
@@ -1421,30 +1834,32 @@ class ClassDataObj(Base):
                         int, Dict[Literal["member", "leader"], List["Student"]]
                     ]
                 ] = getattr(self, "cleaing_mapping")
-            return json.dumps(
-                {
-                    "type": self.chunk_type_name,
-                    "key": self.key,
-                    "name": self.name,
-                    "owner": self.owner,
-                    "students": [(s.num, s.uuid) for s in self.students.values()],
-                    "groups": [(g.key, g.uuid) for g in self.groups.values()],
-                    "cleaning_mapping": [
-                        (k, [(t, [_s.uuid for _s in s]) for t, s in v.items()])
-                        for k, v in self.cleaning_mapping.items()
-                    ],
-                    "homework_rules": [
-                        (n, h.to_string()) for n, h in self.homework_rules.items()
-                    ],
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return {
+                "type": self.chunk_type_name,
+                "key": self.key,
+                "name": self.name,
+                "owner": self.owner,
+                "students": [(s.num, s.uuid) for s in self.students.values()],
+                "groups": [(g.key, g.uuid) for g in self.groups.values()],
+                "cleaning_mapping": [
+                    (k, [(t, [_s.uuid for _s in s]) for t, s in v.items()])
+                    for k, v in self.cleaning_mapping.items()
+                ],
+                "homework_rules": [
+                    (n, h.to_string()) for n, h in self.homework_rules.items()
+                ],
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
+        def to_string(self) -> str:
+            "将班级对象转换为字符串。"
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(string: str) -> "Class":
             "从字符串加载班级对象。"
-            d = json.loads(string)
+            d = decode_record(string)
             if d["type"] != Class.chunk_type_name:
                 raise ValueError(f"类型不匹配：{d['type']} != {Class.chunk_type_name}")
             obj = Class(
@@ -1470,12 +1885,13 @@ class ClassDataObj(Base):
                 },
             )
             obj.uuid = d["uuid"]
-            obj.archive_uuid = d["archive_uuid"]
+            obj.archive_uuid = intern_uuid(d["archive_uuid"])
             return obj
 
         def inst_from_string(self, string: str):
             "将字符串加载与本身。"
             obj = self.from_string(string)
+            self.__dict__.pop("_rank_index", None)  # 学生全换了，索引得重建
             self.__dict__.update(obj.__dict__)
             return self
 
@@ -1515,6 +1931,207 @@ class ClassDataObj(Base):
             self.groups = self.student_class.groups
             "班级中的所有组"
 
+    class ScoreTimeline(Object):
+        """学生一轮里分数变化的记录
+
+        按history的顺序存每条点评生效的分数（没生效的算0），
+        用线段树维护前缀和的最大/最小值，撤回一条点评的时候不用把history整个重放一遍
+        """
+
+        def __init__(self, history: Dict[int, "ScoreModification"]):
+            """构造函数。
+
+            :param history: 学生的历史记录
+            """
+            self.source: Optional[Dict[int, ScoreModification]] = history
+            "对应的历史记录"
+            self.keys: List[int] = []
+            "每个位置对应的history的key"
+            self.entries: List[ScoreModification] = []
+            "每个位置对应的点评"
+            self.positions: Dict[int, int] = {}
+            "点评的位置，positions[id(点评)] = 位置"
+            values = []
+            for key, modification in history.items():
+                self.positions[id(modification)] = len(self.keys)
+                self.keys.append(key)
+                self.entries.append(modification)
+                values.append(modification.mod if modification.executed else 0.0)
+            self.tree = PrefixExtremaTree(values)
+            "前缀和线段树"
+
+        def __reduce__(self):
+            # 位置是按id(点评)记的，复制/序列化出来就对不上了，给个空的让它重新建
+            return (ClassDataObj.ScoreTimeline, ({},))
+
+        def synced_with(self, history: Dict[int, "ScoreModification"]) -> bool:
+            "是否还和这个history对得上"
+            return self.source is history and len(self.keys) == len(history)
+
+        def invalidate(self) -> None:
+            "标记为失效，下次用的时候重新建"
+            self.source = None
+
+        @staticmethod
+        def on_added(student: "Student", modification: "ScoreModification") -> None:
+            """history里加了一条点评之后调用，已经建好的记录直接追加到末尾。
+
+            :param student: 学生
+            :param modification: 加进去的点评
+            """
+            timeline: Optional[ScoreTimeline] = getattr(student, "_score_timeline", None)
+            if timeline is None:
+                return
+            if (
+                timeline.source is not student.history
+                or len(timeline.keys) + 1 != len(student.history)
+                or id(modification) in timeline.positions
+            ):
+                timeline.invalidate()
+                return
+            timeline.positions[id(modification)] = len(timeline.keys)
+            timeline.keys.append(modification.execute_time_key)
+            timeline.entries.append(modification)
+            timeline.tree.append(modification.mod if modification.executed else 0.0)
+
+        def position_of(self, modification: "ScoreModification") -> Optional[int]:
+            """点评在记录里的位置，不在里面就是None。
+
+            :param modification: 点评
+            """
+            pos = self.positions.get(id(modification))
+            if pos is None or self.entries[pos] is not modification:
+                return None
+            return pos
+
+        def set_executed(self, pos: int, executed: bool) -> None:
+            """修改某条点评是否生效。
+
+            :param pos: 位置
+            :param executed: 是否生效
+            """
+            self.tree.set(pos, self.entries[pos].mod if executed else 0.0)
+
+        def highest(self) -> Tuple[float, int]:
+            """这一轮的最高分（从0开始算）。
+
+            :return: (最高分, 产生最高分的点评的key)，没有超过0就是(0.0, 0)
+            """
+            value, pos = self.tree.max_prefix()
+            if pos < 0 or value <= 0:
+                return 0.0, 0
+            return round(value, 1), self.keys[pos]
+
+        def lowest(self) -> Tuple[float, int]:
+            """这一轮的最低分（从0开始算）。
+
+            :return: (最低分, 产生最低分的点评的key)，没有低于0就是(0.0, 0)
+            """
+            value, pos = self.tree.min_prefix()
+            if pos < 0 or value >= 0:
+                return 0.0, 0
+            return round(value, 1), self.keys[pos]
+
+        def series(self) -> Tuple[List[int], List[float]]:
+            """分数折线，只包含生效了的点评。
+
+            :return: (在history里的序号（从1开始，0是起点）, 当时的分数)
+            """
+            prefix = self.tree.prefix_sums()
+            xs = [0]
+            ys = [0.0]
+            for pos, modification in enumerate(self.entries):
+                if modification.executed:
+                    xs.append(pos + 1)
+                    ys.append(round(prefix[pos], 1))
+            return xs, ys
+
+    class StudentSnapshot(Object):
+        """学生在某一帧的状态快照，给成就模板判断条件用
+
+        排名和各个点评的次数在一帧里只算一次，不用每个成就模板都排序一遍班级
+        """
+
+        def __init__(
+            self,
+            student: "Student",
+            rank: Optional[int] = None,
+            lowest_rank: Optional[int] = None,
+            class_obs: Optional["ClassStatusObserver"] = None,
+        ):
+            """快照构造函数。
+
+            :param student: 学生
+            :param rank: 学生的排名（计算重复名次），不给就在用到的时候从class_obs算
+            :param lowest_rank: 最后一名的名次
+            :param class_obs: 班级侦测器
+            """
+            self.student = student
+            "学生"
+            self.name = student.name
+            "学生名字"
+            self.num = student.num
+            "学号"
+            self.score = student.score
+            "分数"
+            self.highest_score = student.highest_score
+            "最高分"
+            self.lowest_score = student.lowest_score
+            "最低分"
+            self.highest_score_cause_time = student.highest_score_cause_time
+            "最高分产生时间"
+            self.lowest_score_cause_time = student.lowest_score_cause_time
+            "最低分产生时间"
+            self.class_obs = class_obs
+            "班级侦测器"
+            self._rank = rank
+            self._lowest_rank = lowest_rank
+            self._modify_counts: Optional[Dict[str, int]] = None
+
+        @staticmethod
+        def rank_table(
+            ranking: Iterable[Tuple[int, "Student"]],
+        ) -> Tuple[Dict[int, int], int]:
+            """把排名列表整理成学号到名次的表。
+
+            :param ranking: 排名（一般是rank_dumplicate）
+            :return: (学号->名次, 最后一名的名次)
+            """
+            ranks = {stu.num: rank for rank, stu in ranking}
+            return ranks, max(ranks.values(), default=0)
+
+        def _load_ranks(self):
+            if self.class_obs is None:
+                raise AttributeError("没有排名信息")
+            ranks, self._lowest_rank = self.rank_table(self.class_obs.rank_dumplicate)
+            self._rank = ranks[self.num]
+
+        @property
+        def rank(self) -> int:
+            "学生的排名（计算重复名次）"
+            if self._rank is None:
+                self._load_ranks()
+            return self._rank
+
+        @property
+        def lowest_rank(self) -> int:
+            "最后一名的名次"
+            if self._lowest_rank is None:
+                self._load_ranks()
+            return self._lowest_rank
+
+        @property
+        def modify_counts(self) -> Dict[str, int]:
+            "每种点评（模板key）生效的次数"
+            if self._modify_counts is None:
+                counts: Dict[str, int] = {}
+                for history in self.student.history.values():
+                    if history.executed:
+                        key = history.temp.key
+                        counts[key] = counts.get(key, 0) + 1
+                self._modify_counts = counts
+            return self._modify_counts
+
     class ObserverError(Exception):
         "侦测器出错"
 
@@ -1712,6 +2329,97 @@ class ClassDataObj(Base):
             self.further_info = further_info
             self.condition_info = condition_info
             self.archive_uuid = ClassDataObj.archive_uuid
+            self.compile()
+
+        def compile(self) -> List[Callable[["StudentSnapshot"], bool]]:
+            """
+            把达成条件编译成一串判断函数，存在self.plan里。
+
+            构造的时候会自动调用，之后要是直接改了条件的属性得再调一次。
+            自定义条件（others）不在里面，由achieved_by单独处理。
+
+            :return: 判断函数的列表，每个函数传进来一个StudentSnapshot
+            """
+            plan: List[Callable[["StudentSnapshot"], bool]] = []
+
+            if "on_reset" in self.when_triggered and "any" not in self.when_triggered:
+                plan.append(
+                    lambda s: s.highest_score == s.lowest_score == s.score == 0
+                )
+
+            if hasattr(self, "name_ne"):
+                name_ne = frozenset(self.name_ne)
+                plan.append(lambda s: s.name not in name_ne)
+
+            if hasattr(self, "num_ne"):
+                num_ne = frozenset(self.num_ne)
+                plan.append(lambda s: s.num not in num_ne)
+
+            if hasattr(self, "name_eq"):
+                name_eq = frozenset(self.name_eq)
+                plan.append(lambda s: s.name in name_eq)
+
+            if hasattr(self, "num_eq"):
+                num_eq = frozenset(self.num_eq)
+                plan.append(lambda s: s.num in num_eq)
+
+            if hasattr(self, "score_range"):
+                score_range = tuple((i[0], i[1]) for i in self.score_range)
+                plan.append(
+                    lambda s: any(down <= s.score <= up for down, up in score_range)
+                )
+
+            if hasattr(self, "score_rank_down_limit"):
+                # 负数的名次是倒数的，得等拿到最后一名的名次再算
+                rank_down = self.score_rank_down_limit
+                rank_up = self.score_rank_up_limit
+
+                def check_rank(s: "StudentSnapshot") -> bool:
+                    lowest = s.lowest_rank
+                    down = lowest + rank_down + 1 if rank_down < 0 else rank_down
+                    up = lowest + rank_up + 1 if rank_up < 0 else rank_up
+                    return down <= s.rank <= up
+
+                plan.append(check_rank)
+
+            if hasattr(self, "highest_score_down_limit"):
+                hs_down = self.highest_score_down_limit
+                hs_up = self.highest_score_up_limit
+                plan.append(lambda s: hs_down <= s.highest_score <= hs_up)
+
+            if hasattr(self, "highest_score_cause_range_down_limit"):
+                hc_down = self.highest_score_cause_range_down_limit
+                hc_up = self.highest_score_cause_range_up_limit
+                plan.append(lambda s: hc_down <= s.highest_score_cause_time <= hc_up)
+
+            if hasattr(self, "lowest_score_down_limit"):
+                ls_down = self.lowest_score_down_limit
+                ls_up = self.lowest_score_up_limit
+                plan.append(lambda s: ls_down <= s.lowest_score <= ls_up)
+
+            if hasattr(self, "lowest_score_cause_range_down_limit"):
+                lc_down = self.lowest_score_cause_range_down_limit
+                lc_up = self.lowest_score_cause_range_up_limit
+                plan.append(lambda s: lc_down <= s.lowest_score_cause_time <= lc_up)
+
+            if hasattr(self, "modify_ranges"):
+                modify_ranges = tuple(
+                    (item["key"], item["lowest"], item["highest"])
+                    for item in self.modify_ranges
+                )
+
+                def check_modify(s: "StudentSnapshot") -> bool:
+                    counts = s.modify_counts
+                    return all(
+                        lowest <= counts.get(key, 0) <= highest
+                        for key, lowest, highest in modify_ranges
+                    )
+
+                plan.append(check_modify)
+
+            self.plan = plan
+            "编译好的判断条件"
+            return plan
 
         @property
         def kwargs(self):
@@ -1772,66 +2480,65 @@ class ClassDataObj(Base):
                 kwargs["condition_info"] = self.condition_info
             return kwargs
 
+        @property
+        def condition_fields(self) -> Set[str]:
+            """
+            达成条件用到的学生属性，成就侦测器靠这个判断哪些成就需要重新检查。
+
+            可能包含：name, num, score, highest_score, lowest_score, history, rank, other
+            （other是自定义条件，什么都可能用到）
+            """
+            fields = set()
+            if hasattr(self, "name_eq") or hasattr(self, "name_ne"):
+                fields.add("name")
+            if hasattr(self, "num_eq") or hasattr(self, "num_ne"):
+                fields.add("num")
+            if hasattr(self, "score_range") or (
+                "on_reset" in self.when_triggered and "any" not in self.when_triggered
+            ):
+                fields.add("score")
+            if hasattr(self, "score_rank_down_limit"):
+                fields.add("rank")
+            if hasattr(self, "highest_score_down_limit") or hasattr(
+                self, "highest_score_cause_range_down_limit"
+            ):
+                fields.add("highest_score")
+            if hasattr(self, "lowest_score_down_limit") or hasattr(
+                self, "lowest_score_cause_range_down_limit"
+            ):
+                fields.add("lowest_score")
+            if hasattr(self, "modify_ranges"):
+                fields.add("history")
+            if hasattr(self, "other"):
+                fields.add("other")
+            return fields
+
         def achieved_by(
-            self, student: "Student", class_obs: "ClassStatusObserver"
+            self,
+            student: "Student",
+            class_obs: "ClassStatusObserver",
+            snapshot: Optional["StudentSnapshot"] = None,
         ) -> bool:
             """
             判断一个成就是否达成
 
             :param student: 学生
             :param class_obs: 班级状态侦测器
+            :param snapshot: 这一帧的学生快照，不给就现场做一个
             :raise ObserverError: lambda或者function爆炸了
             :return: 是否达成"""
 
-            # 反人类写法又出现了
-
             if not self.active:
                 return False
-            if (
-                "on_reset" in self.when_triggered and "any" not in self.when_triggered
-            ) and (
-                not student.highest_score == student.lowest_score == student.score == 0
-            ):
-                return False
-
-            if hasattr(self, "name_ne") and student.name in self.name_ne:
-                return False
-
-            if hasattr(self, "num_ne") and student.num in self.num_ne:
-                return False
-
-            if hasattr(self, "name_eq") and student.name not in self.name_eq:
-                return False
 
-            if hasattr(self, "num_eq") and student.num not in self.num_eq:
-                return False
-
-            if hasattr(self, "score_range") and not any(
-                [i[0] <= student.score <= i[1] for i in self.score_range]
-            ):
-                return False
+            plan = self.__dict__.get("plan")
+            if plan is None:  # 不是从构造函数出来的（比如老的pickle）
+                plan = self.compile()
+            if snapshot is None:
+                snapshot = StudentSnapshot(student, class_obs=class_obs)
             try:
-                if hasattr(self, "score_rank_down_limit"):
-                    lowest_rank = max(*([i[0] for i in class_obs.rank_dumplicate]))
-                    l = (
-                        (lowest_rank + self.score_rank_down_limit + 1)
-                        if self.score_rank_down_limit < 0
-                        else self.score_rank_down_limit
-                    )
-                    r = (
-                        (lowest_rank + self.score_rank_up_limit + 1)
-                        if self.score_rank_up_limit < 0
-                        else self.score_rank_up_limit
-                    )
-                    if not (
-                        l
-                        <= [
-                            i[0]
-                            for i in class_obs.rank_dumplicate
-                            if i[1].num == student.num
-                        ][0]
-                        <= r
-                    ):
+                for predicate in plan:
+                    if not predicate(snapshot):
                         return False
             except (
                 KeyError,
@@ -1841,55 +2548,6 @@ class ClassDataObj(Base):
             ) as unused:  # pylint: disable=unused-variable
                 return False
 
-            if hasattr(self, "highest_score_down_limit") and (
-                not self.highest_score_down_limit
-                <= student.highest_score
-                <= self.highest_score_up_limit
-            ):
-                return False
-
-            if hasattr(self, "highest_score_cause_range_down_limit") and (
-                not self.highest_score_cause_range_down_limit
-                <= student.highest_score_cause_time
-                <= self.highest_score_cause_range_up_limit
-            ):
-                return False
-
-            if hasattr(self, "lowest_score_down_limit") and (
-                not self.lowest_score_down_limit
-                <= student.lowest_score
-                <= self.lowest_score_up_limit
-            ):
-                return False
-
-            if hasattr(self, "lowest_score_cause_range_down_limit") and (
-                not self.lowest_score_cause_range_down_limit
-                <= student.lowest_score_cause_time
-                <= self.lowest_score_cause_range_up_limit
-            ):
-                return False
-            try:
-                if hasattr(self, "modify_ranges") and not all(
-                    [
-                        item["lowest"]
-                        <= [
-                            history.temp.key
-                            for history in student.history.values()
-                            if history.executed
-                        ].count(item["key"])
-                        <= item["highest"]
-                        for item in self.modify_ranges
-                    ]
-                ):
-                    return False
-            except (
-                KeyError,
-                IndexError,
-                TypeError,
-                AttributeError,
-            ) as unused:  # pylint: disable=unused-variable
-                return False
-
             if hasattr(self, "other"):
                 try:
                     d = ClassData(
@@ -2083,20 +2741,24 @@ class ClassDataObj(Base):
             return_str += "\n" * 2 + self.condition_info
             return return_str
 
-        def to_string(self):
-            "从字符串加载成就模板对象。"
+        def to_dict(self) -> Dict[str, Any]:
+            "将成就模板转换为字典。"
             obj = {"type": self.chunk_type_name}
             obj.update(self.kwargs)
             if "others" in obj:
                 obj["others"] = base64.b64encode(pickle.dumps(obj["others"])).decode()
             obj["uuid"] = self.uuid
             obj["archive_uuid"] = self.archive_uuid
-            return json.dumps(obj)
+            return obj
+
+        def to_string(self) -> str:
+            "从字符串加载成就模板对象。"
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(string: str):
             "从字符串加载成就模板对象。"
-            d: Dict[str, Any] = json.loads(string)
+            d: Dict[str, Any] = decode_record(string)
             if d["type"] != AchievementTemplate.chunk_type_name:
                 raise ValueError(
                     f"类型不匹配：{d['type']} != {AchievementTemplate.chunk_type_name}"
@@ -2141,6 +2803,17 @@ class ClassDataObj(Base):
         dummy: "Achievement" = None
         "空的成就实例"
 
+        __slots__ = (
+            "_time",
+            "time_key",
+            "temp",
+            "target",
+            "sound",
+            "archive_uuid",
+            "_uuid",
+            "__weakref__",
+        )
+
         @staticmethod
         def new_dummy():
             "创建一个空的成就实例"
@@ -2176,6 +2849,15 @@ class ClassDataObj(Base):
             self.sound = self.temp.sound
             self.archive_uuid = ClassDataObj.archive_uuid
 
+        @property
+        def time(self) -> str:
+            "达成时间"
+            return unpack_time(self._time)
+
+        @time.setter
+        def time(self, value: str):
+            self._time = pack_time(value)
+
         def give(self):
             "发放成就"
             Base.log(
@@ -2184,6 +2866,7 @@ class ClassDataObj(Base):
                 f"time={repr(self.time)}, key={self.time_key}",
             )
             self.target.achievements[self.time_key] = self
+            ClassDataObj.mark_dirty(self, self.target)
 
         def delete(self):
             "删除成就"
@@ -2194,25 +2877,27 @@ class ClassDataObj(Base):
             )
             del self
 
-        def to_string(self):
+        def to_dict(self) -> Dict[str, Any]:
+            "将成就转换为字典。"
+            return {
+                "type": self.chunk_type_name,
+                "time": self.time,
+                "time_key": self.time_key,
+                "template": self.temp.uuid,
+                "target": self.target.uuid,
+                "sound": self.sound,
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
+        def to_string(self) -> str:
             "将成就对象转换为字符串。"
-            return json.dumps(
-                {
-                    "type": self.chunk_type_name,
-                    "time": self.time,
-                    "time_key": self.time_key,
-                    "template": self.temp.uuid,
-                    "target": self.target.uuid,
-                    "sound": self.sound,
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(string: str):
             "从字符串加载成就对象。"
-            d: Dict[str, Any] = json.loads(string)
+            d: Dict[str, Any] = decode_record(string)
             if d["type"] != Achievement.chunk_type_name:
                 raise ValueError(
                     f"类型不匹配：{d['type']} != {Achievement.chunk_type_name}"
@@ -2225,13 +2910,13 @@ class ClassDataObj(Base):
             )
             obj.sound = d["sound"]
             obj.uuid = d["uuid"]
-            obj.archive_uuid = d["archive_uuid"]
+            obj.archive_uuid = intern_uuid(d["archive_uuid"])
             return obj
 
         def inst_from_string(self, string: str):
             "将字符串加载与本身。"
             obj = self.from_string(string)
-            self.__dict__.update(obj.__dict__)
+            self.update_state(obj)
             return self
 
     class AttendanceInfo(Object):
@@ -2246,6 +2931,20 @@ class ClassDataObj(Base):
         dummy: "AttendanceInfo" = None
         "空的考勤信息实例"
 
+        __slots__ = (
+            "target_class",
+            "is_early",
+            "is_late",
+            "is_late_more",
+            "is_absent",
+            "is_leave",
+            "is_leave_early",
+            "is_leave_late",
+            "archive_uuid",
+            "_uuid",
+            "__weakref__",
+        )
+
         @staticmethod
         def new_dummy():
             "返回一个空考勤信息"
@@ -2307,28 +3006,30 @@ class ClassDataObj(Base):
             self.archive_uuid = ClassDataObj.archive_uuid
             "存档UUID"
 
+        def to_dict(self) -> Dict[str, Any]:
+            "将考勤记录转换为字典。"
+            return {
+                "type": self.chunk_type_name,
+                "target_class": self.target_class,
+                "is_early": [s.uuid for s in self.is_early],
+                "is_late": [s.uuid for s in self.is_late],
+                "is_late_more": [s.uuid for s in self.is_late_more],
+                "is_absent": [s.uuid for s in self.is_absent],
+                "is_leave": [s.uuid for s in self.is_leave],
+                "is_leave_early": [s.uuid for s in self.is_leave_early],
+                "is_leave_late": [s.uuid for s in self.is_leave_late],
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
         def to_string(self) -> str:
             "将考勤记录对象转为字符串。"
-            return json.dumps(
-                {
-                    "type": self.chunk_type_name,
-                    "target_class": self.target_class,
-                    "is_early": [s.uuid for s in self.is_early],
-                    "is_late": [s.uuid for s in self.is_late],
-                    "is_late_more": [s.uuid for s in self.is_late_more],
-                    "is_absent": [s.uuid for s in self.is_absent],
-                    "is_leave": [s.uuid for s in self.is_leave],
-                    "is_leave_early": [s.uuid for s in self.is_leave_early],
-                    "is_leave_late": [s.uuid for s in self.is_leave_late],
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(string: str) -> "AttendanceInfo":
             "从字符串加载出勤信息对象。"
-            d = json.loads(string)
+            d = decode_record(string)
             if d["type"] != AttendanceInfo.chunk_type_name:
                 raise ValueError(
                     f"类型不匹配：{d['type']} != {AttendanceInfo.chunk_type_name}"
@@ -2348,7 +3049,7 @@ class ClassDataObj(Base):
                 ],
             )
             obj.uuid = d["uuid"]
-            obj.archive_uuid = d["archive_uuid"]
+            obj.archive_uuid = intern_uuid(d["archive_uuid"])
             return obj
 
         def is_normal(self, target_class: "Class") -> List["Student"]:
@@ -2367,7 +3068,7 @@ class ClassDataObj(Base):
         def inst_from_string(self, string: str):
             "将字符串加载与本身。"
             obj = self.from_string(string)
-            self.__dict__.update(obj.__dict__)
+            self.update_state(obj)
             return self
 
     class DayRecord(Object):
@@ -2407,26 +3108,28 @@ class ClassDataObj(Base):
             self.target_class = target_class
             self.archive_uuid = ClassDataObj.archive_uuid
 
-        def to_string(self):
-            "将每日记录对象转为字符串。"
+        def to_dict(self) -> Dict[str, Any]:
+            "将每日记录转换为字典。"
             if isinstance(self.target_class, dict):
                 self.target_class = self.target_class[self.target_class.keys()[0]]
-            return json.dumps(
-                {
-                    "type": self.chunk_type_name,
-                    "target_class": self.target_class.uuid,
-                    "weekday": self.weekday,
-                    "utc": self.utc,
-                    "attendance_info": self.attendance_info.uuid,
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return {
+                "type": self.chunk_type_name,
+                "target_class": self.target_class.uuid,
+                "weekday": self.weekday,
+                "utc": self.utc,
+                "attendance_info": self.attendance_info.uuid,
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
+        def to_string(self) -> str:
+            "将每日记录对象转为字符串。"
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(string: str) -> "DayRecord":
             "从字符串加载每日记录对象。"
-            d = json.loads(string)
+            d = decode_record(string)
             if d["type"] != DayRecord.chunk_type_name:
                 raise ValueError(
                     f"类型不匹配：{d['type']} != {DayRecord.chunk_type_name}"
@@ -2438,7 +3141,7 @@ class ClassDataObj(Base):
                 attendance_info=ClassDataObj.LoadUUID(d["attendance_info"], AttendanceInfo),
             )
             obj.uuid = d["uuid"]
-            obj.archive_uuid = d["archive_uuid"]
+            obj.archive_uuid = intern_uuid(d["archive_uuid"])
             return obj
 
         def inst_from_string(self, string: str):
@@ -2475,27 +3178,29 @@ class ClassDataObj(Base):
         def __repr__(self):
             return f"<History object at time {self.time:.3f}>"
 
-        def to_string(self):
-            "将历史记录转换为字符串。"
+        def to_dict(self) -> Dict[str, Any]:
+            "将历史记录转换为字典。"
             for _class, item in self.weekdays.items():
                 if isinstance(item, list):
                     self.weekdays[_class] = {d.utc: d for d in item}
 
-            return json.dumps(
-                {
-                    "classes": {k: v.uuid for k, v in self.classes.items()},
-                    "time": self.time,
-                    "weekdays": [[(_class, time_key, day.uuid) for time_key, day in item.items()] \
-                                    for _class, item in self.weekdays.items()],
-                    "uuid": self.uuid,
-                    "archive_uuid": self.archive_uuid,
-                }
-            )
+            return {
+                "classes": {k: v.uuid for k, v in self.classes.items()},
+                "time": self.time,
+                "weekdays": [[(_class, time_key, day.uuid) for time_key, day in item.items()] \
+                                for _class, item in self.weekdays.items()],
+                "uuid": self.uuid,
+                "archive_uuid": self.archive_uuid,
+            }
+
+        def to_string(self) -> str:
+            "将历史记录转换为字符串。"
+            return json.dumps(self.to_dict())
 
         @staticmethod
         def from_string(s: str) -> "History":
             "从字符串加载历史记录。"
-            d = json.loads(s)
+            d = decode_record(s)
             if d["type"] != History.chunk_type_name:
                 raise ValueError(
                     f"类型不匹配：{d['type']} != {History.chunk_type_name}"
@@ -2512,7 +3217,7 @@ class ClassDataObj(Base):
                     obj.weekdays[_class] = {}
                 obj.weekdays[_class][time_key] = ClassDataObj.LoadUUID(day_uuid, DayRecord)
             obj.uuid = d["uuid"]
-            obj.archive_uuid = d["archive_uuid"]
+            obj.archive_uuid = intern_uuid(d["archive_uuid"])
             assert obj.uuid == obj.archive_uuid, (
                 "对于一个历史记录, 它的对象uuid和归档uuid必须保持一致"
                 f"（当前一个是{obj.uuid}, 另一个是{obj.archive_uuid}）"
@@ -2579,6 +3284,8 @@ class ClassStatusObserver(Object):
     "上次更新时间"
     tps: int
     "最大每秒更新次数"
+    version: int
+    "数据版本号，学生、分数或者小组变了就会加一"
     rank_non_dumplicate: List[Tuple[int, "Student"]]
     "去重排名"
     rank_dumplicate: List[Tuple[int, "Student"]]
@@ -2638,6 +3345,8 @@ Day = ClassDataObj.DayRecord
 
 
 ClassData = ClassDataObj.ClassData
+StudentSnapshot = ClassDataObj.StudentSnapshot
+ScoreTimeline = ClassDataObj.ScoreTimeline
 History = ClassDataObj.History
 
 
@@ -2654,3 +3363,127 @@ Achievement.dummy = default_achievement = Achievement.new_dummy()
 AchievementTemplate.dummy = default_achievement_template = (
     AchievementTemplate.new_dummy()
 )
+
+
+if __name__ == "__main__":
+    # 分数修改记录的内存占用，以及结算的时候写时复制和原来深拷贝的对比：
+    # python -m utils.classdatatypes [学生数] [每人每周点评数] [周数]
+    import gc
+    import sys
+    import tracemalloc
+    from utils.basetypes import SysMemTracer
+
+    student_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    modify_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    weeks = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    # 分数修改记录加__slots__前后每条占的内存（用SysMemTracer看进程内存涨了多少）
+    class _DictModification(ScoreModification):
+        "加__slots__之前的分数修改记录：同一个类加上__dict__，标题、描述、分数和字符串格式的时间存在__dict__里"
+
+        # 子类不写__slots__就会有__dict__，把这几个property盖掉，赋值的时候就会像以前一样存进__dict__
+        title = desc = mod = execute_time = create_time = None
+
+        def __init__(self, template: ScoreModificationTemplate, target: Student, key: int):
+            super().__init__(template, target, execute_time=Base.gettime())
+            del self._values
+            self.title = template.title
+            self.desc = template.desc
+            self.mod = template.mod
+            self.executed = True
+            self.execute_time_key = key
+            self.ensure_uuid()
+
+    def _slotted_modification(
+        template: ScoreModificationTemplate, target: Student, key: int
+    ) -> ScoreModification:
+        m = ScoreModification(template, target, execute_time=Base.gettime())
+        m.executed = True
+        m.execute_time_key = key
+        m.ensure_uuid()
+        return m
+
+    count = student_count * modify_count * (weeks + 1)
+    templates = [
+        ScoreModificationTemplate(f"t{i}", (i % 5) - 2.0, f"模板{i}", "")
+        for i in range(20)
+    ]
+    target = Student("学生", 1, 0.0, "CLASS_BENCH")
+    kept = []
+    # 要在别的测试之前跑，两组对象都留到最后，不然会用上之前释放掉的内存，算出来偏小
+    with SysMemTracer(0.01) as tracer:
+        for name, factory in (
+            ("__slots__", _slotted_modification),
+            ("__dict__", _DictModification),
+        ):
+            gc.collect()
+            time.sleep(0.05)
+            before = tracer.current_usage
+            kept.append(
+                [factory(templates[i % len(templates)], target, i) for i in range(count)]
+            )
+            time.sleep(0.05)
+            used = tracer.current_usage - before
+            print(f"{name:10} {count}条分数修改记录  每条{used / count:8.1f}字节")
+    print("（__dict__那一行是上限：子类还带着父类的slot，用不到的也占地方）")
+    del kept
+
+    def _build() -> Dict[str, Class]:
+        templates = [
+            ScoreModificationTemplate(f"t{i}", (i % 5) - 2.0, f"模板{i}", "")
+            for i in range(20)
+        ]
+        students = {
+            n: Student(f"学生{n}", n, 0.0, "CLASS_BENCH")
+            for n in range(1, student_count + 1)
+        }
+        _class = Class("测试班级", "老师", students, "CLASS_BENCH", {})
+        key = 0
+        for _ in range(weeks):
+            for s in students.values():
+                for i in range(modify_count):
+                    m = ScoreModification(templates[i % len(templates)], s)
+                    m.executed = True
+                    key += 1
+                    m.execute_time_key = key
+                    s.history[key] = m
+            _class.reset()
+        for s in students.values():
+            for i in range(modify_count):
+                m = ScoreModification(templates[i % len(templates)], s)
+                m.executed = True
+                key += 1
+                m.execute_time_key = key
+                s.history[key] = m
+        return {"CLASS_BENCH": _class}
+
+    def _deepcopy_reset(classes: Dict[str, Class]) -> History:
+        # 原来的做法：整个班级深拷贝给历史记录，班级自己再拷一次，每个学生再拷一次
+        history = History(copy.deepcopy(classes), {})
+        for _class in classes.values():
+            copy.deepcopy(_class)
+            for s in _class.students.values():
+                s.last_reset_info = copy.deepcopy(s)
+                s.reset_score()
+                s.reset_achievements()
+                s.refresh_uuid()
+            _class.refresh_uuid()
+        return history
+
+    def _snapshot_reset(classes: Dict[str, Class]) -> History:
+        return History({k: c.reset() for k, c in classes.items()}, {})
+
+    print(
+        f"{student_count}个学生，每周每人{modify_count}条点评，"
+        f"已经结算过{weeks}周（重置信息的链也有这么长）"
+    )
+    for name, reset in (("深拷贝", _deepcopy_reset), ("写时复制", _snapshot_reset)):
+        data = _build()
+        tracemalloc.start()
+        t = time.perf_counter()
+        reset(data)
+        spent = time.perf_counter() - t
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:8} 耗时{spent * 1000:9.2f}ms  峰值内存{peak / 1024 / 1024:8.2f}MB")
+
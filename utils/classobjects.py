@@ -12,8 +12,10 @@ import signal
 import base64
 import random
 import warnings
+import threading
 import traceback
 from queue import Queue
+from concurrent.futures import Future
 from abc import abstractmethod
 from types import TracebackType, FrameType
 from typing import *  # pylint: disable=wildcard-import, unused-wildcard-import
@@ -50,8 +52,11 @@ from utils.classdatatypes import (
     History,
     ClassDataObj as OrigClassObj,
     HomeworkRule,
+    ClassObjectEvents,
+    StudentSnapshot,
     dummy_student,
 )
+from utils.events.event import EventSignal
 from utils.algorithm.datatypes import Stack, Thread, Mutex
 from utils.algorithm.keyorder import OrderedKeyList
 from utils.algorithm.numeric import inf
@@ -61,6 +66,10 @@ from utils.dataloader import (
     Chunk,
     UserDataBase,
     DataObject,
+    ArchiveStorage,
+    SingleFileStorage,
+    ScoreAggregate,
+    ScoreGroupBy,
 )  # pylint: disable=unused-import
 from utils.functions.prompts import question_yes_no
 from utils.consts import default_user
@@ -276,7 +285,9 @@ class ClassObj(OrigClassObj):
             Base.log("I", "从" + path + "加载数据...", "MainThread.save_data")
         if method == "auto":
             dirpath = os.path.dirname(path)
-            if os.path.exists(os.path.join(dirpath, "info.json")):
+            if path.endswith(SingleFileStorage.suffix):
+                method = "sqlite"
+            elif os.path.exists(os.path.join(dirpath, "info.json")):
                 path = dirpath
                 method = "sqlite"
             else:
@@ -480,6 +491,10 @@ class ClassObj(OrigClassObj):
                         self.classes[c].students[s].belongs_to_group = default_students[
                             s
                         ].belongs_to_group  # 恢复所属小组
+                        EventSignal.emit(
+                            ClassObjectEvents.StudentModified,
+                            default_arguments=((self.classes[c].students[s],), {}),
+                        )
 
         for _class in self.classes.values():
             for g in copy.deepcopy(_class.groups).keys():  # 重置小组信息
@@ -729,11 +744,13 @@ class ClassObj(OrigClassObj):
         *,
         path: str = os.path.abspath(f"chunks/{default_user}/"),
         mode: Literal["pickle", "sqlite"] = "sqlite",
+        clear_histories: bool = False,
     ):
         """
         强制以指定数据保存存档。
 
         :param path: 文件路径
+        :param clear_histories: 是否把原来的存档整个换掉（写完之后才换，中途出错原来的存档不受影响）
         """
         with ClassObj._saving_task_mutex:
             Base.log("I", "保存数据到" + path + "...", "MainThread.save_data_strict")
@@ -775,7 +792,7 @@ class ClassObj(OrigClassObj):
                     path = os.path.dirname(path) if path.endswith(".datas") else path
                     chunk = Chunk(path, database)
                     t = time.time()
-                    chunk.save_data()
+                    chunk.save_data(clear_histories=clear_histories)
                     Base.log(
                         "I",
                         f"写入文件完成 ({time.time()-t:.3f}s)",
@@ -828,13 +845,67 @@ class ClassObj(OrigClassObj):
                 Base.log_exc("保存存档" + path + "失败：", "Mainhread.save_data_strict")
                 raise
 
+    def snapshot_database(self) -> UserDataBase:
+        """
+        拍一个当前数据的快照，后台保存用。
+
+        班级、小组和学生复制一层，记录字典也复制一层，里面的分数修改记录和成就是直接引用的，
+        快照拍完之后再改分、加学生都不会影响到快照。
+
+        :return: 快照
+        """
+        return UserDataBase(
+            self.current_user,
+            time.time(),
+            CORE_VERSION,
+            CORE_VERSION_CODE,
+            self.last_reset,
+            dict(self.history_data),
+            {k: c.snapshot(detach_records=True) for k, c in self.classes.items()},
+            dict(self.modify_templates),
+            dict(self.achievement_templates),
+            self.last_start_time,
+            {k: copy.copy(v) for k, v in self.weekday_record.items()},
+            dict(self.current_day_attendance),
+        )
+
+    def save_data_async(self, path: str = None) -> "Future[UserDataBase]":
+        """
+        在后台保存当前存档。
+
+        快照在调用的线程上拍，编码和写入交给``Chunk.save_pipeline``，
+        还没开始写的保存会合并到一起，进度在``Chunk.loading_info``里面。
+
+        :param path: 存档路径
+        :return: 保存完成的Future
+        """
+        if path is None:
+            path = self.save_path
+        path = os.path.dirname(path) if path.endswith(".datas") else path
+        if not os.path.isdir(os.path.dirname(path)):
+            Base.log("I", "路径不存在，尝试创建...", "ClassObj.save_data_async")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        t = time.time()
+        database = self.snapshot_database()
+        future = Chunk.save_pipeline.submit(
+            path, database, OrigClassObj.pop_dirty_objects()
+        )
+        Base.log(
+            "I",
+            f"提交保存到{path}，拍快照耗时{time.time() - t:.3f}秒",
+            "ClassObj.save_data_async",
+        )
+        return future
+
     def save_data(self, path: str = None, mode: Literal["pickle", "sqlite"] = "sqlite"):
-        """保存当前存档。
+        """保存当前存档，会等到写完。
 
         :param path: 文件路径
         """
         if path is None:
             path = self.save_path
+        if mode == "sqlite":
+            return self.save_data_async(path).result()
         return self.save_data_strict(
             default_user,
             time.time(),
@@ -881,10 +952,6 @@ class ClassObj(OrigClassObj):
         :param path: 存档路径
         """
         Base.log("E", "重置数据到" + path + "...", "MainThread.reset_data")
-        import shutil
-
-        shutil.rmtree(os.path.join(path, "Histories"), ignore_errors=True)
-
         ClassObj.save_data_strict(
             default_user,
             time.time(),
@@ -900,6 +967,7 @@ class ClassObj(OrigClassObj):
             {DEFAULT_CLASS_KEY: AttendanceInfo(DEFAULT_CLASS_KEY)}.copy(),
             path=path,
             mode=mode,
+            clear_histories=True,
         )
 
     def stop(self):
@@ -909,6 +977,7 @@ class ClassObj(OrigClassObj):
         self.achievement_obs.stop()
         Base.log("I", "保存最后的数据....", "MainThread.stop")
         self.save_data()
+        Chunk.save_pipeline.wait()
 
     class ObserverError(RuntimeError):
         "侦测器出现错误"
@@ -1261,6 +1330,11 @@ class ClassObj(OrigClassObj):
             self.classes[to_class].students[num] = Student(
                 name, num, init_score, to_class, {}
             )
+            self.classes[to_class].index_student(self.classes[to_class].students[num])
+            EventSignal.emit(
+                ClassObjectEvents.NewStudentCreated,
+                default_arguments=((self.classes[to_class].students[num],), {}),
+            )
             Base.log("I", f"学生{name}新建完毕!", "MainThread.add_student")
             return True
         except Exception as e:  # pylint: disable=broad-exception-caught
@@ -1298,6 +1372,10 @@ class ClassObj(OrigClassObj):
         try:
             orig = self.classes[from_class].students[stuobj.num]
             del self.classes[from_class].students[stuobj.num]
+            self.classes[from_class].unindex_student(orig)
+            EventSignal.emit(
+                ClassObjectEvents.StudentRemoved, default_arguments=((orig,), {})
+            )
             Base.log("I", f"学生{stuobj.name}删除完毕!", "MainThread.del_student")
             return orig
         except KeyError as e:  # pylint: disable=broad-exception-caught
@@ -1730,17 +1808,14 @@ class ClassObj(OrigClassObj):
 
     def reset_scores(self) -> Dict[str, Class]:
         "结算所有数据"
-        history = History(
-            copy.deepcopy(self.classes), 
-            self.weekday_record, 
-            time.time()
-        )
+        save_time = time.time()
         Base.log("W", "正在重置所有班级...", "ClassObjects.reset")
 
-        for _class in self.classes.values():
-            _class.reset()
+        # 重置的时候顺便拍了快照，旧的分数修改记录和成就直接挪到快照里面，不用整个深拷贝
+        snapshots = {key: _class.reset() for key, _class in self.classes.items()}
+        history = History(snapshots, self.weekday_record, save_time)
 
-        Base.log("I", "重置完成", "ClassObjects.reset")
+        Base.log("I", f"重置完成，耗时{time.time() - save_time:.3f}秒", "ClassObjects.reset")
         self.insert_action_history_info(
             "分数结算", self.show_all_history, (216, 112, 112, 255, 202, 202), 40
         )
@@ -1752,6 +1827,53 @@ class ClassObj(OrigClassObj):
         ClassObj.archive_uuid = gen_uuid()
         return self.classes
 
+    def score_statistics(
+        self,
+        group_by: ScoreGroupBy = "template",
+        histories: Optional[Iterable[Union[History, str]]] = None,
+        class_key: Optional[str] = None,
+        student: Optional[Student] = None,
+        template: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        executed_only: bool = True,
+    ) -> Dict[Any, ScoreAggregate]:
+        """
+        统计分数修改记录，比如"这学期每个模板一共扣了多少分"。
+
+        直接在存档的分数列存储上算，不会加载任何分数修改记录，
+        所以统计的是最近一次保存的时候的数据。
+
+        :param group_by: 按什么分组（模板key/学生uuid/班级key/历史记录uuid/日期/周）
+        :param histories: 只统计这些历史记录（``History``或者uuid，当前周是``"Current"``），None就是全部
+        :param class_key: 只统计这个班级
+        :param student: 只统计这个学生
+        :param template: 只统计这个模板（key）
+        :param since: 执行时间下限（时间戳）
+        :param until: 执行时间上限（时间戳）
+        :param executed_only: 是否只统计已经执行的
+        :return: 分组的值到统计结果（数量，总分，加分，扣分）的映射
+        """
+        path = (
+            os.path.dirname(self.save_path)
+            if self.save_path.endswith(".datas")
+            else self.save_path
+        )
+        return ArchiveStorage.open(path).aggregate_scores(
+            group_by,
+            (
+                None
+                if histories is None
+                else [h.uuid if isinstance(h, History) else h for h in histories]
+            ),
+            class_key=class_key,
+            student=None if student is None else student.uuid,
+            template=template,
+            since=since,
+            until=until,
+            executed_only=executed_only,
+        )
+
     def random_choose_stu(
         self,
         count: int = 1,
@@ -1881,7 +2003,8 @@ class ClassObj(OrigClassObj):
                 Base.log("I", f"自动保存到{self.save_path}", "ClassObj.auto_save")
 
                 try:
-                    self.save_data(self.save_path)
+                    # 这个线程自己等就行，快照拍完界面就可以接着改了
+                    self.save_data_async(self.save_path).result()
                     Base.log("I", "自动保存完成", "ClassObj.auto_save")
 
                 except (
@@ -2043,6 +2166,22 @@ class ClassStatusObserver(Object):
             "侦测器每帧耗时"
             self.tps: float = 0
             "侦测器每秒帧数"
+            self.version: int = 0
+            "数据版本号，班级里的学生、分数或者小组变了就会加一，拿来和上次的比一下就知道要不要刷新"
+            self.full_check_interval = 5.0
+            "没有事件的时候多久兜底检查一次（秒）"
+            self.coalesce_interval = 0.05
+            "收到事件之后等一小会再处理，把连续的一批修改合并成一次"
+            self.wakeup = threading.Event()
+            "有事件的时候用来唤醒侦测器"
+            self.version_changed = threading.Condition()
+            "版本号变化的条件变量，给wait_for_change用"
+            self.full_check_requested = True
+            "是否需要全量检查（学号同步之类的）"
+            self.last_signature: tuple = ()
+            "上次处理时班级的(学号, 姓名, 分数)和小组的(key, 名字, 成员学号)"
+            self.modified = False
+            "收到了学生信息或者小组修改的事件，下一帧一定要加版本号"
         except (
             KeyError,
             ValueError,
@@ -2052,42 +2191,106 @@ class ClassStatusObserver(Object):
             Base.log_exc("获取班级信息失败", "ClassStatusObserver.__init__")
             raise ClassObj.ObserverError("获取班级信息失败")
 
+    def on_class_changed(self, *args) -> None:
+        "班级里有学生的分数变了"
+        student: Optional[Student] = args[0] if args else None
+        if student is None or getattr(student, "belongs_to", self.class_id) == self.class_id:
+            self.wakeup.set()
+
+    def on_class_modified(self, *args) -> None:
+        "学生信息或者小组变了（改名、进出小组），分数不一定变，但是按钮要刷新"
+        target = args[0] if args else None
+        if target is None or getattr(target, "belongs_to", self.class_id) == self.class_id:
+            self.modified = True
+            self.wakeup.set()
+
+    def make_signature(self) -> tuple:
+        "班级现在的(学号, 姓名, 分数)和小组的(key, 名字, 成员学号)，和上次的不一样就说明要刷新"
+        return (
+            tuple(
+                (s.num, s.name, s.score)
+                for s in list(self.target_class.students.values())
+            ),
+            tuple(
+                (g.key, g.name, tuple(m.num for m in g.members))
+                for g in list(self.target_class.groups.values())
+            ),
+        )
+
+    def request_full_check(self, *_args) -> None:
+        "学生增减之后要全量检查一次"
+        self.full_check_requested = True
+        self.wakeup.set()
+
+    def wait_for_change(self, version: int, timeout: Optional[float] = None) -> int:
+        """
+        等到数据版本号和传进来的不一样为止。
+
+        :param version: 上次拿到的版本号
+        :param timeout: 最多等多久（秒），None就是一直等
+        :return: 当前的版本号
+        """
+        with self.version_changed:
+            self.version_changed.wait_for(
+                lambda: self.version != version or not self.on_active, timeout
+            )
+            return self.version
+
+    def sync_student_nums(self) -> None:
+        "学生的学号和字典的key不一样时以key为准"
+        for k, s in list(self.target_class.students.items()):
+            if s.num != k:
+                orig = s.num
+                s.num = k
+                Base.log(
+                    "I",
+                    f"学生 {s.name} 的学号已"
+                    f"从 {orig} 变为 {s.num}（二者不同步）",
+                    "ClassStatusObserver._start",
+                )
+
     def run(self):
         "内部用来启动侦测器的函数"
         self.on_active = True
         last_frame_time = time.time()
+        last_full_check = 0.0
         while self.on_active:
-            last_opreate_time = time.time()
+            # 没事件就一直睡着，最多睡到下一次兜底检查
+            self.wakeup.wait(
+                max(self.full_check_interval - (time.time() - last_full_check), 0)
+            )
+            if not self.on_active:
+                break
+            self.wakeup.clear()
+            if self.coalesce_interval > 0:
+                time.sleep(self.coalesce_interval)
             if self.limited_tps:
                 time.sleep(
                     max((1 / self.limited_tps) - (time.time() - last_frame_time), 0)
                 )
+            last_opreate_time = last_frame_time
             last_frame_time = time.time()
-            if time.time() - self.last_update > 1:
-                self.last_update = time.time()
-            for k, s in self.target_class.students.items():
-                if s.num != k:
-                    orig = s.num
-                    s.num = k
-                    Base.log(
-                        "I",
-                        f"学生 {s.name} 的学号已"
-                        f"从 {orig} 变为 {s.num}（二者不同步）",
-                        "ClassStatusObserver._start",
-                    )
-            self.stu_score_ord = dict(
-                enumerate(
-                    sorted(
-                        list(self.classes[self.class_id].students.values()),
-                        key=lambda a: a.score,
-                    ),
-                    start=1,
-                )
+            self.last_update = last_frame_time
+            full_check = (
+                self.full_check_requested
+                or last_frame_time - last_full_check >= self.full_check_interval
             )
+            self.full_check_requested = False
+            if full_check:
+                last_full_check = last_frame_time
+                self.sync_student_nums()
+            modified = self.modified
+            self.modified = False
+            signature = self.make_signature()
+            if modified or signature != self.last_signature:
+                self.last_signature = signature
+                self.stu_score_ord = self.target_class.stu_score_ord
+                with self.version_changed:
+                    self.version += 1
+                    self.version_changed.notify_all()
             self.mspt = (time.time() - last_frame_time) * 1000
             self.tps = 1 / max((time.time() - last_opreate_time), 0.001)
 
-
     @property
     def student_total_score(self) -> int:
         """班级总分"""
@@ -2142,11 +2345,27 @@ class ClassStatusObserver(Object):
     def start(self):
         "启动侦测器"
         self.on_active = True
+        self.request_full_check()
+        EventSignal.connect(self.on_class_changed, ClassObjectEvents.StudentScoreChanged)
+        EventSignal.connect(self.on_class_changed, ClassObjectEvents.StudentScoreReset)
+        EventSignal.connect(self.request_full_check, ClassObjectEvents.NewStudentCreated)
+        EventSignal.connect(self.request_full_check, ClassObjectEvents.StudentRemoved)
+        EventSignal.connect(self.on_class_modified, ClassObjectEvents.StudentModified)
+        EventSignal.connect(self.on_class_modified, ClassObjectEvents.StudentAddedToGroup)
+        EventSignal.connect(
+            self.on_class_modified, ClassObjectEvents.StudentRemovedFromGroup
+        )
         Thread(target=self.run, name="ClassStatusObserver", daemon=True).start()
 
     def stop(self):
         "停止侦测器"
         self.on_active = False
+        EventSignal.disconnect(self.on_class_changed, on_error="ignore")
+        EventSignal.disconnect(self.request_full_check, on_error="ignore")
+        EventSignal.disconnect(self.on_class_modified, on_error="ignore")
+        self.wakeup.set()
+        with self.version_changed:
+            self.version_changed.notify_all()
 
 
 class AchievementStatusObserver(Object):
@@ -2216,6 +2435,86 @@ class AchievementStatusObserver(Object):
         "上一帧时间"
         self.overload_count = 0
         "过载帧数"
+        self.full_check_interval = 30.0
+        "兜底的全量检查间隔（秒），防止有没发事件的修改漏掉了"
+        self.coalesce_interval = 0.05
+        "收到事件之后等一小会再检查，把连续的一批修改合并成一帧"
+        self.last_full_check = 0.0
+        "上次全量检查的时间"
+        self.wakeup = threading.Event()
+        "有事件的时候用来唤醒侦测器"
+        self.pending_lock = threading.Lock()
+        "待检查学生的锁"
+        self.pending_students: Dict[int, Student] = {}
+        "等待检查的学生，pending_students[id(学生)] = 学生"
+        self.full_check_requested = True
+        "是否需要全量检查（刚启动、加了学生之类的）"
+        self.last_ranks: Dict[int, int] = {}
+        "上一帧的排名，last_ranks[id(学生)] = 排名"
+
+    score_event_fields = {"score", "highest_score", "lowest_score", "history", "other"}
+    "分数变化之后需要重新检查的条件"
+
+    rank_event_fields = {"rank", "other"}
+    "排名变化之后需要重新检查的条件"
+
+    def on_student_changed(self, student: Student) -> None:
+        "学生分数变了，记下来等侦测器检查"
+        with self.pending_lock:
+            self.pending_students[id(student)] = student
+        self.wakeup.set()
+
+    def request_full_check(self, *_args) -> None:
+        "要求侦测器下一帧检查所有学生的所有成就"
+        self.full_check_requested = True
+        self.wakeup.set()
+
+    def check_student(
+        self,
+        s: Student,
+        template_keys: Iterable[str],
+        recheck_achievement: bool = True,
+        recheck_interval: float = 0.1,
+        ranks: Optional[Tuple[Dict[int, int], int]] = None,
+    ) -> bool:
+        """
+        检查一个学生的一部分成就。
+
+        :param s: 学生
+        :param template_keys: 要检查的成就模板key
+        :param recheck_achievement: 是否需要重新检查成就
+        :param recheck_interval: 重新检查成就的间隔
+        :param ranks: 这一帧的排名表（StudentSnapshot.rank_table的返回值）
+        :return: 是否发放了成就
+        """
+        opreated = False
+        achieved = None
+        snapshot = StudentSnapshot(
+            s,
+            ranks[0].get(s.num) if ranks is not None else None,
+            ranks[1] if ranks is not None else None,
+            self.class_obs,
+        )
+        for a in template_keys:
+            template = self.achievement_templates.get(a)
+            if template is None or not template.achieved_by(
+                s, self.class_obs, snapshot
+            ):
+                continue
+            if achieved is None:
+                # 判断成就是否已经达成过
+                achieved = {a.temp.key for a in s.achievements.values()}
+            if template.key in achieved:
+                continue
+            opreated = True
+            if recheck_achievement and recheck_interval > 0:
+                time.sleep(recheck_interval)  # 等待操作完成，避免竞态条件
+            if template.achieved_by(s, self.class_obs) or not recheck_achievement:
+                Base.log("I", f"[{s.name}] 达成了成就 [{template.name}]")
+                Achievement(template, s).give()
+                achieved.add(template.key)
+                self.display_achievement_queue.put({"achievement": a, "student": s})
+        return opreated
 
     def next_frame(self, 
                     recheck_achievement: bool = True,
@@ -2224,61 +2523,82 @@ class AchievementStatusObserver(Object):
                     ):
 
         """
-        下一帧
-        
+        下一帧，没有事件的时候会一直等着（最多等到下一次兜底的全量检查）
+
         :param recheck_achievement: 是否需要重新检查成就
         :param recheck_interval: 重新检查成就的间隔
         :param handle_overloading: 是否需要处理过载
         """
+        self.wakeup.wait(
+            max(self.full_check_interval - (time.time() - self.last_full_check), 0)
+        )
+        if not self.on_active:
+            return
+        self.wakeup.clear()
+        if self.coalesce_interval > 0:
+            time.sleep(self.coalesce_interval)
         self.total_frame_count += 1
         last_opreate_time = time.time()
+        self.last_update = last_opreate_time
+        with self.pending_lock:
+            pending = self.pending_students
+            self.pending_students = {}
+        full_check = (
+            self.full_check_requested
+            or time.time() - self.last_full_check >= self.full_check_interval
+        )
+        self.full_check_requested = False
+        students = self.classes[self.class_id].students
+        fields = {
+            k: t.condition_fields for k, t in list(self.achievement_templates.items())
+        }
+        opreated = False
+        # 排名一帧只排一次
+        rank_table = StudentSnapshot.rank_table(self.class_obs.rank_dumplicate)
+
+        if full_check:
+            self.last_full_check = time.time()
+            for s in list(students.values()):
+                opreated |= self.check_student(
+                    s, fields.keys(), recheck_achievement, recheck_interval, rank_table
+                )
+        else:
+            score_templates = [k for k, f in fields.items() if f & self.score_event_fields]
+            for s in pending.values():
+                if students.get(s.num) is not s:
+                    continue  # 不是这个班的或者已经删掉了
+                opreated |= self.check_student(
+                    s, score_templates, recheck_achievement, recheck_interval, rank_table
+                )
 
-        if time.time() - self.last_update > 1:
-            self.last_update = time.time()
-        if self.limited_tps:
-            time.sleep(
-                max((1 / self.limited_tps) - (time.time() - self.last_frame_time), 0)
+        # 排名变了的学生还要再看看和排名有关的成就
+        # 排名表是在上面排的，这中间新加进来的学生还没有名次，下一帧再看
+        ranks = {
+            id(s): rank_table[0][s.num]
+            for s in list(students.values())
+            if s.num in rank_table[0]
+        }
+        if not full_check and ranks != self.last_ranks:
+            rank_templates = [k for k, f in fields.items() if f & self.rank_event_fields]
+            lowest_changed = max(ranks.values(), default=0) != max(
+                self.last_ranks.values(), default=0
             )
-        self.last_frame_time = time.time()
-        opreated = False
-        # 性能优化点：O(n²)复杂度(?)
-        for s in list(self.classes[self.class_id].students.values()):
-
-            for a in list(self.achievement_templates.keys()):
-
-                if self.achievement_templates[a].achieved_by(
-                    s, self.class_obs
-                ) and (
-                    self.achievement_templates[a].key
-                    not in [  # 判断成就是否已经达成过
-                        a.temp.key
-                        for a in self.classes[self.class_id]
-                        .students[s.num]
-                        .achievements.values()
-                    ]
-                ):
-                    opreated = True
-                    if recheck_achievement and recheck_interval > 0:
-                        time.sleep(recheck_interval)  # 等待操作完成，避免竞态条件
-                    if self.achievement_templates[a].achieved_by(
-                        s, self.class_obs
-                    ) or not recheck_achievement:
-                        Base.log(
-                            "I",
-                            f"[{s.name}] 达成了成就 [{self.achievement_templates[a].name}]",
-                        )
-                        a2 = Achievement(
-                            self.achievement_templates[a], s
-                        )
-                        a2.give()
-                        self.display_achievement_queue.put(
-                            {"achievement": a, "student": s}
-                        )
+            for s in list(students.values()):
+                # 倒数的名次是按最后一名算的，最后一名变了就得全部重新看
+                if lowest_changed or ranks.get(id(s)) != self.last_ranks.get(id(s)):
+                    opreated |= self.check_student(
+                        s,
+                        rank_templates,
+                        recheck_achievement,
+                        recheck_interval,
+                        rank_table,
+                    )
+        self.last_ranks = ranks
 
         cur_time = time.time()
-        self.mspt = (cur_time - self.last_frame_time) * 1000
+        self.mspt = (cur_time - last_opreate_time) * 1000
         overload_before = self.overloaded
-        if not opreated:  # 只在空扫描的时候才检测是否过载
+        if not opreated:  # 只在没有发成就的时候才检测是否过载
             if self.mspt > 1000 / self.limited_tps * self.overload_ratio:
                 self.overloaded = True
                 self.overload_count += 1
@@ -2291,15 +2611,12 @@ class AchievementStatusObserver(Object):
                 and (cur_time - self.start_time) > 1
                 and not overload_before
             ):
-                # 刚才才开始过载并且已经开了有一段时间了
                 if handle_overloading:
                     self.on_observer_overloaded(
                         self.last_frame_time, last_opreate_time, self.mspt
                     )
-            time.sleep((self.mspt * (1 / self.overload_ratio)) / 1000)
-        self.tps = 1 / max((time.time() - last_opreate_time), 0.001)
-
-    
+        self.tps = 1 / max((cur_time - self.last_frame_time), 0.001)
+        self.last_frame_time = cur_time
 
     def on_observer_overloaded(
         self,
@@ -2347,9 +2664,17 @@ class AchievementStatusObserver(Object):
     def start(self):
         "启动侦测器"
         self.on_active = True
+        self.request_full_check()
+        EventSignal.connect(self.on_student_changed, ClassObjectEvents.StudentScoreChanged)
+        EventSignal.connect(self.on_student_changed, ClassObjectEvents.StudentScoreReset)
+        EventSignal.connect(self.request_full_check, ClassObjectEvents.NewStudentCreated)
         Thread(target=self.run, name="AchievementStatusObserver", daemon=True).start()
 
 
     def stop(self):
         "停止侦测器"
         self.on_active = False
+        EventSignal.disconnect(self.on_student_changed, on_error="ignore")
+        EventSignal.disconnect(self.request_full_check, on_error="ignore")
+        EventSignal.disconnect(self.on_class_modified, on_error="ignore")
+        self.wakeup.set()
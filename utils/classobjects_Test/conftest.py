@@ -0,0 +1,80 @@
+"""
+测试用的公共设置
+
+在仓库根目录运行：``python -m pytest -q utils/classobjects_Test``
+"""
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def release_connections():
+    "每个测试结束之后关掉所有数据库连接、清掉对象缓存，免得影响下一个测试"
+    yield
+    # pylint: disable=import-outside-toplevel
+    from utils.dataloader import Chunk, ObjectCache
+
+    Chunk.relase_connections()
+    ObjectCache.clear_all()
+
+
+def build_database(modifications: int = 1):
+    """
+    用默认数据建一个用户数据库，每个学生先加几条分数修改记录。
+
+    :param modifications: 每个学生的分数修改记录数
+    """
+    # pylint: disable=import-outside-toplevel
+    import copy
+    import time
+
+    from utils.classdatatypes import AttendanceInfo, ScoreModification
+    from utils.classobjects import (
+        DEFAULT_ACHIEVEMENTS,
+        DEFAULT_CLASS_KEY,
+        DEFAULT_CLASSES,
+        DEFAULT_SCORE_TEMPLATES,
+        UserDataBase,
+    )
+
+    classes = copy.deepcopy(DEFAULT_CLASSES)
+    templates = copy.deepcopy(DEFAULT_SCORE_TEMPLATES)
+    achievements = copy.deepcopy(DEFAULT_ACHIEVEMENTS)
+    template_list = list(templates.values())
+    i = 0
+    for _ in range(modifications):
+        for student in classes[DEFAULT_CLASS_KEY].students.values():
+            ScoreModification(template_list[i % len(template_list)], student).execute()
+            i += 1
+            time.sleep(0.0011)  # 执行时间是排序用的键，别撞上
+    return UserDataBase(
+        "test",
+        time.time(),
+        "test",
+        1,
+        time.time(),
+        {},
+        classes,
+        templates,
+        achievements,
+        time.time(),
+        {DEFAULT_CLASS_KEY: {}},
+        {DEFAULT_CLASS_KEY: AttendanceInfo(DEFAULT_CLASS_KEY)},
+    )
+
+
+def student_summary(db) -> list:
+    "班级里面每个学生的(学号, 分数, 记录数)，用来比较两个数据库是不是一样"
+    # pylint: disable=import-outside-toplevel
+    from utils.classobjects import DEFAULT_CLASS_KEY
+
+    return sorted(
+        (s.num, round(s.score, 2), len(s.history))
+        for s in db.classes[DEFAULT_CLASS_KEY].students.values()
+    )
+
+
+@pytest.fixture
+def sample_db():
+    "用默认数据建的用户数据库"
+    return build_database()
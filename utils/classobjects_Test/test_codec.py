@@ -0,0 +1,175 @@
+"""
+存档编码的测试
+"""
+
+import json
+
+import pytest
+
+from utils.classobjects import DEFAULT_CLASS_KEY
+from utils.codec import CodecError, decode_record, get_codec, pack_time, unpack_time
+
+UUID = "0123456789abcdef0123456789abcdef"
+
+
+@pytest.mark.parametrize("name", ["json", "compact"])
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"type": "Empty"},
+        {
+            "type": "Mixed",
+            "none": None,
+            "flags": [True, False],
+            "int": -123456789,
+            "float": 0.1,
+            "float_int": 3.0,
+            "str": "中文和emoji😀",
+            "uuid": UUID,
+            "upper": UUID.upper(),  # 大写的不能当成uuid压缩
+            "time": "2024-01-02 03:04:05.678",
+            "bad_time": "2024-13-02 03:04:05",
+            "pairs": [[1700000000000, UUID], [1700000000001, UUID]],
+            "nested": {"1": [{"a": []}], "": {}},
+        },
+        {
+            "type": "ScoreModification",
+            "template": UUID,
+            "target": UUID,
+            "title": "作业优秀",
+            "mod": 1.5,
+            "desc": "",
+            "executed": True,
+            "create_time": "2024-01-02 03:04:05.678",
+            "execute_time": "2024-01-02 03:04:05.679",
+            "execute_time_key": 1700000000000,
+            "uuid": UUID,
+            "archive_uuid": UUID,
+        },
+        {
+            # 固定布局对不上（多了字段）的时候要退回通用编码
+            "type": "Achievement",
+            "time": None,
+            "time_key": 0,
+            "template": UUID,
+            "target": UUID,
+            "sound": None,
+            "uuid": UUID,
+            "archive_uuid": UUID,
+            "extra": 1,
+        },
+    ],
+)
+def test_round_trip(name, data):
+    codec = get_codec(name)
+    raw = codec.encode(data)
+    assert codec.decode(raw) == data
+    assert decode_record(raw) == data
+
+
+def test_compact_matches_json_for_real_objects(sample_db):
+    codec = get_codec("compact")
+    cls = sample_db.classes[DEFAULT_CLASS_KEY]
+    objects = [cls] + list(cls.students.values())
+    for student in cls.students.values():
+        objects.extend(student.history.values())
+    objects.extend(sample_db.templates.values())
+    objects.extend(sample_db.achievements.values())
+    for obj in objects:
+        expected = json.loads(obj.to_string())
+        assert codec.decode(codec.encode(obj.to_dict())) == expected
+
+
+def test_compact_is_smaller_for_score_modifications(sample_db):
+    cls = sample_db.classes[DEFAULT_CLASS_KEY]
+    modification = next(iter(next(iter(cls.students.values())).history.values()))
+    data = modification.to_dict()
+    compact = get_codec("compact").encode(data)
+    assert compact[2] == 3  # 走的是现在的固定布局
+    assert len(compact) < len(get_codec("json").encode(data).encode("utf-8")) / 2
+
+
+SCORE_MODIFICATION = {
+    "type": "ScoreModification",
+    "template": UUID,
+    "target": UUID,
+    "title": "作业优秀",
+    "mod": 2,
+    "desc": "表现很好",
+    "executed": False,
+    "create_time": "2024-01-02 03:04:05.678",
+    "execute_time": None,
+    "execute_time_key": 1700000000000,
+    "uuid": UUID,
+    "archive_uuid": None,
+}
+
+
+@pytest.mark.parametrize("index", [1, 3])
+def test_score_modification_layouts(index):
+    # 1是时间转成整数的旧布局，存档里面可能还有，要一直能解
+    codec = get_codec("compact")
+    layout = codec.layouts_by_index[index]
+    for data in (
+        SCORE_MODIFICATION,
+        dict(SCORE_MODIFICATION, execute_time=SCORE_MODIFICATION["create_time"], archive_uuid=UUID),
+    ):
+        raw = layout.encode(data)
+        assert raw is not None and raw[2] == index
+        decoded = codec.decode(raw)
+        assert decoded == data and type(decoded["mod"]) is int
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        {"uuid": UUID.upper()},
+        {"uuid": UUID[:-1] + "g"},
+        {"uuid": " " + UUID[1:]},
+        {"create_time": "2024-01-02 03:04:05.6789"},
+        {"create_time": "２０２４-01-02 03:04:05.678"},
+        {"title": 1},
+    ],
+)
+def test_layout_falls_back_to_generic(change):
+    codec = get_codec("compact")
+    data = dict(SCORE_MODIFICATION, **change)
+    raw = codec.encode(data)
+    assert raw[2] == 0
+    assert codec.decode(raw) == data
+
+
+def test_decode_errors():
+    codec = get_codec("compact")
+    with pytest.raises(CodecError):
+        get_codec("msgpack")
+    with pytest.raises(CodecError):
+        codec.decode(b"\x00\x01\x00")
+    raw = bytearray(codec.encode({"type": "Empty"}))
+    raw[1] = codec.version + 1
+    with pytest.raises(CodecError):
+        codec.decode(bytes(raw))
+    raw[1], raw[2] = codec.version, 200
+    with pytest.raises(CodecError):
+        codec.decode(bytes(raw))
+    assert get_codec(None) is get_codec("json")
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "2024-01-02 03:04:05.678",
+        "1999-12-31 23:59:59.999",
+        "２０２４-01-02 03:04:05.678",  # 全角数字不能当成时间
+        "not a time",
+        "",
+        None,
+    ],
+)
+def test_pack_time(value):
+    packed = pack_time(value)
+    if value and value[0].isascii() and value[0].isdigit():
+        assert isinstance(packed, int)
+    else:
+        assert packed == value
+    assert unpack_time(packed) == value
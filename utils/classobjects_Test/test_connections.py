@@ -0,0 +1,113 @@
+"""
+连接管理的测试
+"""
+
+import threading
+
+import pytest
+
+from utils.classdatatypes import Student
+from utils.dataloader import Chunk, DataObject, DirectoryStorage
+
+
+def test_reads_do_not_see_uncommitted_batch(tmp_path):
+    storage = DirectoryStorage(str(tmp_path / "archive"))
+    storage.prepare_history("Current")
+    current = storage.history_path("Current")
+    committed = Student("已提交", 1, 0.0, "TEST", {})
+    DataObject.save_many([committed], current)
+    pending = Student("没提交", 2, 0.0, "TEST", {})
+
+    written = threading.Event()
+    checked = threading.Event()
+    seen_by_writer = []
+
+    def background_save():
+        with pytest.raises(RuntimeError):
+            with Chunk.connections.batch():
+                DataObject.save_many([pending], current)
+                # 自己的事务里面要能读到自己刚写的
+                seen_by_writer.append(
+                    storage.read_row("Current", "Student", pending.uuid)
+                )
+                written.set()
+                checked.wait(10)
+                raise RuntimeError("保存失败")
+
+    thread = threading.Thread(target=background_save)
+    thread.start()
+    assert written.wait(10)
+    try:
+        assert storage.read_row("Current", "Student", pending.uuid) is None
+        assert pending.uuid not in storage.read_rows("Current", "Student")
+        assert storage.read_row("Current", "Student", committed.uuid) is not None
+    finally:
+        checked.set()
+        thread.join(10)
+    assert seen_by_writer[0] is not None
+    assert storage.read_row("Current", "Student", pending.uuid) is None
+
+
+def dump(path: str) -> dict:
+    "数据库里面每张表的所有行（不算撤销日志那两张表）"
+    manager = Chunk.connections
+    with manager.reading(path) as conn:
+        tables = [
+            name
+            for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+            if name not in (manager.undo_table, manager.generation_table)
+        ]
+        return {
+            name: sorted(map(repr, conn.execute(f"SELECT * FROM {name}")))
+            for name in tables
+        }
+
+
+def test_revert_undoes_a_committed_batch(tmp_path):
+    manager = Chunk.connections
+    path = str(tmp_path / "undo.db")
+    with manager.transaction(path, create_schema=False) as conn:
+        conn.execute(
+            "CREATE TABLE items (id integer primary key, key text unique, value real)"
+        )
+        conn.execute(
+            "CREATE TABLE pairs (a text, b blob, primary key (a)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE TABLE legacy (x text)")
+        conn.execute("CREATE INDEX idx_legacy_x ON legacy (x)")
+        conn.executemany(
+            "INSERT INTO items (key, value) VALUES (?, ?)",
+            [("a", 0.1), ("b", None), ("c's", 1e300 / 3)],
+        )
+        conn.executemany("INSERT INTO pairs VALUES (?, ?)", [("k", b"\x00\xff")])
+        conn.execute("INSERT INTO legacy VALUES ('old')")
+    before = dump(path)
+
+    with manager.batch(generation=1):
+        with manager.transaction(path, create_schema=False) as conn:
+            conn.execute("INSERT OR REPLACE INTO items (key, value) VALUES ('a', 2)")
+            conn.execute("UPDATE items SET value = -1, key = 'B' WHERE key = 'b'")
+            conn.execute("DELETE FROM items WHERE key = 'c''s'")
+            conn.execute("INSERT INTO items (key, value) VALUES ('d', 3)")
+            conn.execute("UPDATE pairs SET a = 'j', b = x'01' WHERE a = 'k'")
+            conn.execute("INSERT INTO pairs VALUES ('m', NULL)")
+            conn.execute("CREATE TABLE fresh (y text)")
+            conn.execute("INSERT INTO fresh VALUES ('new')")
+            conn.execute("DELETE FROM legacy")
+            conn.execute("DROP TABLE legacy")
+    assert manager.generation(path) == 1
+    assert dump(path) != before
+
+    assert not manager.revert(path, 2)  # 最后提交的不是这一次
+    assert manager.revert(path, 1)
+    assert dump(path) == before
+    assert manager.generation(path) is None
+    assert not manager.revert(path, 1)  # 撤销过了
+    with manager.reading(path) as conn:
+        assert conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'idx_legacy_x'"
+        ).fetchone()
+    # 合并提交完触发器就拆掉了
+    assert not manager.get(path).execute("SELECT 1 FROM temp.sqlite_master").fetchone()
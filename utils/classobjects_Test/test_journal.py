@@ -0,0 +1,185 @@
+"""
+保存日志和断电恢复的测试
+
+崩溃是真的崩溃：子进程在指定的位置直接``os._exit``，不会走任何清理，
+然后在这边重新打开存档，看恢复之后是保存之前的数据还是保存之后的数据。
+"""
+
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from utils.classdatatypes import ScoreModification
+from utils.classobjects import DEFAULT_CLASS_KEY
+from utils.dataloader import (
+    Chunk,
+    ConnectionManager,
+    DataObject,
+    DirectoryStorage,
+    SingleFileStorage,
+)
+
+from .conftest import student_summary
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHILD = r"""
+import json, os, sys, time
+sys.path.insert(0, os.getcwd())
+import utils.dataloader as dl
+from utils.classdatatypes import ScoreModification
+from utils.classobjects import DEFAULT_CLASS_KEY
+
+path, crash = sys.argv[1:3]
+db = dl.Chunk(path).load_data()
+db.templates = {t.key: t for t in db.templates}
+db.achievements = {a.key: a for a in db.achievements}
+template = list(db.templates.values())[1]
+for s in db.classes[DEFAULT_CLASS_KEY].students.values():
+    ScoreModification(template, s).execute()
+    time.sleep(0.0011)
+
+def crash_on(cls, name, nth=1, when=lambda *a, **k: True):
+    orig = getattr(cls, name)
+    count = [0]
+    def wrapper(*args, **kwargs):
+        if when(*args, **kwargs):
+            count[0] += 1
+            if count[0] == nth:
+                sys.stdout.flush()
+                os._exit(3)
+        return orig(*args, **kwargs)
+    setattr(cls, name, wrapper)
+
+storage = dl.SingleFileStorage if path.endswith(".db") else dl.DirectoryStorage
+manager = dl.ConnectionManager
+if crash == "writing":
+    crash_on(storage, "write_meta", 4)
+elif crash == "before_committing":
+    crash_on(dl, "write_json_atomic", when=lambda p, v: v.get("state") == "committing")
+elif crash == "between_commits":
+    crash_on(manager, "_commit", 2)
+elif crash == "committed":
+    crash_on(storage, "finish_journal", when=lambda self, j, c: j["state"] == "committing")
+elif crash == "staging":
+    crash_on(dl.Chunk, "save_score_columns")
+elif crash == "replacing":
+    def finish_replace(cls, p, staging):
+        cls.move_archive(p, cls.backup_path(p))
+        os._exit(3)
+    storage.finish_replace = classmethod(finish_replace)
+print("EXPECT", json.dumps(sorted(
+    (s.num, round(s.score, 2), len(s.history))
+    for s in db.classes[DEFAULT_CLASS_KEY].students.values()
+)))
+sys.stdout.flush()
+dl.Chunk(path, db).save_data(clear_histories=crash in ("staging", "replacing"))
+print("NO CRASH")
+"""
+
+
+def load_summary(path: str) -> list:
+    DataObject.clear_loaded_objects()
+    return student_summary(Chunk(path).load_data())
+
+
+def crash_save(path: str, crash: str) -> list:
+    "在子进程里面改一下数据再保存，在crash的位置崩溃，返回保存之后应该是什么样"
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, path, crash],
+        cwd=ROOT,
+        env=dict(os.environ, SDL_AUDIODRIVER="dummy", QT_QPA_PLATFORM="offscreen"),
+        capture_output=True,
+        text=True,
+        timeout=300,
+        check=False,
+    )
+    assert result.returncode == 3, (result.stdout[-2000:], result.stderr[-2000:])
+    line = next(l for l in result.stdout.splitlines() if "EXPECT " in l)
+    return [tuple(x) for x in json.loads(line.split("EXPECT ", 1)[1].split("\x1b")[0])]
+
+
+@pytest.mark.parametrize(
+    "suffix, crash, action, keeps_new",
+    [
+        ("", "writing", "rollback", False),
+        ("", "before_committing", "rollback", False),
+        ("", "between_commits", "rollback", False),
+        ("", "committed", "roll_forward", True),
+        ("", "staging", "rollback", False),
+        ("", "replacing", "roll_forward", True),
+        (".db", "writing", "rollback", False),
+        (".db", "committed", "roll_forward", True),
+        (".db", "staging", "rollback", False),
+        (".db", "replacing", "roll_forward", True),
+    ],
+)
+def test_recover_after_crash(tmp_path, sample_db, suffix, crash, action, keeps_new):
+    path = str(tmp_path / ("archive" + suffix))
+    Chunk(path, sample_db).save_data()
+    Chunk.relase_connections()
+    before = load_summary(path)
+    Chunk.relase_connections()
+
+    expected = crash_save(path, crash)
+    assert expected != before
+
+    storage_type = SingleFileStorage if suffix else DirectoryStorage
+    assert storage_type.recover(path) == action
+    assert storage_type.recover(path) is None  # 处理完就没有要做的了
+    Chunk.synced_path = None
+    assert load_summary(path) == (expected if keeps_new else before)
+
+    leftovers = [
+        os.path.join(root, name)
+        for root, _, names in os.walk(tmp_path)
+        for name in names
+        if name.endswith((".journal", ".tmp"))
+        or ".staging" in name
+        or ".old" in name
+    ]
+    assert leftovers == []
+
+
+def test_directory_save_writes_in_place(tmp_path, sample_db):
+    path = str(tmp_path / "archive")
+    Chunk(path, sample_db).save_data()
+    db_path = os.path.join(path, "Current", "Student.db")
+    inode = os.stat(db_path).st_ino
+    Chunk(path, sample_db).save_data()  # 第二次是增量保存，会走atomic_save
+    assert os.stat(db_path).st_ino == inode  # 没有复制整个文件再换上去
+    names = [n for _, _, files in os.walk(path) for n in files]
+    assert not any(n.endswith(".journal") for n in names)
+
+
+def test_partial_commit_is_reverted(tmp_path, sample_db, monkeypatch):
+    path = str(tmp_path / "archive")
+    Chunk(path, sample_db).save_data()
+    before = student_summary(sample_db)
+
+    template = list(sample_db.templates.values())[1]
+    for student in sample_db.classes[DEFAULT_CLASS_KEY].students.values():
+        ScoreModification(template, student).execute()
+    commit = ConnectionManager._commit  # pylint: disable=protected-access
+    count = [0]
+
+    def fail_second(self, db_path):
+        count[0] += 1
+        if count[0] == 2:
+            raise sqlite3.OperationalError("disk I/O error")
+        commit(self, db_path)
+
+    monkeypatch.setattr(ConnectionManager, "_commit", fail_second)
+    with pytest.raises(sqlite3.OperationalError):
+        Chunk(path, sample_db).save_data()
+    monkeypatch.undo()
+
+    assert count[0] == 2  # 第一个数据库已经提交了，得靠撤销日志撤回来
+    assert DirectoryStorage.recover(path) is None
+    Chunk.relase_connections()
+    Chunk.synced_path = None
+    assert load_summary(path) == before
@@ -0,0 +1,92 @@
+"""
+目录存档和单文件存档互相转换的测试
+"""
+
+import copy
+import time
+
+import pytest
+
+from utils.classdatatypes import History
+from utils.classobjects import DEFAULT_CLASS_KEY
+from utils.dataloader import (
+    Chunk,
+    DataObject,
+    DirectoryStorage,
+    SingleFileStorage,
+    migrate_archive,
+)
+
+
+def summary(path: str):
+    "存档里面所有历史记录和当前数据的(学号, 分数, 记录数)"
+    DataObject.clear_loaded_objects()
+    db = Chunk(path).load_data(True)
+    result = [
+        sorted(
+            (s.num, round(s.score, 2), len(s.history))
+            for s in h.classes[DEFAULT_CLASS_KEY].students.values()
+        )
+        for _, h in sorted(db.history_data.items())
+    ]
+    result.append(
+        sorted(
+            (s.num, round(s.score, 2), len(s.history))
+            for s in db.classes[DEFAULT_CLASS_KEY].students.values()
+        )
+    )
+    return result, len(db.templates), len(db.achievements), sorted(db.history_data)
+
+
+@pytest.fixture
+def directory_archive(tmp_path, sample_db):
+    "带三个历史记录的目录存档"
+    for k in range(3):
+        history = History(
+            copy.deepcopy(sample_db.classes),
+            {DEFAULT_CLASS_KEY: {}},
+            time.time() - 1000 * (k + 1),
+        )
+        sample_db.history_data[history.time] = history
+    path = str(tmp_path / "archive")
+    Chunk(path, sample_db).save_data()
+    Chunk.relase_connections()
+    return path
+
+
+def test_directory_to_single_file(tmp_path, directory_archive):
+    target = str(tmp_path / "archive.db")
+    counts = migrate_archive(directory_archive, target)
+    assert set(counts) >= {"Current"}
+    assert all(count > 0 for count in counts.values())
+    assert isinstance(Chunk(target).storage, SingleFileStorage)
+    expected = summary(directory_archive)
+    assert len(expected[0]) == 4
+    assert summary(target) == expected
+
+    with pytest.raises(FileExistsError):
+        migrate_archive(directory_archive, target)
+    migrate_archive(directory_archive, target, overwrite=True)
+    assert summary(target) == expected
+
+
+def test_single_file_back_to_directory(tmp_path, directory_archive):
+    single = str(tmp_path / "archive.db")
+    migrate_archive(directory_archive, single)
+    expected = summary(directory_archive)
+
+    DataObject.clear_loaded_objects()
+    db = Chunk(single).load_data(True)
+    db.templates = {t.key: t for t in db.templates}
+    db.achievements = {a.key: a for a in db.achievements}
+    back = str(tmp_path / "back")
+    Chunk(back, db).save_data()
+    Chunk.relase_connections()
+    assert isinstance(Chunk(back).storage, DirectoryStorage)
+    assert summary(back) == expected
+
+
+def test_migrate_missing_source(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        migrate_archive(str(tmp_path / "missing"), str(tmp_path / "missing.db"))
+    assert not (tmp_path / "missing.db").exists()
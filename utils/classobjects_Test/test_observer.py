@@ -0,0 +1,86 @@
+"""
+班级侦测器的测试
+"""
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils.classdatatypes import ClassObjectEvents, Group, Student
+from utils.classobjects import AchievementStatusObserver, ClassStatusObserver, EventSignal
+
+from .test_rankindex import make_class, make_classobj
+
+
+@pytest.fixture
+def observer():
+    "在跑的侦测器，第一帧已经处理完了"
+    cls = make_class([1.0, 2.0, 3.0])
+    cls.groups["g"] = Group("g", "第一组", cls.students[1], [cls.students[1]], "TEST")
+    obj = make_classobj(cls)
+    obj.modify_templates = {}
+    obs = ClassStatusObserver(obj, "TEST")
+    obs.full_check_interval = 3600
+    obs.start()
+    version = obs.wait_for_change(0, 5)
+    assert version == 1
+    yield obs
+    obs.stop()
+
+
+def changed(obs: ClassStatusObserver) -> bool:
+    version = obs.version
+    return obs.wait_for_change(version, 2) != version
+
+
+def test_rename_bumps_version(observer):
+    observer.target_class.students[2].name = "改名了"
+    observer.on_class_changed()  # 不带参数也要能调
+    assert changed(observer)
+
+
+def test_group_edit_bumps_version(observer):
+    group = observer.target_class.groups["g"]
+    group.members.append(observer.target_class.students[2])
+    observer.on_class_changed()
+    assert changed(observer)
+    group.name = "新名字"
+    observer.on_class_changed()
+    assert changed(observer)
+
+
+def test_modified_event_bumps_version_without_data_change(observer):
+    EventSignal.emit(
+        ClassObjectEvents.StudentModified,
+        default_arguments=((observer.target_class.students[1],), {}),
+    )
+    assert changed(observer)
+    observer.on_class_changed()
+    assert not changed(observer)
+
+
+def test_score_change_bumps_version(observer):
+    student = observer.target_class.students[1]
+    student.score += 5
+    EventSignal.emit(ClassObjectEvents.StudentScoreChanged, default_arguments=((student,), {}))
+    assert changed(observer)
+
+
+def test_achievement_observer_skips_students_without_rank():
+    cls = make_class([1.0, 2.0, 3.0])
+    obj = make_classobj(cls)
+    obj.achievement_templates = {}
+    # 排名是加学生之前排的，新学生还没有名次
+    obj.class_obs = SimpleNamespace(rank_dumplicate=list(cls.rank_dumplicate))
+    obs = AchievementStatusObserver(obj, "TEST")
+    obs.on_active = True
+    obs.coalesce_interval = 0
+    obs.full_check_requested = False
+    obs.last_full_check = time.time()
+    obs.last_ranks = {id(s): 1 for s in cls.students.values()}
+    cls.students[4] = Student("新学生", 4, 10.0, "TEST", {})
+    obs.on_student_changed(cls.students[4])
+    obs.next_frame(handle_overloading=False)
+    assert id(cls.students[4]) not in obs.last_ranks
+    assert sorted(obs.last_ranks.values()) == [1, 2, 3]
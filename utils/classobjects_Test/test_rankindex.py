@@ -0,0 +1,135 @@
+"""
+排名索引的测试
+"""
+
+import copy
+import pickle
+from types import SimpleNamespace
+
+import pytest
+
+from utils.algorithm.rankindex import RankIndex
+from utils.classobjects import ClassObj
+from utils.classdatatypes import Class, Student
+
+
+def make_class(scores):
+    "按分数列表建一个班级，学号从1开始"
+    students = {
+        num: Student(f"学生{num}", num, score, "TEST", {})
+        for num, score in enumerate(scores, start=1)
+    }
+    return Class("测试班级", "测试", students, "TEST", {})
+
+
+def make_classobj(cls):
+    "只带一个班级的ClassObj，不读存档"
+    obj = ClassObj.__new__(ClassObj)
+    obj.classes = {cls.key: cls}
+    return obj
+
+
+def test_delete_then_add_keeps_index_in_sync():
+    cls = make_class([10.0, 20.0, 30.0])
+    obj = make_classobj(cls)
+    assert cls.rank_of(cls.students[3]) == 1  # 先把索引建出来
+
+    removed = obj.del_student(2, "TEST")
+    assert obj.add_student("新学生", "TEST", 4, 25.0)
+    new = cls.students[4]
+
+    # 人数没变，索引也得跟着变
+    assert len(cls.rank_index) == len(cls.students) == 3
+    assert removed not in cls.rank_index
+    assert cls.rank_of(new) == 2
+    assert [s.num for s in cls.top_students(3)] == [3, 4, 1]
+
+
+def test_added_student_score_change_updates_rank():
+    cls = make_class([10.0, 20.0])
+    obj = make_classobj(cls)
+    assert cls.rank_of(cls.students[1]) == 2
+    obj.add_student("新学生", "TEST", 3, 0.0)
+    new = cls.students[3]
+    assert cls.rank_of(new) == 3
+    new.score = 50.0
+    assert cls.rank_of(new) == 1
+
+
+def items(*scores):
+    "按分数建一组对象，num从1开始"
+    return [SimpleNamespace(num=num, score=score) for num, score in enumerate(scores, start=1)]
+
+
+def nums(result):
+    return [(rank, item.num) for rank, item in result]
+
+
+def test_order_and_ties():
+    a, b, c, d, e = items(5, 8, 8, 3, 8)
+    index = RankIndex([a, b, c, d, e])
+    # 分数高的在前面，同分的按key从小到大
+    assert [x.num for x in index] == [2, 3, 5, 1, 4]
+    assert nums(index.ranking()) == [(1, 2), (1, 3), (1, 5), (2, 1), (3, 4)]
+    assert nums(index.ranking(False)) == [(1, 2), (1, 3), (1, 5), (4, 1), (5, 4)]
+    assert [index.rank_of(x) for x in (a, b, c, d, e)] == [2, 1, 1, 3, 1]
+    assert [index.rank_of(x, False) for x in (a, b, c, d, e)] == [4, 1, 1, 5, 1]
+    assert index.lowest_rank() == 3 and index.lowest_rank(False) == 5
+    assert [x.num for x in index.top(2)] == [2, 3]
+    assert index.top(0) == [] and len(index.top(10)) == 5
+
+
+def test_window():
+    index = RankIndex(items(5, 8, 8, 3, 8, 1))
+    assert nums(index.window(1, 1)) == [(1, 2), (1, 3), (1, 5)]
+    assert nums(index.window(2, 3)) == [(2, 1), (3, 4)]
+    assert nums(index.window(2, 4, False)) == [(4, 1)]
+    assert nums(index.window(5, 10, False)) == [(5, 4), (6, 6)]
+    assert index.window(7, 9) == []
+
+
+def test_update_rekey_remove():
+    a, b, c = items(1, 2, 3)
+    index = RankIndex([a, b, c])
+    a.score = 10
+    assert index.update(a)
+    assert [x.num for x in index] == [1, 3, 2]
+    assert not index.update(SimpleNamespace(num=1, score=10))  # key一样但不是同一个对象
+
+    a.num = 9
+    assert index.rekey(a, 1)
+    assert a in index and index.rank_of(a) == 1
+    assert not index.rekey(a, 1)
+
+    b.score = 10  # 和a并列，按key排在a前面
+    index.update(b)
+    assert nums(index.ranking()) == [(1, 2), (1, 9), (2, 3)]
+    assert index.remove(b) and not index.remove(b)
+    assert nums(index.ranking()) == [(1, 9), (2, 3)]
+    with pytest.raises(KeyError):
+        index.rank_of(b)
+
+    index.remove(a)
+    index.remove(c)
+    assert len(index) == 0 and index.lowest_rank() == 0 and index.ranking() == []
+
+
+def test_add_replaces_same_key():
+    index = RankIndex(items(1, 2))
+    index.add(SimpleNamespace(num=1, score=5))
+    assert len(index) == 2
+    assert nums(index.ranking()) == [(1, 1), (2, 2)]
+
+
+def test_copied_class_rebuilds_index():
+    cls = make_class([3, 1, 2])
+    assert [s.num for s in cls.rank_index] == [1, 3, 2]
+    # 索引本身复制出来是空的，复制出来的班级第一次用的时候按自己的学生重新建
+    assert len(copy.deepcopy(cls.rank_index)) == 0
+    assert len(pickle.loads(pickle.dumps(cls.rank_index))) == 0
+    other = copy.deepcopy(cls)
+    assert [s.num for s in other.rank_index] == [1, 3, 2]
+    assert all(s is other.students[s.num] for s in other.rank_index)
+    other.students[2].score = 10
+    assert other.rank_index.rank_of(other.students[2]) == 1
+    assert cls.rank_index.rank_of(cls.students[2]) == 3
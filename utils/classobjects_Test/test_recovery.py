@@ -0,0 +1,93 @@
+"""
+增量还原点的测试
+"""
+
+import os
+
+import pytest
+
+from utils.recovery import create_snapshot, manifest_name, read_manifest, restore_snapshot
+
+
+def write(path, content: bytes, mtime_ns: int = 1_700_000_000_000_000_000):
+    "写文件，修改时间固定，不然同一秒里面改的文件分不出来"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def read(path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture
+def archive(tmp_path):
+    "一个有三个文件的存档目录，外加一个不用备份的临时文件"
+    root = tmp_path / "chunks" / "default"
+    write(str(root / "info.json"), b"{}")
+    write(str(root / "Current" / "students.db"), b"s" * 100)
+    write(str(root / "Current" / "classes.db"), b"c" * 50)
+    write(str(root / "info.json.tmp"), b"tmp")
+    return str(root)
+
+
+def test_first_snapshot_copies_everything(tmp_path, archive):
+    point = str(tmp_path / "p1")
+    stats = create_snapshot(archive, point)
+    assert stats == {"linked": 0, "copied": 3, "copied_bytes": 152}
+    manifest = read_manifest(point)
+    assert sorted(manifest["files"]) == [
+        "default/Current/classes.db",
+        "default/Current/students.db",
+        "default/info.json",
+    ]
+    assert not os.path.exists(os.path.join(point, "default", "info.json.tmp"))
+
+
+def test_next_snapshot_links_unchanged_files(tmp_path, archive):
+    p1, p2 = str(tmp_path / "p1"), str(tmp_path / "p2")
+    create_snapshot(archive, p1)
+    write(os.path.join(archive, "Current", "students.db"), b"S" * 120, 1_800_000_000_000_000_000)
+    stats = create_snapshot(archive, p2, previous=p1)
+    assert stats == {"linked": 2, "copied": 1, "copied_bytes": 120}
+    same = os.path.join("default", "Current", "classes.db")
+    changed = os.path.join("default", "Current", "students.db")
+    assert os.path.samefile(os.path.join(p1, same), os.path.join(p2, same))
+    assert not os.path.samefile(os.path.join(p1, changed), os.path.join(p2, changed))
+    assert read(os.path.join(p1, changed)) == b"s" * 100
+    assert read(os.path.join(p2, changed)) == b"S" * 120
+
+
+def test_previous_without_manifest_copies_everything(tmp_path, archive):
+    p1, p2 = str(tmp_path / "p1"), str(tmp_path / "p2")
+    create_snapshot(archive, p1)
+    os.remove(os.path.join(p1, manifest_name))
+    stats = create_snapshot(archive, p2, previous=p1)
+    assert stats["linked"] == 0 and stats["copied"] == 3
+
+
+def test_restore_links_unchanged_and_copies_changed(tmp_path, archive):
+    point = str(tmp_path / "p1")
+    create_snapshot(archive, point)
+    write(os.path.join(archive, "Current", "students.db"), b"x" * 10, 1_800_000_000_000_000_000)
+    target = str(tmp_path / "restored")
+    stats = restore_snapshot(point, "default", target, live=archive)
+    assert stats == {"linked": 2, "copied": 1, "copied_bytes": 100}
+    assert read(os.path.join(target, "Current", "students.db")) == b"s" * 100
+    assert os.path.samefile(
+        os.path.join(target, "info.json"), os.path.join(archive, "info.json")
+    )
+    # 还原点里面的文件不能被链接出去，不然改存档的时候会把还原点一起改掉
+    assert not os.path.samefile(
+        os.path.join(target, "Current", "students.db"),
+        os.path.join(point, "default", "Current", "students.db"),
+    )
+
+
+def test_restore_without_live_copies_everything(tmp_path, archive):
+    point = str(tmp_path / "p1")
+    create_snapshot(archive, point)
+    stats = restore_snapshot(point, "default", str(tmp_path / "restored"))
+    assert stats == {"linked": 0, "copied": 3, "copied_bytes": 152}
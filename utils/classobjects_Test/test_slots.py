@@ -0,0 +1,33 @@
+"""
+__slots__相关的测试
+"""
+
+import copy
+
+import pytest
+
+from utils.basetypes import slot_names
+from utils.classdatatypes import Achievement, AttendanceInfo, ScoreModification, Student
+
+
+@pytest.mark.parametrize("cls", [Student, ScoreModification, Achievement, AttendanceInfo])
+def test_slotted_classes_declare_uuid(cls):
+    assert "_uuid" in slot_names(cls)
+
+
+def test_uuid_generated_once_and_kept_by_copy():
+    student = Student("学生", 1, 0.0, "TEST", {})
+    assert not hasattr(student, "__dict__")
+    uuid = student.ensure_uuid()
+    assert len(uuid) == 32 and student.uuid == uuid
+    assert copy.deepcopy(student).uuid == uuid
+
+
+def test_main_window_layout():
+    # 主窗口同时继承ClassObj和QMainWindow，Object有slot的话这里会报实例布局冲突
+    from PySide6.QtWidgets import QMainWindow  # pylint: disable=import-outside-toplevel
+
+    from utils.classobjects import ClassObj  # pylint: disable=import-outside-toplevel
+
+    class Window(ClassObj, QMainWindow):  # pylint: disable=unused-variable
+        "假的主窗口"
@@ -4,14 +4,30 @@
 
 import os
 import sys
+import atexit
 import math
+import hashlib
 import shutil
+import marshal
 import sqlite3
-from threading import RLock
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import (
+    BrokenExecutor,
+    Future,
+    ProcessPoolExecutor,
+    as_completed,
+    wait as wait_futures,
+)
+from typing import Literal, NamedTuple
+from threading import RLock, Thread, get_ident
 
 from utils.functions.prompts import question_yes_no
 from utils.classdatatypes import *  # pylint: disable=unused-wildcard-import, wildcard-import
 from utils.classobjects import gen_uuid
+from utils.basetypes import intern_uuid
+from utils.codec import RecordCodec, get_codec, decode_record
 from utils.algorithm import Mutex
 from utils.default import DEFAULT_CLASS_KEY
 
@@ -38,46 +54,54 @@ _RT = TypeVar(
 class DataKind(Generic[_RT], str):
     "数据类型, DataKind[Student]代表这个对象在被访问之后会变成一个对象"
 
+    def __new__(
+        cls,
+        uuid: UUIDKind[_RT],
+        data_type: Type[_RT],
+        bound_chunk: "Chunk",
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+    ):
+        return super().__new__(cls, uuid)
+
     def __init__(
         self,
-        instance: _RT,
+        uuid: UUIDKind[_RT],
+        data_type: Type[_RT],
         bound_chunk: "Chunk",
         history_uuid: Union[UUIDKind[History], Literal["Current"]],
     ) -> Union["DataKind[_RT]", _RT]:
         """
-        根据数据类型生成一个未加载的数据类型。
+        根据uuid生成一个未加载的数据类型，本身是个uuid字符串。
 
-        :param instance: 数据实例
+        :param uuid: 数据uuid
+        :param data_type: 数据类型
         :param bound_chunk: 数据所在分块
+        :param history_uuid: 数据所在历史记录
         :return: 数据类型
 
         - 注意，``Union["DataKind[_RT]", _RT]``中的``_RT``只是用来给类成员提示的，实际上**并不会返回原来的数据类型！**
+        - 第一次访问对象的属性或者调用``load()``的时候才会从数据库加载
         """
-        self.data_type: Type[ClassDataType] = instance.__class__
-        self.instance = instance
+        self.uuid = str(uuid)
+        self.data_type: Type[ClassDataType] = data_type
         self.chunk = bound_chunk
         self.history_uuid = history_uuid
+        self.instance: Optional[_RT] = None
 
-    def __getattr__(self, item: str) -> Any:
-        value = getattr(self.instance, item)
-        if isinstance(value, UUIDKind):
-            try:
-                return DataObject.loaded_object_list[
-                    (self.history_uuid, self.data_type.chunk_type_name, value.uuid)
-                ]
-            except KeyError:
-                obj = self.data_type.from_string(
-                    self.chunk.get_object_rdata(
-                        self.history_uuid, value.uuid, self.data_type.chunk_type_name
-                    )
+    def load(self) -> _RT:
+        "加载这个对象，加载过了就直接返回"
+        if self.instance is None:
+            with self.chunk.bind_loaders(self.history_uuid):
+                self.instance = ClassDataObj.LoadUUID(
+                    self.uuid, self.data_type, self.history_uuid
                 )
-                DataObject.loaded_object_list[
-                    (self.history_uuid, self.data_type.chunk_type_name, value.uuid)
-                ] = obj
-                setattr(self.instance, item, obj)
-                return obj
-        else:
-            return value
+        return self.instance
+
+    def __getattr__(self, item: str) -> Any:
+        if item.startswith("__"):
+            # 别让copy和pickle之类的东西把数据加载出来
+            raise AttributeError(item)
+        return getattr(self.load(), item)
 
 
 _RDT = TypeVar(
@@ -201,6 +225,829 @@ class UserDataBase(Object):
         )
 
 
+class ConnectionManager:
+    """
+    数据库连接管理。
+
+    每个数据库文件只开一个连接，保存完也不关，下次保存/加载直接接着用，
+    省掉反复连接、建表检查和回滚日志的开销。
+
+    连接打开的时候会设置这些：
+
+    - ``journal_mode=WAL``：写入只追加到``-wal``文件，不用每次事务都整个写回滚日志
+    - ``synchronous=NORMAL``：WAL模式下只在检查点的时候fsync，断电最多丢最后一次提交
+    - ``cache_size``和``mmap_size``：页缓存和内存映射，读整个库的时候快很多
+
+    ``-wal``里面的数据要检查点（``checkpoint``）之后才会合并回``.db``，
+    所以复制或者删除存档之前记得先``close``对应目录的连接。
+
+    读数据另外有一个连接（见``reading``），别的线程开着写事务的时候也只会读到已经提交的数据。
+
+    合并提交记撤销日志的时候（见``batch``），数据库里面会多两张表：
+    ``batch_undo``（最后一次合并提交的撤销语句）和``batch_generation``（最后一次合并提交的代号）。
+    """
+
+    cache_size: int = -8192
+    "页缓存大小（负数的单位是KiB，-8192就是8MB）"
+
+    mmap_size: int = 64 * 1024 * 1024
+    "内存映射的大小"
+
+    wal_autocheckpoint: int = 1000
+    "WAL文件超过多少页的时候自动检查点"
+
+    cached_statements: int = 256
+    "每个连接缓存的预编译语句数量"
+
+    undo_table: str = "batch_undo"
+    "撤销日志的表名"
+
+    generation_table: str = "batch_generation"
+    "记着最后一次合并提交的代号的表名"
+
+    def __init__(self):
+        self.connections: Dict[str, sqlite3.Connection] = {}
+        "连接池，connections[数据库绝对路径] = 连接"
+        self.locks: Dict[str, RLock] = {}
+        "每个连接的锁，事务期间别的线程不能用这个连接"
+        self.readers: Dict[str, sqlite3.Connection] = {}
+        "读数据用的连接，readers[数据库绝对路径] = 连接"
+        self.reader_locks: Dict[str, RLock] = {}
+        "读数据用的连接的锁"
+        self.schema_ready: Set[str] = set()
+        "已经建好表的数据库"
+        self.lock = RLock()
+        "连接池的锁"
+        self.batch_lock = RLock()
+        "合并提交的锁，同一时间只能有一个线程在合并提交"
+        self.batch_thread: Optional[int] = None
+        "正在合并提交的线程"
+        self.batch_paths: List[str] = []
+        "合并提交期间开了事务的数据库，按开的顺序"
+        self.batch_generation: Optional[int] = None
+        "合并提交的代号，不记撤销日志的时候是None"
+        self.undo_tables: Dict[str, Dict[str, List[str]]] = {}
+        "合并提交期间记撤销日志的表，undo_tables[数据库绝对路径][表名] = 建表和建索引的语句"
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.abspath(path) in self.connections
+
+    def _open(self, path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            path,
+            check_same_thread=False,
+            isolation_level=None,  # 手动管理事务
+            cached_statements=self.cached_statements,
+        )
+        for pragma in (
+            "journal_mode=WAL",
+            "synchronous=NORMAL",
+            f"cache_size={self.cache_size}",
+            f"mmap_size={self.mmap_size}",
+            f"wal_autocheckpoint={self.wal_autocheckpoint}",
+            "temp_store=MEMORY",
+            "recursive_triggers=ON",  # REPLACE删掉旧行的时候撤销日志的触发器也要触发
+        ):
+            try:
+                conn.execute(f"PRAGMA {pragma}").fetchall()
+            except sqlite3.Error as e:
+                # 只读介质或者网络盘上可能设置不了，用默认的也能用
+                Base.log_exc_short(
+                    f"设置{pragma}失败（{os.path.basename(path)}）",
+                    "ConnectionManager.open",
+                    "W",
+                    exc=e,
+                )
+        return conn
+
+    def get(self, path: str, create_schema: bool = False) -> sqlite3.Connection:
+        """
+        获取某个数据库的连接，没有的话就开一个新的。
+
+        :param path: 数据库文件路径
+        :param create_schema: 是否确保``datas``表已经建好
+        :return: 数据库连接
+        """
+        path = os.path.abspath(path)
+        try:
+            conn = self.connections[path]
+        except KeyError:
+            with self.lock:
+                conn = self.connections.get(path)
+                if conn is None:
+                    conn = self._open(path)
+                    self.connections[path] = conn
+                    # 数据库文件被换掉重新打开的时候锁可能还被拿着，得用原来那个
+                    self.locks.setdefault(path, RLock())
+        if create_schema and path not in self.schema_ready:
+            self.ensure_schema(path)
+        return conn
+
+    @contextmanager
+    def reading(self, path: str, create_schema: bool = False):
+        """
+        获取读数据用的连接。
+
+        写连接上可能开着别的线程的事务（比如后台保存的合并提交），
+        用它来读的话会读到还没提交的数据，回滚了之后这些对象还留在缓存里面。
+        所以读的时候用单独的连接，WAL模式下读写互不阻塞，读到的都是已经提交了的。
+        当前线程自己正在合并提交这个数据库的话还是用写连接，这样才能读到自己刚写的。
+
+        >>> with Chunk.connections.reading(db_path) as conn:
+        ...     rows = conn.execute(...).fetchall()
+
+        :param path: 数据库文件路径
+        :param create_schema: 是否确保``datas``表已经建好
+        """
+        path = os.path.abspath(path)
+        writer = self.get(path, create_schema=create_schema)
+        if self.in_batch() and path in self.batch_paths:
+            with self.locks[path]:
+                yield writer
+            return
+        try:
+            conn = self.readers[path]
+        except KeyError:
+            with self.lock:
+                conn = self.readers.get(path)
+                if conn is None:
+                    conn = self._open(path)
+                    self.readers[path] = conn
+                    self.reader_locks.setdefault(path, RLock())
+        with self.reader_locks[path]:
+            yield conn
+
+    def ensure_schema(self, path: str) -> None:
+        """
+        建好数据库里面的``datas``表，每个连接只会检查一次。
+
+        以前的数据库按uuid的第一个字符分成了16张``datas_{0-f}``分表，
+        碰到的话会在这里并进``datas``，然后把分表删掉（只做一次）。
+
+        :param path: 数据库文件路径
+        """
+        path = os.path.abspath(path)
+        conn = self.get(path)
+        with self.locks[path]:
+            if path in self.schema_ready:
+                return
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS datas (
+                                                id     integer    primary key,    -- 行号
+                                                uuid   text       not null unique,  -- 数据UUID
+                                                class  text,                      -- 数据类型
+                                                data   text                       -- 数据
+                                        )"""
+            )
+            legacy = [
+                name
+                for (name,) in conn.execute(
+                    "SELECT name FROM sqlite_master "
+                    "WHERE type = 'table' AND name GLOB 'datas_[0-9a-f]'"
+                )
+            ]
+            if legacy:
+                self._merge_legacy_tables(conn, legacy)
+                Base.log(
+                    "I",
+                    f"{os.path.basename(path)}的{len(legacy)}张旧分表已经合并",
+                    "ConnectionManager.ensure_schema",
+                )
+            self.schema_ready.add(path)
+
+    @staticmethod
+    def _merge_legacy_tables(conn: sqlite3.Connection, tables: List[str]) -> None:
+        "把旧的``datas_{0-f}``分表并进``datas``"
+        # 合并提交期间已经在事务里面了，跟着一起提交
+        own = not conn.in_transaction
+        if own:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            for name in tables:
+                conn.execute(
+                    f"INSERT OR IGNORE INTO datas (uuid, class, data) "
+                    f"SELECT uuid, class, data FROM {name}"
+                )
+                # DROP TABLE不会触发触发器，先删数据撤销日志才记得下来
+                conn.execute(f"DELETE FROM {name}")
+                conn.execute(f"DROP TABLE {name}")
+        except BaseException:
+            if own:
+                conn.execute("ROLLBACK")
+            raise
+        if own:
+            conn.execute("COMMIT")
+
+    @contextmanager
+    def transaction(self, path: str, create_schema: bool = True):
+        """
+        在某个数据库上开一个写事务（``BEGIN IMMEDIATE``），出错的时候回滚。
+
+        >>> with Chunk.connections.transaction(db_path) as conn:
+        ...     conn.executemany(...)
+
+        :param path: 数据库文件路径
+        :param create_schema: 是否确保``datas``表已经建好
+        """
+        path = os.path.abspath(path)
+        conn = self.get(path, create_schema=create_schema)
+        if self.in_batch():
+            if path not in self.batch_paths:
+                self.locks[path].acquire()
+                try:
+                    # 事务里面改不了，得在开始之前切过去
+                    conn.execute("PRAGMA synchronous=FULL").fetchall()
+                    conn.execute("BEGIN IMMEDIATE")
+                    if self.batch_generation is not None:
+                        self._start_undo(path)
+                except BaseException:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    self._drop_undo(path)
+                    conn.execute("PRAGMA synchronous=NORMAL").fetchall()
+                    self.locks[path].release()
+                    raise
+                self.batch_paths.append(path)
+            # 合并提交期间每个数据库只有一个事务，里面的事务用保存点代替
+            conn.execute("SAVEPOINT txn")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK TO txn")
+                conn.execute("RELEASE txn")
+                raise
+            else:
+                conn.execute("RELEASE txn")
+            return
+        with self.locks[path]:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+                raise
+            else:
+                conn.execute("COMMIT")
+
+    def in_batch(self) -> bool:
+        "当前线程是不是在合并提交"
+        return self.batch_thread == get_ident()
+
+    @contextmanager
+    def batch(
+        self,
+        before_commit: Optional[Callable[[List[str]], Any]] = None,
+        generation: Optional[int] = None,
+    ):
+        """
+        合并提交：这期间当前线程上的``transaction``都不会马上提交，
+        每个数据库只开一个事务（里面的``transaction``变成保存点），最后一起提交，出错的话全部回滚。
+
+        事务一直开着，别的线程要写这些数据库得等到提交完。
+        提交用的是``synchronous=FULL``，每个数据库提交完就已经落盘了。
+        单文件存档只有一个数据库，一个事务就是原子的。
+
+        目录存档有好几个数据库文件，只能挨个提交（WAL模式下ATTACH也没法一起提交），中间断电就只有一部分生效，
+        所以要传``generation``（这次合并提交的代号）记撤销日志：
+        每个数据库开事务的时候把代号写进``batch_generation``，改了的每一行都用临时触发器往``batch_undo``里面记一条撤销语句，
+        跟数据在同一个事务里面提交，撤销日志多大只看这次改了多少，不用复制整个文件。
+        全部写完、开始提交之前调用``before_commit``写日志，记下代号和这次写了哪些数据库。
+        断电之后看这些数据库里面的代号（见``generation``）：都是这次的就是提交完了，
+        只有一部分是的话把这一部分撤销掉（见``revert``），就跟这次没保存过一样（见``ArchiveStorage.resolve_journal``）。
+        上一次的撤销日志在下一次合并提交的事务里面顺便清掉。
+
+        表结构只管建表和删表：这次新建的表撤销的时候删掉，删掉的表按原来的语句重新建出来，
+        里面的数据得在删表之前先``DELETE``掉才记得进撤销日志。
+
+        :param before_commit: 全部写完、开始提交之前调用，参数是这次写了的数据库，写日志用
+        :param generation: 这次合并提交的代号，不填就不记撤销日志
+        """
+        if self.in_batch():
+            yield
+            return
+        with self.batch_lock:
+            self.batch_thread = get_ident()
+            self.batch_paths = []
+            self.batch_generation = generation
+            try:
+                yield
+                if generation is not None:
+                    for path in self.batch_paths:
+                        self._finish_undo(path)
+                if before_commit is not None:
+                    before_commit(list(self.batch_paths))
+                for path in self.batch_paths:
+                    self._commit(path)
+            except BaseException:
+                # 已经提交了的数据库这里回滚不了，交给调用的地方用撤销日志处理
+                for path in self.batch_paths:
+                    conn = self.connections[path]
+                    try:
+                        if conn.in_transaction:
+                            conn.execute("ROLLBACK")
+                    except sqlite3.Error:
+                        pass
+                    # 建表也被回滚了
+                    self.schema_ready.discard(path)
+                raise
+            finally:
+                for path in reversed(self.batch_paths):
+                    try:
+                        self._drop_undo(path)
+                        self.connections[path].execute(
+                            "PRAGMA synchronous=NORMAL"
+                        ).fetchall()
+                    except sqlite3.Error:
+                        pass
+                    self.locks[path].release()
+                self.batch_thread = None
+                self.batch_paths = []
+                self.batch_generation = None
+
+    def _commit(self, path: str) -> None:
+        "提交合并提交里面一个数据库的事务"
+        self.connections[path].execute("COMMIT")
+
+    @staticmethod
+    def _quote_name(identifier: str) -> str:
+        "表名和列名加上双引号"
+        return '"' + identifier.replace('"', '""') + '"'
+
+    def _undo_triggers(self, conn: sqlite3.Connection, table: str) -> List[str]:
+        """
+        生成某张表记撤销日志的临时触发器。
+
+        插入的行撤销的时候删掉，删掉的行按原来的值插回去，改了的行改回原来的值，
+        值用``quote``转成SQL字面量，有rowid的表按rowid找行，没有的按主键找。
+
+        :return: 建触发器的语句
+        """
+        quoted = self._quote_name(table)
+        columns = [
+            (row[1], row[2], row[5])
+            for row in conn.execute(f"PRAGMA table_info({quoted})")
+        ]
+        try:
+            conn.execute(f"SELECT rowid FROM {quoted} LIMIT 0")
+        except sqlite3.OperationalError:  # WITHOUT ROWID
+            keys = [c for c, _, pk in sorted(columns, key=lambda c: c[2]) if pk]
+        else:
+            keys = ["rowid"]
+            primary = [(c, t) for c, t, pk in columns if pk]
+            if len(primary) == 1 and primary[0][1].upper() == "INTEGER":
+                # INTEGER PRIMARY KEY就是rowid，不用单独恢复
+                columns = [c for c in columns if c[0] != primary[0][0]]
+            columns.insert(0, ("rowid", "", 0))
+
+        def column(field: str) -> str:
+            return field if field == "rowid" else self._quote_name(field)
+
+        def literal(text: str) -> str:
+            return "'" + text.replace("'", "''") + "'"
+
+        def value(row: str, field: str) -> str:
+            # 拼出来的是触发器里面的表达式，执行的时候才变成撤销语句
+            return f"{row}.rowid" if field == "rowid" else f"quote({row}.{column(field)})"
+
+        def assign(row: str, names: List[str], sep: str) -> str:
+            return f" || {literal(sep)} || ".join(
+                f"{literal(column(n) + '=')} || {value(row, n)}" for n in names
+            )
+
+        names = [c for c, _, _ in columns]
+        undo = {
+            "INSERT": f"{literal(f'DELETE FROM {quoted} WHERE ')} || "
+            + assign("new", keys, " AND "),
+            "DELETE": literal(
+                f"INSERT INTO {quoted} ({', '.join(map(column, names))}) VALUES ("
+            )
+            + " || "
+            + " || ', ' || ".join(value("old", n) for n in names)
+            + " || ')'",
+            "UPDATE": f"{literal(f'UPDATE {quoted} SET ')} || "
+            + assign("old", names, ", ")
+            + " || ' WHERE ' || "
+            + assign("new", keys, " AND "),
+        }
+        return [
+            f"CREATE TEMP TRIGGER {self._quote_name(f'undo_{table}_{operation.lower()}')} "
+            f"AFTER {operation} ON main.{quoted} "
+            f"BEGIN INSERT INTO {self.undo_table} (sql) VALUES ({statement}); END"
+            for operation, statement in undo.items()
+        ]
+
+    def _start_undo(self, path: str) -> None:
+        "合并提交的事务开始的时候写上代号，清掉上一次的撤销日志，再给每张表装上触发器"
+        conn = self.connections[path]
+        conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.undo_table} (
+                                                seq  integer  primary key,     -- 顺序
+                                                sql  text     not null         -- 撤销语句
+                                        )"""
+        )
+        conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.generation_table} (
+                                                id          integer  primary key check (id = 0),
+                                                generation  integer              -- 最后一次合并提交的代号
+                                        )"""
+        )
+        conn.execute(f"DELETE FROM {self.undo_table}")
+        conn.execute(
+            f"INSERT OR REPLACE INTO {self.generation_table} (id, generation) VALUES (0, ?)",
+            (self.batch_generation,),
+        )
+        tables: Dict[str, List[str]] = {}
+        for table, sql in conn.execute(
+            "SELECT tbl_name, sql FROM sqlite_master "
+            "WHERE type IN ('table', 'index') AND sql IS NOT NULL "
+            "ORDER BY type = 'index'"
+        ).fetchall():
+            if table.startswith("sqlite_") or table in (
+                self.undo_table,
+                self.generation_table,
+            ):
+                continue
+            tables.setdefault(table, []).append(sql)
+        self.undo_tables[path] = tables
+        for table in tables:
+            for statement in self._undo_triggers(conn, table):
+                conn.execute(statement)
+
+    def _finish_undo(self, path: str) -> None:
+        "提交之前把表结构的变化也记进撤销日志"
+        conn = self.connections[path]
+        tables = self.undo_tables.get(path, {})
+        current = {
+            table
+            for (table,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+        statements = [
+            f"DROP TABLE {self._quote_name(table)}"
+            for table in sorted(current)
+            if table not in tables
+            and not table.startswith("sqlite_")
+            and table not in (self.undo_table, self.generation_table)
+        ]
+        for table, sqls in tables.items():
+            if table not in current:
+                # 撤销的时候倒着执行，建表要在插回数据之前，也要在建索引之前
+                statements.extend(reversed(sqls))
+        conn.executemany(
+            f"INSERT INTO {self.undo_table} (sql) VALUES (?)",
+            [(sql,) for sql in statements],
+        )
+
+    def _drop_undo(self, path: str) -> None:
+        "拆掉撤销日志的触发器"
+        tables = self.undo_tables.pop(path, None)
+        if not tables:
+            return
+        conn = self.connections[path]
+        for table in tables:
+            for operation in ("insert", "delete", "update"):
+                trigger = self._quote_name(f"undo_{table}_{operation}")
+                conn.execute(f"DROP TRIGGER IF EXISTS temp.{trigger}")
+
+    def generation(self, path: str) -> Optional[int]:
+        """
+        某个数据库最后一次提交的合并提交的代号。
+
+        :param path: 数据库文件路径
+        :return: 代号，数据库不存在或者没记过撤销日志的话是None
+        """
+        path = os.path.abspath(path)
+        if not os.path.isfile(path):
+            return None
+        conn = self.get(path)
+        with self.locks[path]:
+            try:
+                row = conn.execute(
+                    f"SELECT generation FROM {self.generation_table} WHERE id = 0"
+                ).fetchone()
+            except sqlite3.OperationalError:
+                return None
+        return row[0] if row is not None else None
+
+    def revert(self, path: str, generation: int) -> bool:
+        """
+        用撤销日志把某个数据库恢复到代号是``generation``的合并提交之前的样子，断电之后恢复的时候用。
+
+        撤销在一个事务里面做完，中间断电的话下次还能接着撤销。
+
+        :param path: 数据库文件路径
+        :param generation: 要撤销的合并提交的代号
+        :return: 有没有撤销（数据库最后提交的不是这一次就是False）
+        """
+        path = os.path.abspath(path)
+        if self.generation(path) != generation:
+            return False
+        conn = self.get(path)
+        with self.locks[path]:
+            conn.execute("PRAGMA synchronous=FULL").fetchall()
+            try:
+                with self.transaction(path, create_schema=False) as conn:
+                    for (sql,) in conn.execute(
+                        f"SELECT sql FROM {self.undo_table} ORDER BY seq DESC"
+                    ).fetchall():
+                        conn.execute(sql)
+                    conn.execute(f"DELETE FROM {self.undo_table}")
+                    conn.execute(
+                        f"UPDATE {self.generation_table} SET generation = NULL WHERE id = 0"
+                    )
+            finally:
+                conn.execute("PRAGMA synchronous=NORMAL").fetchall()
+        # 表可能被删掉重建了
+        self.schema_ready.discard(path)
+        return True
+
+    def _select(self, path_prefix: Optional[str]) -> List[str]:
+        if path_prefix is None:
+            return list(self.connections)
+        prefix = os.path.abspath(path_prefix)
+        return [
+            p
+            for p in self.connections
+            if p == prefix or p.startswith(prefix.rstrip(os.sep) + os.sep)
+        ]
+
+    def checkpoint(
+        self,
+        path_prefix: Optional[str] = None,
+        mode: Literal["PASSIVE", "FULL", "RESTART", "TRUNCATE"] = "PASSIVE",
+    ) -> int:
+        """
+        把WAL里面的数据合并回数据库文件。
+
+        :param path_prefix: 只处理这个目录（或者文件）下面的连接，不填就是全部
+        :param mode: 检查点模式，``TRUNCATE``会顺便把``-wal``文件清空
+        :return: 处理了的连接数量
+        """
+        count = 0
+        with self.lock:
+            for path in self._select(path_prefix):
+                try:
+                    with self.locks[path]:
+                        self.connections[path].execute(
+                            f"PRAGMA wal_checkpoint({mode})"
+                        ).fetchall()
+                    count += 1
+                except sqlite3.Error as e:
+                    Base.log_exc_short(
+                        f"检查点失败（{path}）", "ConnectionManager.checkpoint", "W", exc=e
+                    )
+        return count
+
+    def close(self, path_prefix: Optional[str] = None) -> int:
+        """
+        关闭连接，关闭之前会先做一次检查点，把``-wal``合并回去。
+
+        删除或者复制存档目录之前必须先调用这个，不然还开着的连接会继续读写已经删掉的文件。
+
+        :param path_prefix: 只关闭这个目录（或者文件）下面的连接，不填就是全部
+        :return: 关闭了的连接数量
+        """
+        count = 0
+        with self.lock:
+            for path in self._select(path_prefix):
+                if path in self.batch_paths:
+                    # 关了的话合并提交的事务就被拆开了
+                    Base.log(
+                        "W", f"{path}正在合并提交，跳过关闭", "ConnectionManager.close"
+                    )
+                    continue
+                conn = self.connections.pop(path)
+                lock = self.locks.pop(path)
+                self.schema_ready.discard(path)
+                reader = self.readers.pop(path, None)
+                if reader is not None:
+                    with self.reader_locks.pop(path):
+                        try:
+                            reader.close()
+                        except sqlite3.Error:
+                            pass
+                with lock:
+                    try:
+                        if conn.in_transaction:
+                            conn.execute("COMMIT")
+                        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+                    except sqlite3.Error:
+                        pass
+                    try:
+                        conn.close()
+                    except sqlite3.Error:
+                        pass
+                count += 1
+        return count
+
+    def close_all(self) -> int:
+        "关闭所有连接"
+        return self.close(None)
+
+
+ObjectKey = Tuple[Union[UUIDKind[History], Literal["Current"]], str, str]
+"对象缓存的键：(历史记录uuid, 数据类型名, 对象uuid)"
+
+
+class ObjectCache:
+    """
+    一个存档的对象缓存（同一个对象只加载一次，加载出来都是同一个实例）。
+
+    ``Current``和共享模板的对象一直留着；旧的历史记录只用弱引用记着，
+    外面没人用了就跟着释放，另外最近用过的``keep_histories``个历史记录会多留一份强引用，
+    来回翻的时候不用每次都重新读。
+    """
+
+    caches: Dict[str, "ObjectCache"] = {}
+    "所有存档的缓存，按存档的绝对路径区分"
+
+    caches_lock: RLock = RLock()
+    "``caches``的锁"
+
+    keep_histories: int = 4
+    "最近用过的旧历史记录留几个"
+
+    def __init__(self, path: str, pinned_histories: Iterable[str] = ("Current",)):
+        """
+        构造函数。
+
+        :param path: 存档路径
+        :param pinned_histories: 一直留着的历史记录
+        """
+        self.path = os.path.abspath(path)
+        "存档路径"
+        self.pinned_histories: Set[str] = set(pinned_histories)
+        "一直留着的历史记录"
+        self.pinned: Dict[ObjectKey, ClassDataType] = {}
+        "一直留着的对象"
+        self.weak: "weakref.WeakValueDictionary[ObjectKey, ClassDataType]" = (
+            weakref.WeakValueDictionary()
+        )
+        "旧历史记录的对象（弱引用）"
+        self.recent: "OrderedDict[str, Dict[ObjectKey, ClassDataType]]" = OrderedDict()
+        "最近用过的旧历史记录的对象（强引用），最近用的在最后"
+        self.histories: "OrderedDict[str, History]" = OrderedDict()
+        "最近单独打开过的历史记录，最近用的在最后"
+        self.loading: Set[ObjectKey] = set()
+        "正在加载的对象"
+        self.hits = 0
+        "命中次数"
+        self.misses = 0
+        "没命中的次数"
+        self.evicted_histories = 0
+        "被挤出``recent``的历史记录数量"
+        self.lock = RLock()
+
+    @classmethod
+    def for_archive(
+        cls, path: str, pinned_histories: Iterable[str] = ("Current",)
+    ) -> "ObjectCache":
+        """
+        获取某个存档的缓存，没有就新建一个。
+
+        :param path: 存档路径
+        :param pinned_histories: 一直留着的历史记录（只有新建的时候有用）
+        :return: 缓存
+        """
+        path = os.path.abspath(path)
+        with cls.caches_lock:
+            if path not in cls.caches:
+                cls.caches[path] = cls(path, pinned_histories)
+            return cls.caches[path]
+
+    @classmethod
+    def discard_archive(cls, path: str) -> None:
+        "丢掉某个存档的缓存（存档被整个换掉之后调用）"
+        with cls.caches_lock:
+            cache = cls.caches.pop(os.path.abspath(path), None)
+        if cache is not None:
+            cache.clear()
+
+    @classmethod
+    def clear_all(cls) -> None:
+        "清空所有存档的缓存"
+        with cls.caches_lock:
+            caches = list(cls.caches.values())
+            cls.caches.clear()
+        for cache in caches:
+            cache.clear()
+
+    def __len__(self) -> int:
+        return len(self.pinned) + len(self.weak)
+
+    def get(self, key: ObjectKey) -> Optional[ClassDataType]:
+        """
+        从缓存里面拿对象。
+
+        :param key: 键
+        :return: 对象，没有就是None
+        """
+        if key[0] in self.pinned_histories:
+            obj = self.pinned.get(key)
+        else:
+            obj = self.weak.get(key)
+            if obj is not None:
+                self._touch(key, obj)
+        if obj is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return obj
+
+    def put(self, key: ObjectKey, obj: ClassDataType) -> None:
+        """
+        把对象放进缓存。
+
+        :param key: 键
+        :param obj: 对象
+        """
+        if key[0] in self.pinned_histories:
+            self.pinned[key] = obj
+        else:
+            self.weak[key] = obj
+            self._touch(key, obj)
+
+    def _touch(self, key: ObjectKey, obj: ClassDataType) -> None:
+        with self.lock:
+            bucket = self.recent.get(key[0])
+            if bucket is None:
+                bucket = self.recent[key[0]] = {}
+                while len(self.recent) > self.keep_histories:
+                    self.recent.popitem(last=False)
+                    self.evicted_histories += 1
+            else:
+                self.recent.move_to_end(key[0])
+            bucket[key] = obj
+
+    def get_history(self, history_uuid: UUIDKind[History]) -> Optional[History]:
+        """
+        拿最近打开过的历史记录。
+
+        :param history_uuid: 历史记录uuid
+        :return: 历史记录，没有就是None
+        """
+        with self.lock:
+            history = self.histories.get(history_uuid)
+            if history is not None:
+                self.histories.move_to_end(history_uuid)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return history
+
+    def put_history(self, history: History) -> None:
+        "记下打开过的历史记录，超过``keep_histories``个就把最早的挤掉"
+        with self.lock:
+            self.histories[history.uuid] = history
+            self.histories.move_to_end(history.uuid)
+            while len(self.histories) > self.keep_histories:
+                self.histories.popitem(last=False)
+
+    def discard_history(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> None:
+        "丢掉某个历史记录的对象（历史记录被删掉之后调用）"
+        with self.lock:
+            self.recent.pop(history_uuid, None)
+            self.histories.pop(history_uuid, None)
+            for key in [k for k in self.pinned if k[0] == history_uuid]:
+                del self.pinned[key]
+            for key in [k for k in list(self.weak.keys()) if k[0] == history_uuid]:
+                self.weak.pop(key, None)
+
+    def clear(self) -> None:
+        "清空缓存"
+        with self.lock:
+            self.pinned.clear()
+            self.weak.clear()
+            self.recent.clear()
+            self.histories.clear()
+            self.loading.clear()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        "统计信息"
+        total = self.hits + self.misses
+        return {
+            "size": len(self),
+            "pinned": len(self.pinned),
+            "weak": len(self.weak),
+            "recent_histories": len(self.recent),
+            "opened_histories": len(self.histories),
+            "loading": len(self.loading),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evicted_histories": self.evicted_histories,
+        }
+
+
 class DataObject:
     "数据对象"
 
@@ -210,40 +1057,22 @@ class DataObject:
     saved_objects = 0
     "保存了的对象数量"
 
-    cur_list: Dict[str, sqlite3.Cursor] = {}
-    "连接列表，conn_list[数据类型名称]=光标"
-
-    loaded_object_list: Dict[
-        Tuple[UUIDKind[History], str, UUIDKind[ClassDataType]], ClassDataType
-    ] = {}
-    "加载目标列表"
-
-    load_tasks: List[Tuple[UUIDKind[History], str, UUIDKind[ClassDataType]]] = []
-    "加载任务列表"
-
     @staticmethod
     def clear_tasks():
         "清空加载任务列表"
-        DataObject.load_tasks.clear()
+        with ObjectCache.caches_lock:
+            for cache in ObjectCache.caches.values():
+                cache.loading.clear()
 
     @staticmethod
     def clear_loaded_objects():
-        "清空加载对象列表"
-        DataObject.loaded_object_list.clear()
+        "清空加载对象列表（所有存档的对象缓存）"
+        ObjectCache.clear_all()
 
     @staticmethod
     def relase_connections(clear_chunk_connections: bool = True):
-        "释放所有连接"
-        for cur in DataObject.cur_list.values():
-            try:
-                cur.close()
-                cur.connection.commit()
-                cur.connection.close()
-            except sqlite3.Error:
-                pass
-        DataObject.cur_list.clear()
-        if clear_chunk_connections:
-            Chunk.relase_connections(False)
+        "释放所有连接（连接现在都在``Chunk.connections``里面，参数只是为了兼容）"
+        Chunk.connections.close_all()
 
     def __init__(
         self,
@@ -290,42 +1119,24 @@ class DataObject:
         path = path or self.chunk.path
         while max_retry:
             max_retry -= 1
-            if type_name not in self.cur_list:
-                conn = sqlite3.connect(
-                    os.path.join(path, f"{type_name}.db"), check_same_thread=False
-                )
-                cur = conn.cursor()
-                for i in range(16):
-                    prefix = f"{i:01x}"
-                    cur.execute(
-                        f"""CREATE TABLE IF NOT EXISTS datas_{prefix} (
-                                                uuid   text       primary key,    -- 数据UUID
-                                                class  text,                      -- 数据类型
-                                                data   text                       -- 数据
-                                        )"""
-                    )
-                conn.commit()
-                conn.close()
-                conn = sqlite3.connect(
-                    os.path.join(path, f"{type_name}.db"), check_same_thread=False
-                )  # 重新连接
-                self.cur_list[type_name] = conn.cursor()
-
-            cursor = self.cur_list[type_name]
+            conn = Chunk.connections.get(
+                os.path.join(path, f"{type_name}.db"), create_schema=True
+            )
+            cursor = conn.cursor()
 
             for i in range(3):
                 try:
 
                     cursor.execute(
-                        f"SELECT class FROM datas_{uuid[:1]} WHERE uuid = ?", (uuid,)
+                        "SELECT class FROM datas WHERE uuid = ?", (uuid,)
                     )
                     existing_class = cursor.fetchone()
 
                     if existing_class:
                         if existing_class[0] == type_name:
                             cursor.execute(
-                                f"""
-                                UPDATE datas_{uuid[:1]}
+                                """
+                                UPDATE datas
                                 SET class = ?, data = ?
                                 WHERE uuid = ?
                             """,
@@ -341,8 +1152,8 @@ class DataObject:
                             )
                     else:
                         cursor.execute(
-                            f"""
-                            INSERT INTO datas_{uuid[:1]} (uuid, class, data)
+                            """
+                            INSERT INTO datas (uuid, class, data)
                             VALUES (?, ?, ?)
                         """,
                             (uuid, type_name, string),
@@ -378,10 +1189,98 @@ class DataObject:
             )
             self.relase_connections()
 
+    @staticmethod
+    def save_many(
+        objects: Iterable[ClassDataType],
+        path: str,
+        max_retry: int = 3,
+        callback: Optional[Callable[[ClassDataType], Any]] = None,
+        codec: Optional[RecordCodec] = None,
+    ) -> int:
+        """
+        批量保存对象。
+
+        对象会按``chunk_type_name``分组，每个数据库文件只开一个事务，
+        用一次``executemany``写入（``INSERT ... ON CONFLICT(uuid) DO UPDATE``）。
+        连接从``Chunk.connections``里面拿，写完不会关掉。
+
+        :param objects: 需要保存的对象
+        :param path: 数据库所在的目录
+        :param max_retry: 最大重试次数
+        :param callback: 每序列化完一个对象之后的回调（用来更新进度条）
+        :param codec: 数据编码，不填就是json（``to_string()``）
+        :return: 保存的对象数量
+        :raise ValueError: 数据库里面已经有了一个uuid相同但类型不同的对象
+        """
+        grouped: Dict[str, List[Tuple[str, str, str]]] = {}
+        count = 0
+        for obj in objects:
+            type_name = obj.chunk_type_name
+            grouped.setdefault(type_name, []).append(
+                (
+                    obj.uuid,
+                    type_name,
+                    obj.to_string() if codec is None else codec.encode(obj.to_dict()),
+                )
+            )
+            count += 1
+            if callback is not None:
+                callback(obj)
+
+        for type_name, rows in grouped.items():
+            retry = max_retry
+            db_path = os.path.join(path, f"{type_name}.db")
+            while True:
+                try:
+                    with Chunk.connections.transaction(db_path) as conn:
+                        cursor = conn.executemany(
+                            """
+                        INSERT INTO datas (uuid, class, data)
+                        VALUES (?, ?, ?)
+                        ON CONFLICT(uuid) DO UPDATE
+                        SET class = excluded.class, data = excluded.data
+                        WHERE datas.class = excluded.class
+                    """,
+                            rows,
+                        )
+                        if cursor.rowcount != len(rows):
+                            # 有的行因为类型不一样没写进去，找出来是哪个
+                            for uuid, _, _ in rows:
+                                existing_class = conn.execute(
+                                    "SELECT class FROM datas WHERE uuid = ?",
+                                    (uuid,),
+                                ).fetchone()
+                                if existing_class and existing_class[0] != type_name:
+                                    raise ValueError(
+                                        f"对于{uuid!r}的对象，数据库中已经存在一个不同类型的对象！"
+                                        f"（当前为{type_name!r}，数据库中为{existing_class[0]!r}）"
+                                    )
+                    break
+                except sqlite3.Error as e:
+                    # 连接可能已经坏掉了，关掉下次重新开
+                    Chunk.connections.close(db_path)
+                    retry -= 1
+                    if retry <= 0:
+                        Base.log_exc(
+                            f"批量写入{type_name}时出现错误，重试{max_retry}次后仍然失败",
+                            "DataObject.save_many",
+                            "E",
+                        )
+                        raise
+                    Base.log_exc_short(
+                        f"批量写入{type_name}时出现错误，0.1秒后重试",
+                        "DataObject.save_many",
+                        "W",
+                        exc=e,
+                    )
+                    time.sleep(0.1)
+        DataObject.saved_objects += count
+        return count
+
     def load_stage1(self, data: str) -> ClassDataType:
         "从某个文件加载这个对象，阶段1 - 只加载基本数据"
 
-        data: Dict[str, Any] = json.loads(data)
+        data: Dict[str, Any] = decode_record(data)
 
         try:
             data_type = data.pop("type")  # 移除类型信息避免参数错误
@@ -551,167 +1450,2116 @@ def spilt_list(
 _DT = TypeVar("_DT")
 
 
-class Chunk:
-    "数据分组"
+def unique_objects(objects: Iterable[_DT], seen: Set[str]) -> List[_DT]:
+    """
+    按uuid去重，已经在``seen``里面的对象会被跳过。
 
-    database_connections: Dict[
-        Tuple[Union[UUIDKind[History], Literal["Current"]], str], sqlite3.Connection
-    ] = {}
-    "数据库连接池，database_connection[(历史记录uuid,数据类型名)] = sqlite3.Connection"
+    :param objects: 对象
+    :param seen: 已经出现过的uuid，会被更新
+    :return: 去重之后的对象
+    """
+    result = []
+    for obj in objects:
+        if obj.uuid not in seen:
+            seen.add(obj.uuid)
+            result.append(obj)
+    return result
 
-    loading_info: Dict[str, Any] = {}
-    "加载信息, 字典里面是啥自己开盲盒吧（懒得写了）"
 
-    save_task_mutex: Mutex = Mutex()
-    "保存任务互斥锁"
+def fsync_dir(path: str) -> None:
+    "把目录本身（里面的文件名）刷到磁盘上，改名之后要调用一下才算真的落盘，打不开目录的系统上跳过"
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
 
 
+def write_json_durable(path: str, value: Any) -> None:
+    """
+    写入json并fsync，函数返回之后文件就已经落盘了。
 
-    def __init__(self, path: str, bound_database: Optional[UserDataBase] = None):
-        self.path = path
-        self.bound_db = bound_database or UserDataBase()
-        self.is_saving = False
-        os.makedirs(
-            self.path if not path.endswith(".datas") else os.path.dirname(self.path),
-            exist_ok=True,
-        )
+    :param path: 文件路径
+    :param value: 能转成json的数据
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(value, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def write_json_atomic(path: str, value: Any) -> None:
+    """
+    原子地写入json：先写到``.tmp``并fsync，再改名换上去，中途断电也不会留下写了一半的文件。
+
+    :param path: 文件路径
+    :param value: 能转成json的数据
+    """
+    write_json_durable(path + ".tmp", value)
+    os.replace(path + ".tmp", path)
+    fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+class ScoreAggregate(NamedTuple):
+    "分数修改记录的统计结果"
+
+    count: int
+    "记录数量"
+    total: float
+    "总分数变化"
+    added: float
+    "加分总和"
+    deducted: float
+    "扣分总和（负数）"
+
+
+ScoreGroupBy = Literal["template", "student", "class", "history", "day", "week"]
+"分数统计可以按哪些东西分组，见``ArchiveStorage.score_group_keys``"
+
+ScoreColumnRow = Tuple[str, str, Optional[str], Optional[str], float, int, bool]
+"分数列存储的一行：(uuid, 学生uuid, 班级key, 模板key, 分数, 执行时间key, 是否已执行)"
+
+
+class HistoryEntry(NamedTuple):
+    "历史记录目录里面的一项，只从索引里面读，不加载对象"
+
+    uuid: str
+    "历史记录uuid"
+    time: float
+    "历史记录的时间"
+    save_time: float
+    "保存时间"
+    total_objects: int
+    "对象数量"
+    classes: Dict[str, str]
+    "班级，key -> 班级名（旧存档没记班级名，就是key -> key）"
+
+
+class ArchiveStorage:
+    """
+    存档存储后端。
+
+    ``Chunk``读写存档的时候只通过这里的方法，不直接碰文件，
+    这样存档是一个目录还是一个文件对``Chunk``来说都一样。
+
+    - ``DirectoryStorage``：原来的格式，每个历史记录一个目录，每个类型一个数据库，索引是json
+    - ``SingleFileStorage``：整个存档就是一个数据库文件
+    """
+
+    manifests: Tuple[str, ...] = (
+        "info",
+        "classes",
+        "weekdays",
+        "templates",
+        "achievements",
+        "current_day_attendance",
+    )
+    "每个历史记录里面的索引（原来的那几个json）"
+
+    shared_uuid: str = "Shared"
+    "整个存档共用的数据（分数修改模板和成就模板）所在的位置，历史记录里面只存它们的uuid"
+
+    shared_types: Tuple[str, ...] = ("ScoreModificationTemplate", "AchievementTemplate")
+    "存在共用位置里面的类型（旧的存档每个历史记录都存了一份，加载的时候两边都会找）"
+
+    busy_paths: Set[str] = set()
+    "这个进程正在写的存档（绝对路径），打开的时候不会去动它们的日志"
+
+    def __init__(self, path: str):
+        self.path = path
+        "存档路径"
+        self.score_columns_ready = False
+        "分数列存储的表是否已经建好"
+        self.objects_ready = False
+        "按内容寻址的对象表是否已经建好"
+        self.deferred_manifests = False
+        "索引是否先写临时文件，等数据库提交之后再换上去（``atomic_save``期间）"
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path!r})"
+
+    @staticmethod
+    def open(path: str) -> "ArchiveStorage":
+        """
+        按路径选一个存储后端，``.db``结尾或者已经是一个文件的用单文件存档，其他的用目录存档。
+
+        上次保存中断留下的日志会在这里处理（见``recover``）。
+
+        :param path: 存档路径
+        :return: 存储后端
+        """
+        if path.endswith(SingleFileStorage.suffix) or os.path.isfile(path):
+            storage_type = SingleFileStorage
+        else:
+            storage_type = DirectoryStorage
+        storage_type.recover(path)
+        return storage_type(path)
+
+    @staticmethod
+    def journal_file(path: str) -> str:
+        "存档的日志文件，放在存档旁边（目录存档整个换掉的时候日志不能跟着一起换）"
+        return os.path.abspath(path) + ".journal"
+
+    @staticmethod
+    def backup_path(path: str) -> str:
+        "整个替换存档的时候原来的存档暂时放的位置"
+        return os.path.abspath(path) + ".old"
+
+    @classmethod
+    def staging_path(cls, path: str) -> str:
+        "整个重写存档的时候新存档先写到的位置"
+        return os.path.abspath(path) + ".staging"
+
+    @classmethod
+    def archive_exists(cls, path: str) -> bool:
+        "某个路径上有没有这种存档"
+        return os.path.exists(path)
+
+    @classmethod
+    def remove_archive(cls, path: str) -> None:
+        "删掉某个路径上的存档（连接会先关掉）"
+        Chunk.connections.close(path)
+
+    @classmethod
+    def move_archive(cls, source: str, target: str) -> None:
+        "把存档挪到另一个路径上，目标不能已经存在"
+        Chunk.connections.close(source)
+        os.replace(source, target)
+
+    @classmethod
+    def copy_archive(cls, source: str, target: str) -> None:
+        "把存档复制到另一个路径上，目标不能已经存在"
+        raise NotImplementedError
+
+    undo_writes: bool = False
+    "``atomic_save``的时候数据库是不是要记撤销日志（有好几个数据库文件的时候才要，见``ConnectionManager.batch``）"
+
+    def forget_schema(self) -> None:
+        "忘掉已经建好的表（事务回滚或者存档被换掉之后调用）"
+        self.score_columns_ready = False
+        self.objects_ready = False
+
+    def resolve_journal(self, journal: Dict[str, Any]) -> bool:
+        """
+        看日志对应的那次保存是该做完还是该回滚。
+
+        还没到``committing``的话数据库都没提交，只能回滚。
+        到了的话记撤销日志的存档要看日志里面的每个数据库（``files``）最后提交的是不是这次保存（``generation``）：
+        都是的话就做完；只有一部分是的话用撤销日志把这一部分撤销掉，然后回滚。
+
+        :param journal: 日志
+        :return: True就是做完，False就是回滚
+        """
+        if journal.get("state") != "committing":
+            return False
+        generation = journal.get("generation")
+        if generation is None:
+            return True
+        files = journal.get("files", [])
+        committed = [p for p in files if Chunk.connections.generation(p) == generation]
+        if len(committed) == len(files):
+            return True
+        for db_path in committed:
+            Chunk.connections.revert(db_path, generation)
+        Base.log(
+            "W",
+            f"{len(files)}个数据库只提交了{len(committed)}个，已经撤销",
+            "ArchiveStorage.resolve_journal",
+        )
+        return False
+
+    def finish_journal(self, journal: Dict[str, Any], commit: bool) -> None:
+        """
+        处理日志里面记的还没换上去的索引。
+
+        :param journal: 日志
+        :param commit: True就是继续做完（换上去），False就是回滚（删掉）
+        """
+
+    @contextmanager
+    def atomic_save(
+        self,
+        history_uuids: Iterable[
+            Optional[Union[UUIDKind[History], Literal["Current"]]]
+        ],
+    ):
+        """
+        原子保存：里面的写入要么全部生效，要么都不生效。
+
+        开始之前先写日志（``<存档>.journal``），数据库的写事务合并到最后一起提交
+        （``ConnectionManager.batch``，目录存档还会记撤销日志），索引先写临时文件，数据库提交完再改名换上去。
+        开始提交之前日志会改成``committing``，并记下这次写了哪些数据库（``files``）。
+        程序崩溃或者断电之后，下次打开存档的时候按日志回滚或者做完，见``resolve_journal``和``recover``。
+
+        >>> with storage.atomic_save(["Current", None]):
+        ...     storage.write_objects("Current", objects)
+        ...     storage.write_meta(None, "info", info)
+
+        :param history_uuids: 会写到的历史记录，None是存档根目录
+        """
+        path = os.path.abspath(self.path)
+        journal_path = self.journal_file(self.path)
+        journal = {
+            "state": "writing",
+            "time": time.time(),
+            "histories": list(dict.fromkeys(history_uuids)),
+            "generation": time.time_ns() if self.undo_writes else None,
+        }
+
+        def _committing(files: List[str]):
+            journal["state"] = "committing"
+            journal["files"] = files
+            write_json_atomic(journal_path, journal)
+
+        busy = path in ArchiveStorage.busy_paths
+        ArchiveStorage.busy_paths.add(path)
+        try:
+            write_json_atomic(journal_path, journal)
+            self.deferred_manifests = True
+            try:
+                with Chunk.connections.batch(_committing, journal["generation"]):
+                    yield
+            except BaseException:
+                self.deferred_manifests = False
+                self.forget_schema()
+                # 提交到一半出错的话已经提交了的数据库要撤销掉；
+                # 撤销不了的话日志留着，下次打开的时候再接着做
+                self.finish_journal(journal, self.resolve_journal(journal))
+                os.remove(journal_path)
+                raise
+            self.deferred_manifests = False
+            self.finish_journal(journal, True)
+            os.remove(journal_path)
+        finally:
+            if not busy:
+                ArchiveStorage.busy_paths.discard(path)
+
+    @classmethod
+    def recover(cls, path: str) -> Optional[str]:
+        """
+        检查上次写这个存档的时候有没有中断，有的话按日志处理：
+
+        - ``writing``：还没开始提交，数据库里面没提交的事务SQLite自己会丢掉，
+          这里删掉临时索引和写了一半的历史记录
+        - ``committing``：已经开始提交了，数据库都提交完了的话把临时索引换上去，
+          只提交了一部分的话撤销掉已经提交的，然后跟``writing``一样回滚（见``resolve_journal``）
+        - ``replacing``：新存档已经完整写好了，接着把它换过来
+        - 没有日志但是有临时存档：整个重写的时候中断了，删掉临时存档，原来的存档没动过
+
+        :param path: 存档路径
+        :return: 做了什么（``rollback``或者``roll_forward``），什么都没做就是None
+        """
+        if os.path.abspath(path) in ArchiveStorage.busy_paths:
+            return None
+        journal_path = cls.journal_file(path)
+        staging = cls.staging_path(path)
+        action = None
+        if os.path.isfile(journal_path):
+            try:
+                with open(journal_path, "r", encoding="utf-8") as f:
+                    journal = json.load(f)
+            except (OSError, ValueError):
+                # 日志是原子写的，读不出来只可能是别的问题，按没提交处理
+                journal = {"state": "writing", "histories": []}
+            if journal.get("state") == "replacing":
+                cls.finish_replace(path, staging)
+                action = "roll_forward"
+            else:
+                storage = cls(path)
+                commit = storage.resolve_journal(journal)
+                action = "roll_forward" if commit else "rollback"
+                storage.finish_journal(journal, commit)
+            os.remove(journal_path)
+        if cls.archive_exists(staging):
+            cls.remove_archive(staging)
+            action = action or "rollback"
+        if os.path.isfile(cls.journal_file(staging)):
+            os.remove(cls.journal_file(staging))
+        if action is not None:
+            Base.log("W", f"存档{path}上次保存中断，已处理（{action}）", "ArchiveStorage.recover")
+        return action
+
+    @classmethod
+    def finish_replace(cls, path: str, staging: str) -> None:
+        """
+        把写好的临时存档换过来（中断之后再调用也能接着做完）。
+
+        :param path: 存档路径
+        :param staging: 临时存档路径
+        """
+        backup = cls.backup_path(path)
+        if cls.archive_exists(staging):
+            if cls.archive_exists(path):
+                if cls.archive_exists(backup):
+                    cls.remove_archive(backup)
+                cls.move_archive(path, backup)
+            cls.move_archive(staging, path)
+            fsync_dir(os.path.dirname(os.path.abspath(path)))
+        if cls.archive_exists(backup):
+            cls.remove_archive(backup)
+
+    def staging(self) -> "ArchiveStorage":
+        """
+        在存档旁边建一个空的临时存档，写完之后用``replace_with``整个换过来，
+        出错了用``discard_staging``丢掉，原来的存档在换过来之前一直是完整的。
+
+        :return: 临时存档
+        """
+        ArchiveStorage.busy_paths.add(os.path.abspath(self.path))
+        path = self.staging_path(self.path)
+        if self.archive_exists(path):
+            self.remove_archive(path)
+        return type(self)(path)
+
+    def discard_staging(self, staging: "ArchiveStorage") -> None:
+        "丢掉``staging``建的临时存档"
+        self.remove_archive(staging.path)
+        ArchiveStorage.busy_paths.discard(os.path.abspath(self.path))
+
+    def replace_with(self, staging: "ArchiveStorage") -> None:
+        """
+        用临时存档整个替换这个存档。
+
+        先写日志再挪文件，中途断电的话下次打开的时候会接着换完。
+
+        :param staging: ``staging``建的临时存档，已经完整写好了
+        """
+        journal_path = self.journal_file(self.path)
+        staging.close()
+        self.close()
+        try:
+            write_json_atomic(
+                journal_path,
+                {"state": "replacing", "time": time.time(), "staging": staging.path},
+            )
+            self.finish_replace(self.path, staging.path)
+            os.remove(journal_path)
+        finally:
+            ArchiveStorage.busy_paths.discard(os.path.abspath(self.path))
+        self.forget_schema()
+
+    def restore_from(
+        self,
+        source: str,
+        copy_function: Optional[Callable[[str, str], Any]] = None,
+    ) -> None:
+        """
+        用另一个同样格式的存档（比如还原点里面的）整个替换这个存档。
+
+        :param source: 另一个存档的路径
+        :param copy_function: 把source复制到临时存档的函数，参数是(source, 临时存档路径)，
+            不填就是``copy_archive``（还原点用``utils.recovery.restore_snapshot``，没变过的文件直接链接）
+        """
+        staging = self.staging()
+        try:
+            # 复制的时候可能会直接链接现在存档里面的文件，连接得先关掉，不然WAL还没合并回去
+            self.close()
+            Chunk.connections.close(source)
+            self.remove_archive(staging.path)
+            (copy_function or self.copy_archive)(source, staging.path)
+        except BaseException:
+            self.discard_staging(staging)
+            raise
+        self.replace_with(staging)
+        # 内容整个换了，之前加载出来的对象都不对了
+        ObjectCache.discard_archive(self.path)
+
+    def read_rows(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]], data_type: str
+    ) -> Dict[str, Union[str, bytes]]:
+        """
+        读取某个历史记录中某个类型的所有数据。
+
+        :param history_uuid: 历史记录uuid
+        :param data_type: 数据类型名
+        :return: uuid到数据的映射，没有数据就是空的
+        """
+        raise NotImplementedError
+
+    def read_row(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        data_type: str,
+        uuid: str,
+    ) -> Optional[Union[str, bytes]]:
+        """
+        读取一个对象的数据。
+
+        :param history_uuid: 历史记录uuid
+        :param data_type: 数据类型名
+        :param uuid: 对象uuid
+        :return: 数据，不存在就是None
+        """
+        raise NotImplementedError
+
+    def data_types(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> List[str]:
+        "某个历史记录里面存了哪些类型"
+        raise NotImplementedError
+
+    def write_objects(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        objects: Iterable[ClassDataType],
+        callback: Optional[Callable[[ClassDataType], Any]] = None,
+        codec: Optional[RecordCodec] = None,
+    ) -> int:
+        """
+        写入对象，已经存在的会被覆盖。
+
+        :param history_uuid: 历史记录uuid
+        :param objects: 对象
+        :param callback: 每序列化完一个对象之后的回调
+        :param codec: 数据编码，不填就是json
+        :return: 写入的对象数量
+        """
+        raise NotImplementedError
+
+    def read_meta(
+        self,
+        history_uuid: Optional[Union[UUIDKind[History], Literal["Current"]]],
+        name: str,
+    ) -> Any:
+        """
+        读取索引。
+
+        :param history_uuid: 历史记录uuid，None就是整个存档的信息（只有``info``）
+        :param name: 索引名称
+        :raise FileNotFoundError: 索引不存在
+        """
+        raise NotImplementedError
+
+    def write_meta(
+        self,
+        history_uuid: Optional[Union[UUIDKind[History], Literal["Current"]]],
+        name: str,
+        value: Any,
+    ) -> None:
+        """
+        写入索引。
+
+        :param history_uuid: 历史记录uuid，None就是整个存档的信息
+        :param name: 索引名称
+        :param value: 能转成json的数据
+        """
+        raise NotImplementedError
+
+    def has_history(self, history_uuid: UUIDKind[History]) -> bool:
+        "历史记录是否已经完整保存过"
+        raise NotImplementedError
+
+    def list_histories(self) -> List[UUIDKind[History]]:
+        "存档里面所有历史记录的uuid（不包括Current）"
+        raise NotImplementedError
+
+    def prepare_history(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> None:
+        "写入某个历史记录之前调用"
+
+    def clear_history(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> None:
+        "清空某个历史记录"
+        raise NotImplementedError
+
+    def del_history(self, history_uuid: UUIDKind[History]) -> None:
+        "删除某个历史记录"
+        self.clear_history(history_uuid)
+
+    def clear_histories(self) -> None:
+        "删除所有历史记录（不包括Current）"
+        for history_uuid in self.list_histories():
+            self.clear_history(history_uuid)
+
+    def clear_all(self) -> None:
+        "清空整个存档"
+        raise NotImplementedError
+
+    def checkpoint(self) -> None:
+        "把还没合并的WAL合并回数据库文件"
+        Chunk.connections.checkpoint(self.path, "TRUNCATE")
+
+    def close(self) -> None:
+        "关闭这个存档的所有连接"
+        Chunk.connections.close(self.path)
+
+    content_addressed: bool = True
+    "历史记录是否按内容寻址保存（没改过的对象在不同的历史记录之间只存一份）"
+
+    def objects_path(self) -> str:
+        "按内容寻址的对象表所在的数据库文件"
+        raise NotImplementedError
+
+    def objects_connection(self) -> sqlite3.Connection:
+        """
+        获取按内容寻址的对象表的连接，第一次用的时候会建好表：
+
+        - ``object_blobs``：数据本身，主键是数据的哈希
+        - ``object_keys``：用到的uuid和类型名，每个对应一个整数编号
+        - ``history_index``：每个历史记录里面有哪些对象，全用编号，只记哈希
+
+        以前的``history_objects``（直接用uuid和类型名做主键）碰到的话会在这里转成编号（只做一次）。
+        """
+        path = self.objects_path()
+        if not self.objects_ready:
+            with Chunk.connections.transaction(path, create_schema=False) as conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS object_blobs (
+                                                hash  blob  primary key,           -- 数据的哈希
+                                                data  text                         -- 数据
+                                        ) WITHOUT ROWID"""
+                )
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS object_keys (
+                                                id   integer  primary key,        -- 编号
+                                                key  text     not null unique     -- uuid或者类型名
+                                        )"""
+                )
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS history_index (
+                                                history_id  integer  not null,    -- 历史记录uuid的编号
+                                                type_id     integer  not null,    -- 数据类型名的编号
+                                                object_id   integer  not null,    -- 数据UUID的编号
+                                                hash        blob     not null,    -- 数据的哈希
+                                                primary key (history_id, type_id, object_id)
+                                        ) WITHOUT ROWID"""
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_history_index_hash "
+                    "ON history_index (hash)"
+                )
+                if conn.execute(
+                    "SELECT 1 FROM sqlite_master "
+                    "WHERE type = 'table' AND name = 'history_objects'"
+                ).fetchone():
+                    self._migrate_history_objects(conn)
+            self.objects_ready = True
+        return Chunk.connections.get(path)
+
+    @staticmethod
+    def _migrate_history_objects(conn: sqlite3.Connection) -> None:
+        "把旧的``history_objects``转成``object_keys``加``history_index``"
+        for column in ("history_uuid", "data_type", "uuid"):
+            conn.execute(
+                f"INSERT OR IGNORE INTO object_keys (key) "
+                f"SELECT DISTINCT {column} FROM history_objects"
+            )
+        count = conn.execute(
+            "INSERT OR REPLACE INTO history_index "
+            "(history_id, type_id, object_id, hash) "
+            "SELECT h.id, t.id, o.id, old.hash FROM history_objects old "
+            "JOIN object_keys h ON h.key = old.history_uuid "
+            "JOIN object_keys t ON t.key = old.data_type "
+            "JOIN object_keys o ON o.key = old.uuid"
+        ).rowcount
+        # 先删数据，合并提交的撤销日志才记得下来（见ConnectionManager.batch）
+        conn.execute("DELETE FROM history_objects")
+        conn.execute("DROP TABLE history_objects")
+        Base.log(
+            "I",
+            f"旧的历史记录索引已经转换完成，共{count}行",
+            "ArchiveStorage.objects_connection",
+        )
+
+    def is_content_addressed(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> bool:
+        "写入这个历史记录的时候是否按内容寻址（Current经常改，还是直接存）"
+        return self.content_addressed and history_uuid not in (
+            "Current",
+            self.shared_uuid,
+        )
+
+    def _has_history_objects(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> bool:
+        if history_uuid in ("Current", self.shared_uuid):
+            return False
+        path = self.objects_path()
+        return path in Chunk.connections or os.path.isfile(path)
+
+    @staticmethod
+    def content_hash(data: Union[str, bytes]) -> bytes:
+        "数据的哈希（16字节的blake2b）"
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    @staticmethod
+    def encode_objects(
+        objects: Iterable[ClassDataType],
+        callback: Optional[Callable[[ClassDataType], Any]] = None,
+        codec: Optional[RecordCodec] = None,
+    ) -> Tuple[Dict[str, List[Tuple[str, Union[str, bytes]]]], int]:
+        """
+        序列化对象，按类型分好。
+
+        :param objects: 对象
+        :param callback: 每序列化完一个对象之后的回调
+        :param codec: 数据编码，不填就是json
+        :return: (类型名到(uuid, 数据)列表的映射, 对象数量)
+        """
+        grouped: Dict[str, List[Tuple[str, Union[str, bytes]]]] = {}
+        count = 0
+        for obj in objects:
+            grouped.setdefault(obj.chunk_type_name, []).append(
+                (
+                    obj.uuid,
+                    obj.to_string() if codec is None else codec.encode(obj.to_dict()),
+                )
+            )
+            count += 1
+            if callback is not None:
+                callback(obj)
+        return grouped, count
+
+    def write_history_rows(
+        self,
+        history_uuid: UUIDKind[History],
+        data_type: str,
+        rows: Iterable[Tuple[str, Union[str, bytes]]],
+    ) -> int:
+        """
+        按内容寻址写入原始数据，内容一样的数据只会存一份。
+
+        :param history_uuid: 历史记录uuid
+        :param data_type: 数据类型名
+        :param rows: (uuid, 数据)
+        :return: 写入的行数
+        """
+        hashed = [(uuid, data, self.content_hash(data)) for uuid, data in rows]
+        self.objects_connection()
+        with Chunk.connections.transaction(
+            self.objects_path(), create_schema=False
+        ) as conn:
+            added = conn.executemany(
+                "INSERT OR IGNORE INTO object_blobs (hash, data) VALUES (?, ?)",
+                ((h, data) for _, data, h in hashed),
+            ).rowcount
+            conn.executemany(
+                "INSERT OR IGNORE INTO object_keys (key) VALUES (?)",
+                [(history_uuid,), (data_type,)] + [(uuid,) for uuid, _, _ in hashed],
+            )
+            history_id = self._key_id(conn, history_uuid)
+            type_id = self._key_id(conn, data_type)
+            conn.executemany(
+                "INSERT OR REPLACE INTO history_index "
+                "(history_id, type_id, object_id, hash) "
+                "VALUES (?, ?, (SELECT id FROM object_keys WHERE key = ?), ?)",
+                ((history_id, type_id, uuid, h) for uuid, _, h in hashed),
+            )
+        Base.log(
+            "D",
+            f"历史记录{history_uuid}的{data_type}写入完成，"
+            f"共{len(hashed)}个，其中新的内容{added}个",
+            "ArchiveStorage.write_history_rows",
+        )
+        return len(hashed)
+
+    def write_history_objects(
+        self,
+        history_uuid: UUIDKind[History],
+        objects: Iterable[ClassDataType],
+        callback: Optional[Callable[[ClassDataType], Any]] = None,
+        codec: Optional[RecordCodec] = None,
+    ) -> int:
+        "按内容寻址写入对象，参数和``write_objects``一样"
+        grouped, count = self.encode_objects(objects, callback, codec)
+        for type_name, rows in grouped.items():
+            self.write_history_rows(history_uuid, type_name, rows)
+        DataObject.saved_objects += count
+        return count
+
+    @staticmethod
+    def _key_id(conn: sqlite3.Connection, key: str) -> Optional[int]:
+        "uuid或者类型名的编号，没有就是None"
+        result = conn.execute(
+            "SELECT id FROM object_keys WHERE key = ?", (key,)
+        ).fetchone()
+        return None if result is None else result[0]
+
+    def read_history_rows(
+        self, history_uuid: UUIDKind[History], data_type: str
+    ) -> Dict[str, Union[str, bytes]]:
+        "读取某个历史记录中按内容寻址保存的某个类型的所有数据"
+        if not self._has_history_objects(history_uuid):
+            return {}
+        self.objects_connection()
+        with Chunk.connections.reading(self.objects_path()) as conn:
+            return dict(
+                conn.execute(
+                    "SELECT o.key, b.data FROM history_index h "
+                    "JOIN object_keys o ON o.id = h.object_id "
+                    "JOIN object_blobs b ON b.hash = h.hash "
+                    "WHERE h.history_id = (SELECT id FROM object_keys WHERE key = ?) "
+                    "AND h.type_id = (SELECT id FROM object_keys WHERE key = ?)",
+                    (history_uuid, data_type),
+                )
+            )
+
+    def read_history_row(
+        self, history_uuid: UUIDKind[History], data_type: str, uuid: str
+    ) -> Optional[Union[str, bytes]]:
+        "读取一个按内容寻址保存的对象的数据"
+        if not self._has_history_objects(history_uuid):
+            return None
+        self.objects_connection()
+        with Chunk.connections.reading(self.objects_path()) as conn:
+            result = conn.execute(
+                "SELECT b.data FROM history_index h "
+                "JOIN object_blobs b ON b.hash = h.hash "
+                "WHERE h.history_id = (SELECT id FROM object_keys WHERE key = ?) "
+                "AND h.type_id = (SELECT id FROM object_keys WHERE key = ?) "
+                "AND h.object_id = (SELECT id FROM object_keys WHERE key = ?)",
+                (history_uuid, data_type, uuid),
+            ).fetchone()
+        return None if result is None else result[0]
+
+    def history_object_types(self, history_uuid: UUIDKind[History]) -> List[str]:
+        "某个历史记录里面按内容寻址保存了哪些类型"
+        if not self._has_history_objects(history_uuid):
+            return []
+        self.objects_connection()
+        with Chunk.connections.reading(self.objects_path()) as conn:
+            return [
+                t
+                for (t,) in conn.execute(
+                    "SELECT t.key FROM object_keys t WHERE t.id IN ("
+                    "SELECT DISTINCT type_id FROM history_index "
+                    "WHERE history_id = (SELECT id FROM object_keys WHERE key = ?))",
+                    (history_uuid,),
+                )
+            ]
+
+    def clear_history_objects(
+        self, history_uuid: Optional[UUIDKind[History]] = None
+    ) -> None:
+        """
+        删掉按内容寻址保存的历史记录，没有历史记录再用的数据和编号也会一起删掉。
+
+        :param history_uuid: 历史记录uuid，None就是全部
+        """
+        path = self.objects_path()
+        if not (path in Chunk.connections or os.path.isfile(path)):
+            return
+        self.objects_connection()
+        with Chunk.connections.transaction(path, create_schema=False) as conn:
+            if history_uuid is None:
+                conn.execute("DELETE FROM history_index")
+                conn.execute("DELETE FROM object_blobs")
+                conn.execute("DELETE FROM object_keys")
+                return
+            history_id = self._key_id(conn, history_uuid)
+            if history_id is None:
+                return
+            conn.execute(
+                "DELETE FROM history_index WHERE history_id = ?", (history_id,)
+            )
+            conn.execute(
+                "DELETE FROM object_blobs WHERE NOT EXISTS "
+                "(SELECT 1 FROM history_index h WHERE h.hash = object_blobs.hash)"
+            )
+            conn.execute(
+                "DELETE FROM object_keys WHERE id NOT IN "
+                "(SELECT history_id FROM history_index UNION "
+                "SELECT type_id FROM history_index UNION "
+                "SELECT object_id FROM history_index)"
+            )
+
+    score_columns_version: int = 1
+    "分数列存储的格式版本"
+
+    score_group_keys: Dict[str, str] = {
+        "template": "template",
+        "student": "student",
+        "class": "class_key",
+        "history": "history_uuid",
+        "day": "date(execute_time_key / 1000.0, 'unixepoch', 'localtime')",
+        "week": "strftime('%Y-W%W', execute_time_key / 1000.0, 'unixepoch', 'localtime')",
+    }
+    "分数统计可以按哪些东西分组（对应的SQL表达式）"
+
+    def score_columns_path(self) -> str:
+        "分数列存储所在的数据库文件"
+        raise NotImplementedError
+
+    def _has_score_columns_db(self) -> bool:
+        path = self.score_columns_path()
+        return path in Chunk.connections or os.path.isfile(path)
+
+    def score_columns_connection(self) -> sqlite3.Connection:
+        "获取分数列存储的连接，第一次用的时候会建好表"
+        path = self.score_columns_path()
+        if not self.score_columns_ready:
+            with Chunk.connections.transaction(path, create_schema=False) as conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS score_columns (
+                                                history_uuid      text  not null,  -- 历史记录uuid
+                                                uuid              text  not null,  -- 分数修改记录uuid
+                                                student           text,            -- 学生uuid
+                                                class_key         text,            -- 班级key
+                                                template          text,            -- 模板key
+                                                mod               real,            -- 分数
+                                                execute_time_key  integer,         -- 执行时间（毫秒时间戳）
+                                                executed          integer,         -- 是否已执行
+                                                primary key (history_uuid, uuid)
+                                        ) WITHOUT ROWID"""
+                )
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS score_column_histories (
+                                                history_uuid  text  primary key,   -- 历史记录uuid
+                                                version       integer              -- 格式版本
+                                        )"""
+                )
+                for column in ("template", "student", "class_key", "execute_time_key"):
+                    conn.execute(
+                        f"CREATE INDEX IF NOT EXISTS idx_score_columns_{column} "
+                        f"ON score_columns ({column})"
+                    )
+            self.score_columns_ready = True
+        return Chunk.connections.get(path)
+
+    def has_score_columns(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> bool:
+        "某个历史记录的分数列存储是否完整"
+        if not self._has_score_columns_db():
+            return False
+        return (
+            self.score_columns_connection()
+            .execute(
+                "SELECT 1 FROM score_column_histories "
+                "WHERE history_uuid = ? AND version = ?",
+                (history_uuid, self.score_columns_version),
+            )
+            .fetchone()
+            is not None
+        )
+
+    def write_score_columns(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        rows: Iterable[ScoreColumnRow],
+        replace: bool = False,
+    ) -> int:
+        """
+        写入分数列存储，uuid相同的会被覆盖。
+
+        :param history_uuid: 历史记录uuid
+        :param rows: 要写入的行
+        :param replace: 是否先清掉这个历史记录原来的行（写完之后这个历史记录就算是完整的）
+        :return: 写入的行数
+        """
+        self.score_columns_connection()
+        with Chunk.connections.transaction(
+            self.score_columns_path(), create_schema=False
+        ) as conn:
+            if replace:
+                conn.execute(
+                    "DELETE FROM score_columns WHERE history_uuid = ?", (history_uuid,)
+                )
+            cursor = conn.executemany(
+                "INSERT OR REPLACE INTO score_columns (history_uuid, uuid, student, "
+                "class_key, template, mod, execute_time_key, executed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((history_uuid,) + tuple(row) for row in rows),
+            )
+            if replace:
+                conn.execute(
+                    "INSERT OR REPLACE INTO score_column_histories (history_uuid, version) "
+                    "VALUES (?, ?)",
+                    (history_uuid, self.score_columns_version),
+                )
+            return cursor.rowcount
+
+    def read_score_columns(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> List[ScoreColumnRow]:
+        "读取某个历史记录的分数列存储"
+        if not self._has_score_columns_db():
+            return []
+        return (
+            self.score_columns_connection()
+            .execute(
+                "SELECT uuid, student, class_key, template, mod, execute_time_key, "
+                "executed FROM score_columns WHERE history_uuid = ?",
+                (history_uuid,),
+            )
+            .fetchall()
+        )
+
+    def clear_score_columns(
+        self,
+        history_uuid: Optional[Union[UUIDKind[History], Literal["Current"]]] = None,
+    ) -> None:
+        """
+        清掉分数列存储。
+
+        :param history_uuid: 历史记录uuid，None就是除了Current之外的所有历史记录
+        """
+        if not self._has_score_columns_db():
+            return
+        self.score_columns_connection()
+        with Chunk.connections.transaction(
+            self.score_columns_path(), create_schema=False
+        ) as conn:
+            for table in ("score_columns", "score_column_histories"):
+                if history_uuid is None:
+                    conn.execute(
+                        f"DELETE FROM {table} WHERE history_uuid != 'Current'"
+                    )
+                else:
+                    conn.execute(
+                        f"DELETE FROM {table} WHERE history_uuid = ?", (history_uuid,)
+                    )
+
+    def aggregate_scores(
+        self,
+        group_by: ScoreGroupBy,
+        history_uuids: Optional[
+            Iterable[Union[UUIDKind[History], Literal["Current"]]]
+        ] = None,
+        class_key: Optional[str] = None,
+        student: Optional[str] = None,
+        template: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        executed_only: bool = True,
+    ) -> Dict[Any, ScoreAggregate]:
+        """
+        按分数列存储统计分数修改记录，不用加载任何``ScoreModification``。
+
+        :param group_by: 分组方式，``day``是``YYYY-MM-DD``，``week``是``YYYY-Www``（本地时间）
+        :param history_uuids: 只统计这些历史记录，None就是全部
+        :param class_key: 只统计这个班级
+        :param student: 只统计这个学生（uuid）
+        :param template: 只统计这个模板（key）
+        :param since: 执行时间下限（时间戳，秒，包含）
+        :param until: 执行时间上限（时间戳，秒，不包含）
+        :param executed_only: 是否只统计已经执行的
+        :return: 分组的值到统计结果的映射
+        :raise ValueError: 分组方式不对
+        """
+        if group_by not in self.score_group_keys:
+            raise ValueError(f"不支持的分组方式：{group_by}")
+        if not self._has_score_columns_db():
+            return {}
+        conditions: List[str] = []
+        params: List[Any] = []
+        if history_uuids is not None:
+            history_uuids = list(history_uuids)
+            if not history_uuids:
+                return {}
+            conditions.append(
+                f"history_uuid IN ({', '.join('?' * len(history_uuids))})"
+            )
+            params.extend(history_uuids)
+        for column, value in (
+            ("class_key", class_key),
+            ("student", student),
+            ("template", template),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("execute_time_key >= ?")
+            params.append(int(since * 1000))
+        if until is not None:
+            conditions.append("execute_time_key < ?")
+            params.append(int(until * 1000))
+        if executed_only:
+            conditions.append("executed")
+        key = self.score_group_keys[group_by]
+        return {
+            row[0]: ScoreAggregate(*row[1:])
+            for row in self.score_columns_connection().execute(
+                f"SELECT {key}, COUNT(*), TOTAL(mod), "
+                "TOTAL(CASE WHEN mod > 0 THEN mod END), "
+                "TOTAL(CASE WHEN mod < 0 THEN mod END) FROM score_columns"
+                + (" WHERE " + " AND ".join(conditions) if conditions else "")
+                + f" GROUP BY {key}",
+                params,
+            )
+        }
+
+
+class DirectoryStorage(ArchiveStorage):
+    """
+    目录存档，也就是原来的格式::
+
+        <存档>/info.json
+        <存档>/Current/{类型}.db, info.json, classes.json, ...
+        <存档>/Histories/xx/yyyy/{类型}.db, info.json, ...
+
+    每个数据库里面只有一张``datas``表，主键是整数行号，uuid上面有唯一索引
+    （以前按uuid的第一个字符分成16张``datas_{0-f}``分表，打开的时候会自动合并）。
+    """
+
+    undo_writes: bool = True
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        os.makedirs(
+            self.path if not path.endswith(".datas") else os.path.dirname(self.path),
+            exist_ok=True,
+        )
+
+    def history_path(
+        self, history_uuid: Optional[Union[UUIDKind[History], Literal["Current"]]]
+    ) -> str:
+        "获取历史记录所在的目录，None就是存档的根目录"
+        if history_uuid is None:
+            return self.path
+        if history_uuid in ("Current", self.shared_uuid):
+            return os.path.join(self.path, history_uuid)
+        return os.path.join(self.path, "Histories", history_uuid[:2], history_uuid[2:])
+
+    def score_columns_path(self) -> str:
+        return os.path.join(self.path, "score_columns.db")
+
+    def objects_path(self) -> str:
+        return os.path.join(self.path, "objects.db")
+
+    @classmethod
+    def archive_exists(cls, path: str) -> bool:
+        return os.path.isdir(path)
+
+    @classmethod
+    def remove_archive(cls, path: str) -> None:
+        Chunk.connections.close(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    @classmethod
+    def copy_archive(cls, source: str, target: str) -> None:
+        Chunk.connections.close(source)
+        shutil.copytree(source, target)
+
+    def finish_journal(self, journal: Dict[str, Any], commit: bool) -> None:
+        for history_uuid in dict.fromkeys([None] + journal.get("histories", [])):
+            path = self.history_path(history_uuid)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if name.endswith(".json.tmp"):
+                    tmp = os.path.join(path, name)
+                    if commit:
+                        os.replace(tmp, tmp[: -len(".tmp")])
+                    else:
+                        os.remove(tmp)
+            if (
+                not commit
+                and history_uuid not in (None, "Current", self.shared_uuid)
+                and not os.path.isfile(os.path.join(path, "info.json"))
+            ):
+                # 这次才开始写的历史记录，数据库里面没提交的数据已经没了，目录也删掉
+                Chunk.connections.close(path)
+                shutil.rmtree(path, ignore_errors=True)
+            fsync_dir(path)
+
+    def read_rows(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]], data_type: str
+    ) -> Dict[str, Union[str, bytes]]:
+        rows: Dict[str, Union[str, bytes]] = {}
+        path = os.path.join(self.history_path(history_uuid), f"{data_type}.db")
+        # 别为了读一下就建一个空的数据库
+        if os.path.isfile(path):
+            with Chunk.connections.reading(path, create_schema=True) as conn:
+                rows.update(conn.execute("SELECT uuid, data FROM datas"))
+        rows.update(self.read_history_rows(history_uuid, data_type))
+        return rows
+
+    def read_row(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        data_type: str,
+        uuid: str,
+    ) -> Optional[Union[str, bytes]]:
+        path = os.path.join(self.history_path(history_uuid), f"{data_type}.db")
+        if os.path.isfile(path):
+            with Chunk.connections.reading(path, create_schema=True) as conn:
+                result = conn.execute(
+                    "SELECT data FROM datas WHERE uuid = ?", (uuid,)
+                ).fetchone()
+            if result is not None:
+                return result[0]
+        return self.read_history_row(history_uuid, data_type, uuid)
+
+    def data_types(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> List[str]:
+        path = self.history_path(history_uuid)
+        types = set(self.history_object_types(history_uuid))
+        if os.path.isdir(path):
+            types.update(f[:-3] for f in os.listdir(path) if f.endswith(".db"))
+        return sorted(types)
+
+    def write_objects(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        objects: Iterable[ClassDataType],
+        callback: Optional[Callable[[ClassDataType], Any]] = None,
+        codec: Optional[RecordCodec] = None,
+    ) -> int:
+        if self.is_content_addressed(history_uuid):
+            return self.write_history_objects(history_uuid, objects, callback, codec)
+        return DataObject.save_many(
+            objects, self.history_path(history_uuid), callback=callback, codec=codec
+        )
+
+    def read_meta(
+        self,
+        history_uuid: Optional[Union[UUIDKind[History], Literal["Current"]]],
+        name: str,
+    ) -> Any:
+        with open(
+            os.path.join(self.history_path(history_uuid), f"{name}.json"),
+            "r",
+            encoding="utf-8",
+        ) as f:
+            return json.load(f)
+
+    def write_meta(
+        self,
+        history_uuid: Optional[Union[UUIDKind[History], Literal["Current"]]],
+        name: str,
+        value: Any,
+    ) -> None:
+        path = os.path.join(self.history_path(history_uuid), f"{name}.json")
+        if self.deferred_manifests:
+            # 数据库提交之后才换上去，见atomic_save
+            write_json_durable(path + ".tmp", value)
+        else:
+            write_json_atomic(path, value)
+
+    def has_history(self, history_uuid: UUIDKind[History]) -> bool:
+        return os.path.isfile(os.path.join(self.history_path(history_uuid), "info.json"))
+
+    def list_histories(self) -> List[UUIDKind[History]]:
+        root = os.path.join(self.path, "Histories")
+        if not os.path.isdir(root):
+            return []
+        history_uuids = []
+        for dir_1 in os.listdir(root):
+            for dir_2 in os.listdir(os.path.join(root, dir_1)):
+                history_uuids.append(dir_1 + dir_2)
+        return history_uuids
+
+    def prepare_history(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> None:
+        os.makedirs(self.history_path(history_uuid), exist_ok=True)
+
+    def clear_history(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> None:
+        path = self.history_path(history_uuid)
+        if Chunk.connections.in_batch():
+            # 合并提交期间不能删文件，只删数据，跟着一起提交或者回滚（索引保存的时候会重新写）
+            for name in os.listdir(path) if os.path.isdir(path) else ():
+                if name.endswith(".db"):
+                    with Chunk.connections.transaction(os.path.join(path, name)) as conn:
+                        conn.execute("DELETE FROM datas")
+        else:
+            Chunk.connections.close(path)
+            shutil.rmtree(path, ignore_errors=True)
+        self.clear_score_columns(history_uuid)
+        if history_uuid not in ("Current", self.shared_uuid):
+            self.clear_history_objects(history_uuid)
+
+    def del_history(self, history_uuid: UUIDKind[History]) -> None:
+        path = self.history_path(history_uuid)
+        Chunk.connections.close(path)
+        shutil.rmtree(path)
+        self.clear_score_columns(history_uuid)
+        self.clear_history_objects(history_uuid)
+
+    def clear_histories(self) -> None:
+        path = os.path.join(self.path, "Histories")
+        Chunk.connections.close(path)
+        shutil.rmtree(path, ignore_errors=True)
+        self.clear_score_columns()
+        self.clear_history_objects()
+
+    def clear_all(self) -> None:
+        Chunk.connections.close(self.path)
+        self.score_columns_ready = False
+        self.objects_ready = False
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
+
+
+class SingleFileStorage(ArchiveStorage):
+    """
+    单文件存档，整个存档就是一个SQLite数据库：
+
+    - ``data_{类型}``：每个类型一张表，``(history_uuid, uuid)``是主键，另外对uuid建了索引
+    - ``history_manifests``：每个历史记录的索引（原来的info.json、classes.json这些）
+    - ``archive_info``：整个存档的信息（原来根目录的info.json）
+
+    打开存档只需要开一个文件，历史记录再多也一样。
+    """
+
+    suffix: str = ".db"
+    "单文件存档的后缀名"
+
+    format_version: int = 1
+    "单文件存档的格式版本"
+
+    table_prefix: str = "data_"
+    "数据表的前缀"
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        self.ready_tables: Set[str] = set()
+        "已经确认存在的表"
+
+    def connection(self) -> sqlite3.Connection:
+        "获取存档的连接，第一次打开的时候会建好元数据表"
+        conn = Chunk.connections.get(self.path)
+        if not self.ready_tables:
+            with Chunk.connections.transaction(self.path, create_schema=False) as conn:
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS archive_info (
+                                                name   text       primary key,    -- 信息名称
+                                                data   text                       -- json
+                                        )"""
+                )
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS history_manifests (
+                                                history_uuid  text  not null,     -- 历史记录uuid
+                                                name          text  not null,     -- 索引名称
+                                                data          text,               -- json
+                                                primary key (history_uuid, name)
+                                        )"""
+                )
+                conn.execute(
+                    "INSERT OR IGNORE INTO archive_info (name, data) VALUES (?, ?)",
+                    ("format_version", json.dumps(self.format_version)),
+                )
+            self.ready_tables.update(("archive_info", "history_manifests"))
+        return conn
+
+    def _exists(self) -> bool:
+        return self.path in Chunk.connections or os.path.isfile(self.path)
+
+    companion_suffixes: Tuple[str, ...] = ("-wal", "-shm")
+    "数据库文件旁边跟着的文件"
+
+    @classmethod
+    def staging_path(cls, path: str) -> str:
+        path = os.path.abspath(path)
+        if path.endswith(cls.suffix):
+            path = path[: -len(cls.suffix)]
+        return path + ".staging" + cls.suffix
+
+    @classmethod
+    def archive_exists(cls, path: str) -> bool:
+        return os.path.isfile(path)
+
+    @classmethod
+    def remove_archive(cls, path: str) -> None:
+        Chunk.connections.close(path)
+        for suffix in ("",) + cls.companion_suffixes:
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def move_archive(cls, source: str, target: str) -> None:
+        Chunk.connections.close(source)
+        for suffix in cls.companion_suffixes:
+            if os.path.exists(target + suffix):
+                os.remove(target + suffix)
+        # WAL先挪，主文件挪过去的时候旁边的WAL已经在了
+        for suffix in cls.companion_suffixes + ("",):
+            if os.path.exists(source + suffix):
+                os.replace(source + suffix, target + suffix)
+
+    @classmethod
+    def copy_archive(cls, source: str, target: str) -> None:
+        Chunk.connections.close(source)
+        for suffix in ("",) + cls.companion_suffixes:
+            if os.path.exists(source + suffix):
+                shutil.copy2(source + suffix, target + suffix)
+
+    def forget_schema(self) -> None:
+        super().forget_schema()
+        self.ready_tables.clear()
+
+    def score_columns_path(self) -> str:
+        return self.path
+
+    def objects_path(self) -> str:
+        return self.path
+
+    def _table(self, data_type: str) -> str:
+        return f'"{self.table_prefix}{data_type}"'
+
+    def _ensure_table(self, conn: sqlite3.Connection, data_type: str) -> None:
+        if data_type in self.ready_tables:
+            return
+        table = self._table(data_type)
+        conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS {table} (
+                                                history_uuid  text  not null,     -- 历史记录uuid
+                                                uuid          text  not null,     -- 数据UUID
+                                                data          text,               -- 数据
+                                                primary key (history_uuid, uuid)
+                                        ) WITHOUT ROWID"""
+        )
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS "idx_{self.table_prefix}{data_type}_uuid" '
+            f"ON {table} (uuid)"
+        )
+        self.ready_tables.add(data_type)
+
+    def read_rows(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]], data_type: str
+    ) -> Dict[str, Union[str, bytes]]:
+        if not self._exists():
+            return {}
+        self.connection()
+        try:
+            with Chunk.connections.reading(self.path) as conn:
+                rows = dict(
+                    conn.execute(
+                        f"SELECT uuid, data FROM {self._table(data_type)} "
+                        "WHERE history_uuid = ?",
+                        (history_uuid,),
+                    )
+                )
+        except sqlite3.OperationalError:
+            rows = {}  # 表不存在
+        rows.update(self.read_history_rows(history_uuid, data_type))
+        return rows
+
+    def read_row(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        data_type: str,
+        uuid: str,
+    ) -> Optional[Union[str, bytes]]:
+        if not self._exists():
+            return None
+        self.connection()
+        try:
+            with Chunk.connections.reading(self.path) as conn:
+                result = conn.execute(
+                    f"SELECT data FROM {self._table(data_type)} "
+                    "WHERE history_uuid = ? AND uuid = ?",
+                    (history_uuid, uuid),
+                ).fetchone()
+        except sqlite3.OperationalError:
+            result = None
+        if result is not None:
+            return result[0]
+        return self.read_history_row(history_uuid, data_type, uuid)
+
+    def type_tables(self) -> List[str]:
+        "存档里面所有的类型"
+        if not self._exists():
+            return []
+        return [
+            name[len(self.table_prefix) :]
+            for (name,) in self.connection().execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?",
+                (self.table_prefix + "%",),
+            )
+        ]
+
+    def data_types(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> List[str]:
+        conn = self.connection() if self._exists() else None
+        types = {
+            t
+            for t in self.type_tables()
+            if conn.execute(
+                f"SELECT 1 FROM {self._table(t)} WHERE history_uuid = ? LIMIT 1",
+                (history_uuid,),
+            ).fetchone()
+        }
+        types.update(self.history_object_types(history_uuid))
+        return sorted(types)
+
+    def write_rows(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        data_type: str,
+        rows: Iterable[Tuple[str, Union[str, bytes]]],
+    ) -> int:
+        """
+        直接写入原始数据。
+
+        :param history_uuid: 历史记录uuid
+        :param data_type: 数据类型名
+        :param rows: (uuid, 数据)
+        :return: 写入的行数
+        """
+        self.connection()
+        with Chunk.connections.transaction(self.path, create_schema=False) as conn:
+            self._ensure_table(conn, data_type)
+            cursor = conn.executemany(
+                f"INSERT OR REPLACE INTO {self._table(data_type)} "
+                "(history_uuid, uuid, data) VALUES (?, ?, ?)",
+                ((history_uuid, uuid, data) for uuid, data in rows),
+            )
+            return cursor.rowcount
+
+    def write_objects(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        objects: Iterable[ClassDataType],
+        callback: Optional[Callable[[ClassDataType], Any]] = None,
+        codec: Optional[RecordCodec] = None,
+    ) -> int:
+        if self.is_content_addressed(history_uuid):
+            return self.write_history_objects(history_uuid, objects, callback, codec)
+        grouped, count = self.encode_objects(objects, callback, codec)
+        for type_name, rows in grouped.items():
+            self.write_rows(history_uuid, type_name, rows)
+        DataObject.saved_objects += count
+        return count
+
+    def read_meta(
+        self,
+        history_uuid: Optional[Union[UUIDKind[History], Literal["Current"]]],
+        name: str,
+    ) -> Any:
+        if not self._exists():
+            raise FileNotFoundError(f"存档{self.path}不存在")
+        if history_uuid is None:
+            result = (
+                self.connection()
+                .execute("SELECT data FROM archive_info WHERE name = ?", (name,))
+                .fetchone()
+            )
+        else:
+            result = (
+                self.connection()
+                .execute(
+                    "SELECT data FROM history_manifests "
+                    "WHERE history_uuid = ? AND name = ?",
+                    (history_uuid, name),
+                )
+                .fetchone()
+            )
+        if result is None:
+            raise FileNotFoundError(f"{history_uuid}的{name}不存在")
+        return json.loads(result[0])
+
+    def write_meta(
+        self,
+        history_uuid: Optional[Union[UUIDKind[History], Literal["Current"]]],
+        name: str,
+        value: Any,
+    ) -> None:
+        self.connection()
+        with Chunk.connections.transaction(self.path, create_schema=False) as conn:
+            if history_uuid is None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO archive_info (name, data) VALUES (?, ?)",
+                    (name, json.dumps(value)),
+                )
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO history_manifests "
+                    "(history_uuid, name, data) VALUES (?, ?, ?)",
+                    (history_uuid, name, json.dumps(value)),
+                )
+
+    def has_history(self, history_uuid: UUIDKind[History]) -> bool:
+        if not self._exists():
+            return False
+        return (
+            self.connection()
+            .execute(
+                "SELECT 1 FROM history_manifests WHERE history_uuid = ? AND name = 'info'",
+                (history_uuid,),
+            )
+            .fetchone()
+            is not None
+        )
+
+    def list_histories(self) -> List[UUIDKind[History]]:
+        if not self._exists():
+            return []
+        return [
+            uuid
+            for (uuid,) in self.connection().execute(
+                "SELECT history_uuid FROM history_manifests "
+                "WHERE name = 'info' AND history_uuid != 'Current' "
+                "ORDER BY history_uuid"
+            )
+        ]
+
+    def clear_history(
+        self, history_uuid: Union[UUIDKind[History], Literal["Current"]]
+    ) -> None:
+        if not self._exists():
+            return
+        tables = self.type_tables()
+        with Chunk.connections.transaction(self.path, create_schema=False) as conn:
+            for t in tables:
+                conn.execute(
+                    f"DELETE FROM {self._table(t)} WHERE history_uuid = ?",
+                    (history_uuid,),
+                )
+            conn.execute(
+                "DELETE FROM history_manifests WHERE history_uuid = ?", (history_uuid,)
+            )
+        self.clear_score_columns(history_uuid)
+        if history_uuid not in ("Current", self.shared_uuid):
+            self.clear_history_objects(history_uuid)
+
+    def del_history(self, history_uuid: UUIDKind[History]) -> None:
+        if not self.has_history(history_uuid):
+            raise FileNotFoundError("历史记录不存在")
+        self.clear_history(history_uuid)
+
+    def clear_all(self) -> None:
+        Chunk.connections.close(self.path)
+        self.ready_tables.clear()
+        self.score_columns_ready = False
+        self.objects_ready = False
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+
+def migrate_archive(
+    source: str, target: str, overwrite: bool = False
+) -> Dict[str, int]:
+    """
+    把目录存档（``chunks/<用户>/``）转换成单文件存档。
+
+    原来的存档不会被修改。
+
+    :param source: 原来的存档目录
+    :param target: 转换出来的存档文件（一般以``.db``结尾）
+    :param overwrite: 目标已经存在的时候是否覆盖
+    :return: 每个历史记录转换了多少个对象
+    :raise FileNotFoundError: 原来的存档不存在
+    :raise FileExistsError: 目标已经存在，而且没有指定覆盖
+    """
+    src = DirectoryStorage(source) if os.path.isdir(source) else None
+    if src is None or not os.path.isfile(os.path.join(source, "info.json")):
+        raise FileNotFoundError(f"存档{source}不存在")
+    dst = SingleFileStorage(target)
+    if os.path.exists(target):
+        if not overwrite:
+            raise FileExistsError(f"{target}已经存在")
+        dst.clear_all()
+    t = time.time()
+    result: Dict[str, int] = {}
+    try:
+        for history_uuid in ["Current", src.shared_uuid] + src.list_histories():
+            if history_uuid not in ("Current", src.shared_uuid) and not src.has_history(
+                history_uuid
+            ):
+                Base.log(
+                    "W", f"历史记录{history_uuid}不完整，跳过", "migrate_archive"
+                )
+                continue
+            count = 0
+            write_rows = (
+                dst.write_history_rows
+                if dst.is_content_addressed(history_uuid)
+                else dst.write_rows
+            )
+            for data_type in src.data_types(history_uuid):
+                count += write_rows(
+                    history_uuid,
+                    data_type,
+                    src.read_rows(history_uuid, data_type).items(),
+                )
+            for name in dst.manifests:
+                try:
+                    dst.write_meta(history_uuid, name, src.read_meta(history_uuid, name))
+                except FileNotFoundError:
+                    pass
+            if src.has_score_columns(history_uuid):
+                dst.write_score_columns(
+                    history_uuid, src.read_score_columns(history_uuid), replace=True
+                )
+            result[history_uuid] = count
+            Base.log(
+                "D", f"历史记录{history_uuid}转换完成，共{count}个对象", "migrate_archive"
+            )
+        info = src.read_meta(None, "info")
+        info["histories"] = dst.list_histories()
+        dst.write_meta(None, "info", info)
+        dst.checkpoint()
+    except Exception:
+        dst.clear_all()
+        raise
+    finally:
+        src.close()
+    Base.log(
+        "I",
+        f"存档{source}转换完成，共{sum(result.values())}个对象，耗时{time.time() - t:.3f}秒",
+        "migrate_archive",
+    )
+    return result
+
+
+def init_history_worker() -> None:
+    "加载历史记录的子进程初始化（fork出来的连接不能接着用，换一个新的连接池）"
+    Chunk.connections = ConnectionManager()
+
+
+def read_history_payload(
+    storage_type: Type["ArchiveStorage"],
+    path: str,
+    history_uuid: UUIDKind[History],
+    skip_types: Tuple[str, ...] = (),
+) -> Tuple[UUIDKind[History], bytes, float]:
+    """
+    在子进程里面读出一个历史记录的所有数据并解码。
+
+    :param storage_type: 存储后端类型
+    :param path: 存档路径
+    :param history_uuid: 历史记录uuid
+    :param skip_types: 不用读的类型（延迟加载的那些）
+    :return: (历史记录uuid, marshal过的{类型名: {uuid: 解码后的数据}}, 耗时)
+    """
+    t = time.time()
+    storage = storage_type(path)
+    try:
+        rows = {
+            data_type: {
+                uuid: decode_record(raw)
+                for uuid, raw in storage.read_rows(history_uuid, data_type).items()
+            }
+            for data_type in storage.data_types(history_uuid)
+            if data_type not in skip_types
+        }
+    finally:
+        storage.close()
+    return history_uuid, marshal.dumps(rows), time.time() - t
+
+
+class SavePipeline:
+    """
+    后台保存队列。
+
+    提交的时候只需要给一个已经拍好的快照（见``ClassObj.snapshot_database``），
+    编码和写入都在后台线程里面做，保存期间界面和侦测器可以照常改分。
+
+    同一个存档还没开始写的请求会合并：后提交的快照替换前面的，两次之间改过的对象合在一起，
+    拿到的是同一个``Future``。后台线程没活干的时候自己退出，不是守护线程，
+    所以退出程序的时候会等最后一次保存写完。
+    """
+
+    def __init__(self):
+        self.pending: Dict[str, Tuple[UserDataBase, Dict[int, Any], Future]] = {}
+        "还没开始写的请求，pending[存档绝对路径] = (快照, 修改过的对象, Future)"
+        self.running: Optional[Future] = None
+        "正在写的请求"
+        self.worker: Optional[Thread] = None
+        "后台线程"
+        self.coalesced: int = 0
+        "被合并掉的请求数量"
+        self.lock = RLock()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.pending) + (self.running is not None)
+
+    @property
+    def busy(self) -> bool:
+        "是否有还没写完的保存"
+        return len(self) > 0
+
+    def submit(
+        self, path: str, database: UserDataBase, dirty_objects: Dict[int, Any]
+    ) -> "Future[UserDataBase]":
+        """
+        提交一次保存。
+
+        :param path: 存档路径
+        :param database: 要保存的快照，提交之后别再改
+        :param dirty_objects: 拍快照的时候取出来的修改过的对象（``ClassDataObj.pop_dirty_objects``）
+        :return: 保存完成之后结果是快照，失败的话是异常
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            if path in self.pending:
+                _, merged, future = self.pending.pop(path)
+                merged.update(dirty_objects)
+                dirty_objects = merged
+                self.coalesced += 1
+                Base.log("D", f"合并保存请求（{path}）", "SavePipeline.submit")
+            else:
+                future = Future()
+            self.pending[path] = (database, dirty_objects, future)
+            Chunk.loading_info["save_pending"] = len(self.pending)
+            if self.worker is None:
+                self.worker = Thread(target=self._run, name="SavePipeline", daemon=False)
+                self.worker.start()
+        return future
+
+    def _run(self) -> None:
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.worker = None
+                    return
+                path = next(iter(self.pending))
+                database, dirty_objects, future = self.pending.pop(path)
+                Chunk.loading_info["save_pending"] = len(self.pending)
+                if not future.set_running_or_notify_cancel():
+                    ClassDataObj.mark_dirty(*dirty_objects.values())
+                    continue
+                self.running = future
+            t = time.time()
+            try:
+                Chunk(path, database).save_data(dirty_objects=dirty_objects)
+            except BaseException as e:  # pylint: disable=broad-exception-caught
+                # 没写进去的下次还得写
+                ClassDataObj.mark_dirty(*dirty_objects.values())
+                Base.log_exc("后台保存" + path + "失败", "SavePipeline.run", "E", exc=e)
+                future.set_exception(e)
+            else:
+                Base.log(
+                    "I",
+                    f"后台保存{path}完成，耗时{time.time() - t:.3f}秒",
+                    "SavePipeline.run",
+                )
+                future.set_result(database)
+            finally:
+                with self.lock:
+                    self.running = None
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待目前提交了的保存全部写完（等待期间新提交的不算）。
+
+        :param timeout: 超时时间（秒），None为一直等
+        :return: 是否全部写完了
+        """
+        with self.lock:
+            futures = [f for _, _, f in self.pending.values()]
+            if self.running is not None:
+                futures.append(self.running)
+        return not wait_futures(futures, timeout).not_done
+
+
+class Chunk:
+    "数据分组"
+
+    connections: ConnectionManager = ConnectionManager()
+    "数据库连接池，所有存档的连接都在这里，按数据库文件的路径区分"
+
+    loading_info: Dict[str, Any] = {}
+    "加载信息, 字典里面是啥自己开盲盒吧（懒得写了）"
+
+    save_task_mutex: Mutex = Mutex()
+    "保存任务互斥锁"
+
+    save_pipeline: SavePipeline = SavePipeline()
+    "后台保存队列"
+
+    bulk_save: bool = True
+    "是否使用批量保存（关掉之后会一个一个对象保存，很慢，但是出问题的时候好排查）"
+
+    synced_path: Optional[str] = None
+    "上次完整加载或者保存过的存档路径，只有保存到这个路径的时候才能增量保存"
+
+    prefetch_rows: bool = True
+    "加载的时候是否把每个类型的数据库整个读进内存（每个库只扫一遍，比一个一个uuid查快很多）"
+
+    lazy_load: bool = True
+    "是否延迟加载学生的历史记录和成就（用到的时候才从数据库读取）"
+
+    load_lock: RLock = RLock()
+    "加载锁，加载的时候会替换ClassDataObj.LoadUUID，不能同时有两个地方在加载"
+
+    default_codec: str = "json"
+    "新存档用的数据编码（json或者compact），已有的存档沿用存档信息里面记的编码"
+
+    history_workers: int = 0
+    "加载全部历史记录的时候用几个子进程读取和解码，0或者1就是在当前线程一个一个加载"
+
+    def __init__(
+        self,
+        path: str,
+        bound_database: Optional[UserDataBase] = None,
+        storage: Optional[ArchiveStorage] = None,
+        codec: Optional[str] = None,
+    ):
+        """
+        构造函数。
+
+        :param path: 存档路径，``.db``结尾的是单文件存档，其他的是目录存档
+        :param bound_database: 绑定的数据库
+        :param storage: 存储后端，不填就按路径选
+        :param codec: 保存时用的数据编码，不填就沿用存档原来的（新存档用``default_codec``）；
+            读取的时候每一行会自己判断是哪种编码，不受这个影响
+        """
+        self.path = path
+        self.storage = storage or ArchiveStorage.open(path)
+        "存储后端"
+        self.codec = codec
+        "保存时用的数据编码"
+        self.bound_db = bound_database or UserDataBase()
+        self.is_saving = False
+        self.prefetched_rows: Dict[
+            Tuple[Union[UUIDKind[History], Literal["Current"]], str],
+            Dict[str, Union[str, bytes]],
+        ] = {}
+        "预读取的数据，prefetched_rows[(历史记录uuid,数据类型名)][uuid] = 数据"
+        self.objects = ObjectCache.for_archive(
+            self.storage.path, ("Current", self.storage.shared_uuid)
+        )
+        "这个存档的对象缓存，同一个存档的分块共用一个"
+
+    def prefetch(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        data_type: str,
+    ) -> Dict[str, Union[str, bytes]]:
+        """
+        把某个历史记录中某个类型的数据一次性全部读进内存。
+
+        :param history_uuid: 历史记录uuid
+        :param data_type: 数据类型名
+        :return: uuid到数据的映射
+        """
+        t = time.time()
+        rows = self.storage.read_rows(history_uuid, data_type)
+        self.prefetched_rows[(history_uuid, data_type)] = rows
+        Base.log(
+            "D",
+            f"预读取历史记录{history_uuid}的{data_type}完成，"
+            f"共{len(rows)}条，耗时{time.time() - t:.5f}秒",
+            "Chunk.prefetch",
+        )
+        return rows
+
+    def clear_prefetched_rows(
+        self, history_uuid: Optional[Union[UUIDKind[History], Literal["Current"]]] = None
+    ) -> None:
+        """
+        清理预读取的数据。
+
+        :param history_uuid: 历史记录uuid，不填就是全部清理
+        """
+        if history_uuid is None:
+            self.prefetched_rows.clear()
+            return
+        for key in [k for k in self.prefetched_rows if k[0] == history_uuid]:
+            del self.prefetched_rows[key]
+
+    def shared_rows(self, data_type: str) -> Dict[str, Union[str, bytes]]:
+        """
+        共用位置里面某个类型的所有数据（第一次用的时候整个读进内存，反正没多少）。
+
+        :param data_type: 数据类型名
+        :return: uuid到数据的映射
+        """
+        rows = self.prefetched_rows.get((self.storage.shared_uuid, data_type))
+        if rows is None:
+            rows = self.prefetch(self.storage.shared_uuid, data_type)
+        return rows
 
     def get_object_rdata(
         self,
         history_uuid: Union[UUIDKind[History], Literal["Current"]],
         uuid: UUIDKind[_DT],
         data_type: str,
+        prefetch: Optional[bool] = None,
     ) -> StringObjectDataKind[_DT]:
         """
-        获取对象数据。
+        获取对象数据。
+
+        :param history_uuid: 历史记录uuid，Current为此周（还未重置的存档
+        :param uuid: 对象uuid
+        :param data_type: 数据类型名
+        :param prefetch: 是否预读取整个数据库，不填就按照Chunk.prefetch_rows来
+        :return: 对象数据
+        :raise ValueError: 数据不存在
+        """
+        if prefetch is None:
+            prefetch = self.prefetch_rows
+        if prefetch or (history_uuid, data_type) in self.prefetched_rows:
+            try:
+                rows = self.prefetched_rows[(history_uuid, data_type)]
+            except KeyError:
+                rows = self.prefetch(history_uuid, data_type)
+            try:
+                return rows[uuid]
+            except KeyError as e:
+                raise ValueError("数据不存在") from e
+        result = self.storage.read_row(history_uuid, data_type, uuid)
+        if result is None:
+            raise ValueError("数据不存在")
+        return result
+
+    def load_object(
+        self,
+        uuid: UUIDKind[_DT],
+        data_type: Type[_DT],
+        history_uuid: Union[UUIDKind[History], Literal["Current"]] = "Current",
+        failures: Optional[List[Tuple[str, str, str]]] = None,
+        prefetch: Optional[bool] = None,
+    ) -> _DT:
+        """
+        加载一个对象，加载过了就直接从缓存里面拿。
+
+        :param uuid: 对象uuid
+        :param data_type: 数据类型
+        :param history_uuid: 历史记录uuid
+        :param failures: 加载失败的对象会记在这里面
+        :param prefetch: 是否预读取整个数据库，不填就按照Chunk.prefetch_rows来
+        :return: 对象，数据不存在的时候返回一个空对象
+        """
+        DataObject.loaded_objects += 1
+        if (
+            data_type.chunk_type_name in self.storage.shared_types
+            and history_uuid != self.storage.shared_uuid
+            and uuid in self.shared_rows(data_type.chunk_type_name)
+        ):
+            # 模板整个存档只存了一份，所有历史记录用的都是同一个对象
+            history_uuid = self.storage.shared_uuid
+        # 引用里面的uuid和对象自己的uuid用同一个字符串，缓存的键也不会多存一份
+        uuid = intern_uuid(uuid)
+        _id = (history_uuid, data_type.chunk_type_name, uuid)
+        if uuid is None:
+            if "noticed_uuid_is_none" not in runtime_flags:
+                Base.log("D", "加载时遇到uuid为None，将会直接返回None", "Chunk.load_object")
+                runtime_flags["noticed_uuid_is_none"] = True
+            return None
+
+        # 尝试直接从缓存中获取
+        obj = self.objects.get(_id)
+        if obj is not None:
+            return obj
+
+        # 如果不存在的话就从数据库读取
+        self.objects.loading.add(_id)
+        try:
+            try:
+                result = self.get_object_rdata(
+                    history_uuid, uuid, data_type.chunk_type_name, prefetch
+                )
+            except (sqlite3.Error, ValueError):
+                Base.log(
+                    "W",
+                    f"数据不存在，将会返回默认\n数据：{data_type.__qualname__}({uuid})",
+                    "Chunk.load_object",
+                )
+                if failures is not None:
+                    failures.append(_id)
+                obj = data_type.new_dummy()
+                obj.archive_uuid = _id[0]
+                obj.uuid = _id[2]
+                return obj
+
+            obj = data_type.new_dummy()
+            # 先浅层加载一下，防止触发无限递归
+            self.objects.put(_id, obj)
+            # 再深层处理，这样就不用担心了
+            obj.inst_from_string(result)
+            return obj
+        finally:
+            self.objects.loading.discard(_id)
+
+    @contextmanager
+    def bind_loaders(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        failures: Optional[List[Tuple[str, str, str]]] = None,
+        prefetch: bool = False,
+    ):
+        """
+        在with块里面把ClassDataObj.LoadUUID（和LazyLoadUUID）绑定到这个分块的某个历史记录上，
+        出了with块之后还原。
 
-        :param history_uuid: 历史记录uuid，Current为此周（还未重置的存档
-        :param uuid: 对象uuid
-        :param data_type: 数据类型名
-        :return: 对象数据
-        :raise ValueError: 数据不存在
+        :param history_uuid: 历史记录uuid
+        :param failures: 加载失败的对象会记在这里面
+        :param prefetch: 是否预读取整个数据库（零散加载几个对象的时候就别开了）
         """
-        try:
-            conn = self.database_connections[(history_uuid, data_type)]
-        except KeyError:
-            conn = sqlite3.connect(
-                os.path.join(self.path, f"{data_type}.db"), check_same_thread=False
+
+        def _load_object(
+            uuid: UUIDKind[_DT],
+            data_type: ClassDataType,
+            history_uuid: UUIDKind[History] = history_uuid,
+        ) -> _DT:
+            return self.load_object(uuid, data_type, history_uuid, failures, prefetch)
+
+        def _lazy_load_object(
+            uuid: UUIDKind[_DT], data_type: ClassDataType
+        ) -> DataKind[_DT]:
+            if uuid is None:
+                return None
+            return DataKind(uuid, data_type, self, history_uuid)
+
+        with Chunk.load_lock:
+            orig_loaders = (
+                getattr(ClassDataObj, "LoadUUID", None),
+                ClassDataObj.LazyLoadUUID,
             )
-            self.database_connections[(history_uuid, data_type)] = conn
-        result = conn.execute(
-            f"SELECT data FROM datas_{uuid[:1]} WHERE uuid = ?", (uuid,)
-        ).fetchone()
-        if result is None:
-            raise ValueError("数据不存在")
-        return result[0]
+            ClassDataObj.LoadUUID = _load_object
+            ClassDataObj.LazyLoadUUID = _lazy_load_object if self.lazy_load else None
+            try:
+                yield
+            finally:
+                ClassDataObj.LoadUUID, ClassDataObj.LazyLoadUUID = orig_loaders
 
     def load_history(
         self,
         history_uuid: Union[UUIDKind[History], Literal["Current"]] = "Current",
         request_uuid: Optional[UUIDKind[Type[None]]] = None,
+        keep_prefetched: bool = False,
+        worker_time: Optional[float] = None,
     ) -> History:
         """
         加载历史记录。
 
         :param history_uuid: 历史记录uuid
         :param request_uuid: 请求uuid，只是用来做数据加载的标识的
+        :param keep_prefetched: 加载完之后是否保留预读取的数据（后面还要接着从这个历史记录加载东西的时候用）
+        :param worker_time: 数据是子进程读好的话，子进程读取花的时间（只用来记日志）
         :return: 历史记录
         :raise FileNotFoundError: 历史记录不存在
         """
         failures = []
         start_time = time.time()
         start_obj = DataObject.loaded_objects
-        
-
-        def _load_object(
-            uuid: UUIDKind[_DT],
-            data_type: ClassDataType,
-            history_uuid: UUIDKind[History] = history_uuid,
-        ) -> _DT:
-            DataObject.loaded_objects += 1
-            _id = (history_uuid, data_type.chunk_type_name, uuid)
-            if uuid is None:
-                if "noticed_uuid_is_none" not in runtime_flags:
-                    Base.log("D", "加载时遇到uuid为None，将会直接返回None", "Chunk.load_history._load_object")
-                    runtime_flags["noticed_uuid_is_none"] = True
-                return None
-
-            DataObject.load_tasks.append(_id)
-            try:
-                # 尝试直接从缓存中获取
-                obj = DataObject.loaded_object_list[_id]
-                DataObject.load_tasks.remove(_id)
-                return obj
-
-            except KeyError:
-                # 如果不存在的话就从数据库读取
-                try:
-                    # 从连接池获取连接
-                    conn = self.database_connections[
-                        (history_uuid, data_type.chunk_type_name)
-                    ]
-                except KeyError:
-                    # 如果没连接就直接开一个新的连接放连接池，不用反复开开关关的节约性能
-                    # （加载完记得relase_connections，清理内存）
-                    conn = sqlite3.connect(
-                        os.path.join(path, f"{data_type.chunk_type_name}.db"),
-                        check_same_thread=False,
-                    )
-
-                    self.database_connections[
-                        (history_uuid, data_type.chunk_type_name)
-                    ] = conn
-
-                try:
-                    result = conn.execute(
-                        f"SELECT data FROM datas_{uuid[:1]} WHERE uuid = ?", (uuid,)
-                    ).fetchone()
-                except sqlite3.Error:
-
-                    Base.log(
-                        "W",
-                        f"数据不存在，将会返回默认\n数据：{data_type.__qualname__}({uuid})",
-                        "Chunk.load_history",
-                    )
-                    DataObject.load_tasks.remove(_id)
-                    failures.append(_id)
-                    obj = data_type.new_dummy()
-                    obj.archive_uuid = _id[0]
-                    obj.uuid = _id[2]
-                    return obj
-
-                if result is None:
-                    Base.log(
-                        "W",
-                        f"数据不存在，将会返回默认\n数据：{data_type.__qualname__}({uuid})",
-                        "Chunk.load_history",
-                    )
-                    DataObject.load_tasks.remove(_id)
-                    failures.append(_id)
-                    obj = data_type.new_dummy()
-                    obj.archive_uuid = _id[0]
-                    obj.uuid = _id[2]
-                    return obj
-
-                obj_shallow_loaded = data_type.new_dummy()
-                # 先浅层加载一下，防止触发无限递归
-                DataObject.loaded_object_list[_id] = obj_shallow_loaded
-                # 再深层处理，这样就不用担心了
-                DataObject.loaded_object_list[_id].inst_from_string(result[0])
-                obj = DataObject.loaded_object_list[_id]
-                DataObject.load_tasks.remove(_id)
-                return obj
+        with self.bind_loaders(history_uuid, failures, self.prefetch_rows):
+            history = self._load_history(history_uuid, request_uuid)
+        if not keep_prefetched:
+            self.clear_prefetched_rows(history_uuid)
+        total_time = time.time() - start_time
+        total_obj = DataObject.loaded_objects - start_obj
+        cache_stats = self.objects.stats()
+        Base.log("I", f"历史记录{history_uuid}加载完成，总数据处理数：{total_obj}, 警告数量：{len(failures)}, 耗时：{total_time:.3f}s, 平均速度：{total_obj/max(total_time, 0.001):.3f}个/秒, 缓存对象数：{cache_stats['size']}, 缓存命中率：{cache_stats['hit_rate']:.1%}"
+                 + (f", 子进程读取耗时：{worker_time:.3f}s" if worker_time is not None else ""))
+        return history
 
-        ClassDataObj.LoadUUID = _load_object
-        if history_uuid == "Current":
-            path = os.path.join(self.path, "Current")
-        else:
-            path = os.path.join(
-                self.path, "Histories", history_uuid[:2], history_uuid[2:]
-            )
-        if not os.path.isdir(path):
-            raise FileNotFoundError("历史记录不存在")
-        info = json.load(open(os.path.join(path, "info.json"), "r", encoding="utf-8"))
+    def _load_history(
+        self,
+        history_uuid: Union[UUIDKind[History], Literal["Current"]],
+        request_uuid: Optional[UUIDKind[Type[None]]],
+    ) -> History:
+        try:
+            info = self.storage.read_meta(history_uuid, "info")
+        except FileNotFoundError as e:
+            raise FileNotFoundError("历史记录不存在") from e
         if "python_version" in info:
             data_python_ver = info["python_version"]
             current_ver = [
@@ -748,11 +3596,9 @@ class Chunk:
                 "历史记录的Python版本信息缺失，可能存在兼容性问题",
                 "Chunk.load_history",
             )
-        class_uuids = json.load(
-            open(os.path.join(path, "classes.json"), "r", encoding="utf-8")
-        )
-        weekday_uuids: Dict[str, Dict[float, UUIDKind[DayRecord]]] = json.load(
-            open(os.path.join(path, "weekdays.json"), "r", encoding="utf-8")
+        class_uuids = self.storage.read_meta(history_uuid, "classes")
+        weekday_uuids: Dict[str, Dict[float, UUIDKind[DayRecord]]] = (
+            self.storage.read_meta(history_uuid, "weekdays")
         )
         index = 0
         for item in weekday_uuids:
@@ -774,15 +3620,146 @@ class Chunk:
         history = History(
             classes,
             self.bound_db.weekday_record,
-            json.load(open(os.path.join(path, "info.json"), "r", encoding="utf-8"))[
-                "create_time"
-            ],
+            info["create_time"],
         )
         history.uuid = history_uuid
         history.archive_uuid = history_uuid
-        total_time = time.time() - start_time
-        total_obj = DataObject.loaded_objects - start_obj
-        Base.log("I", f"历史记录{history_uuid}加载完成，总数据处理数：{total_obj}, 警告数量：{len(failures)}, 耗时：{total_time:.3f}s, 平均速度：{total_obj/max(total_time, 0.001):.3f}个/秒")
+        return history
+
+    def load_histories(
+        self,
+        history_uuids: List[UUIDKind[History]],
+        request_uuid: Optional[UUIDKind[Type[None]]] = None,
+        workers: Optional[int] = None,
+    ) -> List[History]:
+        """
+        加载多个历史记录，加载失败的会跳过。
+
+        每个历史记录的数据是分开存的，开了多进程的话读取和解码放到子进程里面一起做，
+        当前进程只负责把解好的数据拼成对象（对象之间有引用，这一步没法分开做）。
+
+        :param history_uuids: 历史记录uuid
+        :param request_uuid: 请求uuid
+        :param workers: 子进程数量，不填就是``Chunk.history_workers``
+        :return: 历史记录，顺序不一定和history_uuids一样
+        """
+        if workers is None:
+            workers = self.history_workers
+        histories: List[History] = []
+        remaining = list(history_uuids)
+        if workers > 1 and len(remaining) > 1:
+            skip_types: Tuple[str, ...] = (
+                (ScoreModification.chunk_type_name, Achievement.chunk_type_name)
+                if self.lazy_load
+                else ()
+            )
+            t = time.time()
+            try:
+                with ProcessPoolExecutor(
+                    min(workers, len(remaining)), initializer=init_history_worker
+                ) as executor:
+                    futures = [
+                        executor.submit(
+                            read_history_payload,
+                            type(self.storage),
+                            self.storage.path,
+                            uuid,
+                            skip_types,
+                        )
+                        for uuid in remaining
+                    ]
+                    for future in as_completed(futures):
+                        try:
+                            uuid, payload, worker_time = future.result()
+                        except Exception as e:  # pylint: disable=broad-exception-caught
+                            Base.log_exc(
+                                "子进程读取历史记录失败，稍后重新加载",
+                                "Chunk.load_histories",
+                                "W",
+                                e,
+                            )
+                            continue
+                        for data_type, rows in marshal.loads(payload).items():
+                            self.prefetched_rows[(uuid, data_type)] = rows
+                        try:
+                            histories.append(
+                                self.load_history(
+                                    uuid, request_uuid, worker_time=worker_time
+                                )
+                            )
+                        except FileNotFoundError as e:
+                            Base.log_exc(
+                                f"历史记录{uuid}加载失败，将跳过",
+                                "Chunk.load_histories",
+                                "E",
+                                e,
+                            )
+                        remaining.remove(uuid)
+            except (OSError, BrokenExecutor) as e:
+                # 子进程起不来（或者中途挂了）的话剩下的在当前线程加载
+                Base.log_exc(
+                    "多进程加载历史记录失败，剩下的逐个加载", "Chunk.load_histories", "W", e
+                )
+            Base.log(
+                "I",
+                f"{workers}个子进程加载了{len(history_uuids) - len(remaining)}个历史记录，"
+                f"耗时{time.time() - t:.3f}秒",
+                "Chunk.load_histories",
+            )
+        for uuid in remaining:
+            try:
+                histories.append(self.load_history(uuid, request_uuid))
+            except FileNotFoundError as e:
+                Base.log_exc(
+                    f"历史记录{uuid}加载失败，将跳过", "Chunk.load_histories", "E", e
+                )
+        return histories
+
+    def history_catalog(self) -> List[HistoryEntry]:
+        """
+        列出存档里面所有的历史记录，只读每个历史记录的索引，不加载对象。
+
+        :return: 历史记录目录，按时间排序
+        """
+        entries: List[HistoryEntry] = []
+        for history_uuid in self.storage.list_histories():
+            try:
+                info = self.storage.read_meta(history_uuid, "info")
+                class_names = info.get("class_names")
+                if class_names is None:
+                    class_names = {
+                        key: key
+                        for key, _ in self.storage.read_meta(history_uuid, "classes")
+                    }
+            except FileNotFoundError:
+                continue
+            entries.append(
+                HistoryEntry(
+                    history_uuid,
+                    info["create_time"],
+                    info.get("save_time", info["create_time"]),
+                    info.get("total_objects", 0),
+                    class_names,
+                )
+            )
+        entries.sort(key=lambda e: e.time)
+        return entries
+
+    def open_history(self, history_uuid: UUIDKind[History]) -> History:
+        """
+        单独加载一个历史记录，最近打开过的直接从缓存里面拿。
+
+        :param history_uuid: 历史记录uuid
+        :return: 历史记录
+        :raise FileNotFoundError: 历史记录不存在
+        """
+        history = self.objects.get_history(history_uuid)
+        if history is None:
+            # 用一个新的分块加载，不然这个历史记录的日期记录会混进绑定的数据库里面
+            history = Chunk(self.path, storage=self.storage).load_history(
+                history_uuid
+            )
+            self.objects.put_history(history)
         return history
 
     def del_history(self, history_uuid: str) -> bool:
@@ -790,9 +3767,9 @@ class Chunk:
         删除历史记录
         """
         try:
-            shutil.rmtree(
-                os.path.join(self.path, "Histories", history_uuid[:2], history_uuid[2:])
-            )
+            self.clear_prefetched_rows(history_uuid)
+            self.storage.del_history(history_uuid)
+            self.objects.discard_history(history_uuid)
             return True
         except Exception as unused:  # pylint: disable=broad-exception-caught
             return False
@@ -804,57 +3781,41 @@ class Chunk:
         :return: 对象数据
         :param load_all: 是否加载所有数据
         """
+        with Chunk.load_lock:
+            return self._load_data(load_all)
+
+    def _load_data(self, load_all: bool = False) -> UserDataBase:
         req_uuid = gen_uuid()
-        current_record = self.load_history("Current", req_uuid)
+        current_record = self.load_history("Current", req_uuid, keep_prefetched=True)
 
         templates = []
         achievements = []
         current_day_attendance = {}
+        # 这些都在这周的存档里面，接着用这周的预读取数据
+        with self.bind_loaders("Current", prefetch=self.prefetch_rows):
+            template_uuids = self.storage.read_meta("Current", "templates")
 
+            for _, template_uuid in template_uuids:
+                templates.append(
+                    ClassDataObj.LoadUUID(template_uuid, ScoreModificationTemplate)
+                )
 
+            achievement_uuids = self.storage.read_meta("Current", "achievements")
+            for _, achievement_uuid in achievement_uuids:
+                achievements.append(
+                    ClassDataObj.LoadUUID(achievement_uuid, AchievementTemplate)
+                )
 
-
-        # 有个细节，这里的LoadUUID是纲刚刚加载完这周的，所以不用填默认参数
-        template_uuids = json.load(
-            open(
-                os.path.join(self.path, "Current", "templates.json"),
-                "r",
-                encoding="utf-8",
-            )
-        )
-
-        for _, template_uuid in template_uuids:
-            templates.append(
-                ClassDataObj.LoadUUID(template_uuid, ScoreModificationTemplate)
-            )
-
-        achievement_uuids = json.load(
-            open(
-                os.path.join(self.path, "Current", "achievements.json"),
-                "r",
-                encoding="utf-8",
-            )
-        )
-        for _, achievement_uuid in achievement_uuids:
-            achievements.append(
-                ClassDataObj.LoadUUID(achievement_uuid, AchievementTemplate)
-            )
-
-        current_day_attendance_uuids = json.load(
-            open(
-                os.path.join(self.path, "Current", "current_day_attendance.json"),
-                "r",
-                encoding="utf-8",
-            )
-        )
-        for target_class, uuid in current_day_attendance_uuids:
-            current_day_attendance[target_class] = ClassDataObj.LoadUUID(
-                uuid, AttendanceInfo
+            current_day_attendance_uuids = self.storage.read_meta(
+                "Current", "current_day_attendance"
             )
+            for target_class, uuid in current_day_attendance_uuids:
+                current_day_attendance[target_class] = ClassDataObj.LoadUUID(
+                    uuid, AttendanceInfo
+                )
+        self.clear_prefetched_rows("Current")
 
-        info = json.load(
-            open(os.path.join(self.path, "info.json"), "r", encoding="utf-8")
-        )
+        info = self.storage.read_meta(None, "info")
         self.bound_db.uuid = info["uuid"]
         self.bound_db.save_time = info["save_time"]
         self.bound_db.version = info["version"]
@@ -863,18 +3824,13 @@ class Chunk:
         self.bound_db.last_start_time = info["last_start_time"]
         histories = {}
         if load_all:
-            for uuid in info["histories"]:
-                try:
-                    h = self.load_history(uuid, req_uuid)
-                    while h.time in histories:
-                        h.time += 0.001
-                    histories[h.time] = h
-                except FileNotFoundError as e:
-                    Base.log_exc(
-                        f"历史记录{uuid}加载失败，将跳过", "Chunk.load_data", "E", e
-                    )
+            for h in self.load_histories(info["histories"], req_uuid):
+                while h.time in histories:
+                    h.time += 0.001
+                histories[h.time] = h
             h2 = sorted(histories.items(), key=lambda i: i[0])
             histories = dict(h2)
+        Chunk.synced_path = os.path.abspath(self.path)
         return UserDataBase(
             info["user"],
             info["save_time"],
@@ -890,15 +3846,154 @@ class Chunk:
             current_day_attendance
         )
 
+    def archive_codec(self) -> str:
+        "获取保存时要用的数据编码名称"
+        if self.codec is not None:
+            return self.codec
+        try:
+            return self.storage.read_meta(None, "info").get("codec") or "json"
+        except (FileNotFoundError, ValueError, AttributeError):
+            return self.default_codec
+
+    def save_objects(
+        self,
+        objects: List[ClassDataType],
+        name: str,
+        history_uuid: str,
+        object_percentage: float,
+        codec: Optional[RecordCodec] = None,
+    ) -> int:
+        """
+        保存一组对象，顺便更新进度条。
+
+        :param objects: 对象列表
+        :param name: 对象的名字（给进度条和日志看的）
+        :param history_uuid: 保存到的历史记录uuid
+        :param object_percentage: 每个对象占的总进度
+        :param codec: 数据编码
+        :return: 保存的对象数量
+        """
+        t = time.time()
+        Chunk.loading_info["current_saving_obj_name"] = name
+        Chunk.loading_info["current_saving_obj_total"] = max(len(objects), 1)
+        Chunk.loading_info["current_saving_obj_current"] = 0
+
+        def _update_progress(_obj: ClassDataType) -> None:
+            Chunk.loading_info["current_saving_obj_current"] += 1
+            Chunk.loading_info["total_percentage"] += object_percentage
+
+        if (
+            self.bulk_save
+            or not isinstance(self.storage, DirectoryStorage)
+            or self.storage.is_content_addressed(history_uuid)
+        ):
+            c = self.storage.write_objects(
+                history_uuid, objects, callback=_update_progress, codec=codec
+            )
+        else:
+            c = 0
+            path = self.storage.history_path(history_uuid)
+            for obj in objects:
+                DataObject(obj, self).save(path)
+                _update_progress(obj)
+                c += 1
+        spent = time.time() - t
+        Base.log(
+            "D",
+            f"历史记录中的{history_uuid}的{name}保存完成，"
+            f"耗时{spent: .5f}秒，共{c}个，"
+            f"速率{c / (spent if spent > 0 else 1): .3f}个/秒",
+            "Chunk.save",
+        )
+        return c
+
+    def save_score_columns(
+        self,
+        history_uuid: str,
+        modifies: List[ScoreModification],
+        students: List[Student],
+        templates: List[ScoreModificationTemplate],
+        incremental: bool = False,
+    ) -> int:
+        """
+        把分数修改记录写进分数列存储（给统计用的，见``ArchiveStorage.aggregate_scores``）。
+
+        :param history_uuid: 历史记录uuid
+        :param modifies: 这次保存写入的分数修改记录
+        :param students: 这个历史记录里面的学生
+        :param templates: 分数修改模板
+        :param incremental: ``modifies``是不是只有修改过的
+        :return: 写入的行数
+        """
+        class_keys = {s.uuid: s.belongs_to for s in students}
+        if not incremental or self.storage.has_score_columns(history_uuid):
+            return self.storage.write_score_columns(
+                history_uuid,
+                (
+                    (
+                        m.uuid,
+                        m.target.uuid,
+                        class_keys.get(m.target.uuid),
+                        m.temp.key,
+                        m.mod,
+                        m.execute_time_key,
+                        m.executed,
+                    )
+                    for m in modifies
+                ),
+                replace=not incremental,
+            )
+        # 列存储还不完整（比如旧的存档第一次保存），从刚写进去的数据重新建一遍，
+        # 没加载的记录也不用加载出来
+        template_keys = {t.uuid: t.key for t in templates}
+        rows: List[ScoreColumnRow] = []
+        for uuid, data in self.storage.read_rows(
+            history_uuid, ScoreModification.chunk_type_name
+        ).items():
+            d = decode_record(data)
+            rows.append(
+                (
+                    uuid,
+                    d["target"],
+                    class_keys.get(d["target"]),
+                    template_keys.get(d["template"]),
+                    d["mod"],
+                    d["execute_time_key"],
+                    d["executed"],
+                )
+            )
+        return self.storage.write_score_columns(history_uuid, rows, replace=True)
+
+    def load_lazy_objects(self) -> int:
+        """
+        把绑定的数据库里面所有延迟加载的历史记录和成就都加载出来。
+
+        :return: 加载的对象数量
+        """
+        count = 0
+        histories = [self.bound_db.classes] + [
+            h.classes for h in self.bound_db.history_data.values()
+        ]
+        for classes in histories:
+            for _class in classes.values():
+                for student in _class.students.values():
+                    s = student
+                    while s is not None:
+                        for mapping in (s.history, s.achievements):
+                            if isinstance(mapping, LazyObjectDict):
+                                count += mapping.unloaded_count
+                                mapping.load_all()
+                        s = s._last_reset_info
+        return count
+
     @staticmethod
     def relase_connections(clear_dataobj_connections: bool = True) -> None:
-        """释放所有连接"""
-        for v in Chunk.database_connections.values():
-            v.commit()
-            v.close()
-        Chunk.database_connections.clear()
-        if clear_dataobj_connections:
-            DataObject.relase_connections(False)
+        """
+        释放所有连接（会先把WAL合并回数据库文件）。
+
+        平时不用调用，删除、替换或者复制存档文件之前调用一下。
+        """
+        Chunk.connections.close_all()
 
     def save_data(
         self,
@@ -906,6 +4001,8 @@ class Chunk:
         save_only_if_not_exist: bool = True,
         clear_current: bool = False,
         clear_histories: bool = False,
+        incremental: bool = True,
+        dirty_objects: Optional[Dict[int, Any]] = None,
     ) -> None:
         """
         保存数据。
@@ -914,50 +4011,56 @@ class Chunk:
         :param save_only_if_not_exist: 是否只保存不存在的数据
         :param clear_current: 是否清理当前数据
         :param clear_histories: 是否清理历史数据
+        :param incremental: 是否增量保存，开启后当前周只写入上次保存之后修改过的分数修改记录和成就
+            （只有存档路径和上次加载/保存的一样的时候才会生效，其他的对象数量不多，还是全部写入）
+        :param dirty_objects: 修改过的对象，拍快照的时候已经取出来了就传进来，不填就现取
         """
         with Chunk.save_task_mutex:
             Chunk.loading_info["total_percentage"] = 0.0
+            codec_name = self.archive_codec()
+            codec = get_codec(codec_name)
+            if dirty_objects is None:
+                dirty_objects = ClassDataObj.pop_dirty_objects()
+            incremental = (
+                incremental
+                and not clear_current
+                and not clear_histories
+                and Chunk.synced_path == os.path.abspath(self.path)
+            )
+            if incremental:
+                Base.log(
+                    "I", f"增量保存，修改过的对象数：{len(dirty_objects)}", "Chunk.save"
+                )
 
+            target = self.storage
             try:
                 if self.is_saving:
                     Base.log("W", "当前分块正在处理数据", "Chunk.save")
                 self.is_saving = True
-                Base.log("I", "开始保存数据", "Chunk.save")
+                Base.log("I", f"开始保存数据（编码：{codec_name}）", "Chunk.save")
                 if clear_histories:
-                    shutil.rmtree(self.path, ignore_errors=True)
-                os.makedirs(self.path, exist_ok=True)
-                os.makedirs(os.path.join(self.path, "Histories"), exist_ok=True)
+                    # 整个存档都要删掉重写，延迟加载的对象得先读出来；
+                    # 新存档先写到旁边，写完再整个换过来，中途出错原来的存档还是好的
+                    self.load_lazy_objects()
+                    self.storage = target.staging()
                 history = History(self.bound_db.classes, self.bound_db.weekday_record)
                 save_tasks: List[Tuple[str, History, bool]] = [
                     ("Current", history, clear_current)
                 ]
                 if save_history:
                     for v in self.bound_db.history_data.values():
-                        if save_only_if_not_exist:
-                            if not os.path.isfile(
-                                os.path.join(
-                                    self.path,
-                                    "Histories",
-                                    v.uuid[:2],
-                                    v.uuid[2:],
-                                    "info.json",
-                                )
-                            ):
-                                os.makedirs(
-                                    os.path.join(
-                                        self.path, "Histories", v.uuid[:2], v.uuid[2:]
-                                    ),
-                                    exist_ok=True,
-                                )
-                                save_tasks.append((v.uuid, v, clear_histories))
-                        else:
-                            os.makedirs(
-                                os.path.join(
-                                    self.path, "Histories", v.uuid[:2], v.uuid[2:]
-                                ),
-                                exist_ok=True,
-                            )
+                        if not save_only_if_not_exist or not self.storage.has_history(
+                            v.uuid
+                        ):
                             save_tasks.append((v.uuid, v, clear_histories))
+                # 模板整个存档只存一份，历史记录里面的索引只记uuid
+                shared_templates: List[ScoreModificationTemplate] = list(
+                    self.bound_db.templates.values()
+                )
+                shared_achievements: List[AchievementTemplate] = list(
+                    self.bound_db.achievements.values()
+                )
+                shared_uuids: Set[str] = set()
                 i = 0
                 total_history_count = len(save_tasks)
                 history_percentage = 100 / total_history_count
@@ -966,27 +4069,25 @@ class Chunk:
                     uuid: str, current_history: History, clear: bool, index: int
                 ) -> None:
                     Chunk.loading_info["history_stage"] = f"保存历史记录（{index}/{total_history_count}）"
-                    if uuid != "Current":
-                        path = os.path.join(self.path, "Histories", uuid[:2], uuid[2:])
-                    else:
-                        path = os.path.join(self.path, "Current")
-                    if clear:
-                        shutil.rmtree(path, ignore_errors=True)
-                    os.makedirs(path, exist_ok=True)
                     total_saved_objects = 0
                     t = time.time()
-                    modify_templates: List[ScoreModificationTemplate] = list(
-                        self.bound_db.templates.values()
-                    )
+                    skip_unloaded = incremental and uuid == "Current"
+
+                    def _values(mapping: Dict[Any, _DT]) -> Iterable[_DT]:
+                        # 增量保存的时候，没加载过的对象肯定没改过，不用为了保存专门去加载
+                        if skip_unloaded and isinstance(mapping, LazyObjectDict):
+                            return mapping.loaded_values()
+                        return mapping.values()
+
+                    # 每个对象在一个历史记录里面只写一次，共用的模板已经单独写过了
+                    seen = set(shared_uuids)
+                    modify_templates: List[ScoreModificationTemplate] = []
                     day_records: List[DayRecord] = []
-                    achivement_templates: List[AchievementTemplate] = list(
-                        self.bound_db.achievements.values()
-                    )
 
                     for c, records in current_history.weekdays.items():
                         for r in records.values():
                             day_records.append(r)
-                        
+
                     students: List[Student] = []
                     modifies: List[ScoreModification] = []
                     achievements: List[Achievement] = []
@@ -995,224 +4096,130 @@ class Chunk:
 
                     for _class in current_history.classes.values():
                         for homework_rule in _class.homework_rules:
-                            for template in homework_rule.rule_mapping.values():
-                                modify_templates.append(template)
+                            modify_templates.extend(homework_rule.rule_mapping.values())
                         classes.append(_class)
                         for student in _class.students.values():
-                            students.append(student)
-                            s = student
-                            for _ in range(
-                                Student.last_reset_info_keep_turns
-                            ):  # 保留最近几次的重置信息
-                                # TODO: 把这个废性能的方法改一下，last_reset_info改成动态查询
-                                if s._last_reset_info:
-                                    students.append(student.last_reset_info)
-                                    modifies.extend(
-                                        student.last_reset_info.history.values()
-                                    )
-                                    achievements.extend(
-                                        student.last_reset_info.achievements.values()
-                                    )
-                                    s = s.last_reset_info
-                            modifies.extend(student.history.values())
-                            achievements.extend(student.achievements.values())
-                            i = 0
-                            while student.last_reset_info:
-                                students.append(student.last_reset_info)
-                                modifies.extend(student.last_reset_info.history.values())
-                                achievements.extend(
-                                    student.last_reset_info.achievements.values()
-                                )
-                                i += 1
-                                student.last_reset_info = None
-                                if i > Student.last_reset_info_keep_turns:
-                                    break
+                            # 只保留最近几次的重置信息，更早的不存
+                            chain = [student]
+                            s = student._last_reset_info
+                            while (
+                                s is not None
+                                and len(chain) <= Student.last_reset_info_keep_turns
+                            ):
+                                chain.append(s)
+                                s = s._last_reset_info
+                            if s is not None:
+                                # 重置信息是几个历史记录共用的快照，不能直接改，存一个断开的副本
+                                chain[-1] = chain[-1].snapshot()
+                                chain[-1].last_reset_info = None
+                            for s in chain:
+                                students.append(s)
+                                modifies.extend(_values(s.history))
+                                achievements.extend(_values(s.achievements))
 
                         groups.extend(_class.groups.values())
-                    Base.log(
-                        "D",
-                        f"历史记录中的{uuid}的数据汇总完成，耗时{time.time() - t: .5f}秒",
-                        "Chunk.save",
-                    )
+                    modify_templates = unique_objects(modify_templates, seen)
+                    day_records = unique_objects(day_records, seen)
+                    students = unique_objects(students, seen)
+                    modifies = unique_objects(modifies, seen)
+                    achievements = unique_objects(achievements, seen)
+                    groups = unique_objects(groups, seen)
+                    classes = unique_objects(classes, seen)
+                    # 要汇总完了才能清理，不然延迟加载的对象就读不出来了
+                    if clear:
+                        self.clear_prefetched_rows(uuid)
+                        self.storage.clear_history(uuid)
+                    self.storage.prepare_history(uuid)
                     total_objects = len(classes) + len(students) + len(groups) + len(modifies) + len(achievements) \
-                                    + len(modify_templates) + len(day_records) + len(achivement_templates) \
+                                    + len(modify_templates) + len(day_records) \
                                     + len(self.bound_db.current_day_attendance)
-                    object_percentage = history_percentage / total_objects
-                    t = time.time()
-                    c = 0
-                    total = max(len(classes), 1)
-                    Chunk.loading_info["current_saving_obj_name"] = "班级信息"
-                    Chunk.loading_info["current_saving_obj_total"] = total
-                    for _class in classes:
-                        Chunk.loading_info["current_saving_obj_current"] = c
-                        Chunk.loading_info["total_percentage"] += object_percentage
-                        DataObject(_class, self).save(path)
-                        c += 1
-                        total_saved_objects += 1
-                    c = max(1, c)
+                    archive_objects = total_objects
+                    if incremental and uuid == "Current":
+                        # 分数修改记录和成就占了存档的绝大部分，只写改过的
+                        total_objects -= len(modifies) + len(achievements)
+                        modifies = [m for m in modifies if id(m) in dirty_objects]
+                        achievements = [a for a in achievements if id(a) in dirty_objects]
+                        total_objects += len(modifies) + len(achievements)
                     Base.log(
                         "D",
-                        f"历史记录中的{uuid}的班级保存完成，"
-                        f"耗时{time.time() - t: .5f}秒，共{c}个，"
-                        f"速率{c / (time.time() - t if (time.time() - t) > 0 else 1): .3f}个/秒",
+                        f"历史记录中的{uuid}的数据汇总完成，耗时{time.time() - t: .5f}秒",
                         "Chunk.save",
                     )
+                    object_percentage = history_percentage / max(total_objects, 1)
                     t = time.time()
-                    c = 0
-                    total = max(len(students), 1)
-                    Chunk.loading_info["current_saving_obj_name"] = "学生信息"
-                    Chunk.loading_info["current_saving_obj_total"] = total
-                    for student in students:
-                        Chunk.loading_info["current_saving_obj_current"] = c
-                        Chunk.loading_info["total_percentage"] += object_percentage
-                        DataObject(student, self).save(path)
-                        c += 1
-                        total_saved_objects += 1
-                    c = max(1, c)
+                    for name, objects in (
+                        ("班级信息", classes),
+                        ("学生信息", students),
+                        ("小组信息", groups),
+                        ("分数修改记录", modifies),
+                        ("成就记录", achievements),
+                        ("作业规则模板", modify_templates),
+                        ("每日记录", day_records),
+                        ("当前出勤", list(self.bound_db.current_day_attendance.values())),
+                    ):
+                        total_saved_objects += self.save_objects(
+                            objects, name, uuid, object_percentage, codec
+                        )
+                    spent = time.time() - t
                     Base.log(
                         "D",
-                        f"历史记录中的{uuid}的学生保存完成，"
-                        f"耗时{time.time() - t: .5f}秒，共{c}个，"
-                        f"速率{c / (time.time() - t if (time.time() - t) > 0 else 1): .3f}个/秒",
+                        f"历史记录中的{uuid}的数据写入完成，"
+                        f"耗时{spent: .5f}秒，共{total_saved_objects}个，"
+                        f"速率{total_saved_objects / (spent if spent > 0 else 1): .3f}个/秒",
                         "Chunk.save",
                     )
+
                     t = time.time()
-                    c = 0
-                    total = max(len(groups), 1)
-                    Chunk.loading_info["current_saving_obj_name"] = "小组信息"
-                    Chunk.loading_info["current_saving_obj_total"] = total
-                    for group in groups:
-                        Chunk.loading_info["current_saving_obj_current"] = c
-                        Chunk.loading_info["total_percentage"] += object_percentage
-                        DataObject(group, self).save(path)
-                        c += 1
-                        total_saved_objects += 1
-                    c = max(1, c)
-                    Base.log(
-                        "D",
-                        f"历史记录中的{uuid}的小组保存完成，"
-                        f"耗时{time.time() - t: .5f}秒，共{c}个，"
-                        f"速率{c / (time.time() - t if (time.time() - t) > 0 else 1): .3f}个/秒",
-                        "Chunk.save",
+                    column_count = self.save_score_columns(
+                        uuid,
+                        modifies,
+                        students,
+                        shared_templates + modify_templates,
+                        incremental and uuid == "Current",
                     )
-                    t = time.time()
-                    c = 0
-                    total = max(len(modifies), 1)
-                    self.relase_connections()
-                    Chunk.loading_info["current_saving_obj_name"] = "分数修改记录"
-                    Chunk.loading_info["current_saving_obj_total"] = total
-                    for modify in modifies:
-                        Chunk.loading_info["current_saving_obj_current"] = c
-                        Chunk.loading_info["total_percentage"] += object_percentage
-                        DataObject(modify, self).save(path)
-                        c += 1
-                        total_saved_objects += 1
-                    c = max(1, c)
                     Base.log(
                         "D",
-                        f"历史记录中的{uuid}的分数修改记录保存完成，"
-                        f"耗时{time.time() - t: .5f}秒，共{c}个，"
-                        f"速率{c / (time.time() - t if (time.time() - t) > 0 else 1): .3f}个/秒",
+                        f"历史记录中的{uuid}的分数列存储写入完成，"
+                        f"耗时{time.time() - t: .5f}秒，共{column_count}行",
                         "Chunk.save",
                     )
-                    t = time.time()
-                    c = 0
-                    total = max(len(day_records), 1)
-                    Chunk.loading_info["current_saving_obj_name"] = "成就记录"
-                    Chunk.loading_info["current_saving_obj_total"] = total
-                    for achievement in achievements:
-                        Chunk.loading_info["current_saving_obj_current"] = c
-                        Chunk.loading_info["total_percentage"] += object_percentage
-                        DataObject(achievement, self).save(path)
-                        c += 1
-                        total_saved_objects += 1
-                    c = max(1, c)
-                    Base.log(
-                        "D",
-                        f"历史记录中的{uuid}的成就记录保存完成，"
-                        f"耗时{time.time() - t: .5f}秒，共{c}个，"
-                        f"速率{c / (time.time() - t if (time.time() - t) > 0 else 1): .3f}个/秒",
-                        "Chunk.save",
+
+                    Base.log("D", "保存基本信息", "Chunk.save")
+                    self.storage.write_meta(
+                        uuid,
+                        "classes",
+                        [(c.key, c.uuid) for c in current_history.classes.values()],
                     )
-                    t = time.time()
-                    c = 0
-                    Chunk.loading_info["current_saving_obj_name"] = "分数修改模板"
-                    Chunk.loading_info["current_saving_obj_total"] = total
-                    for template in modify_templates:
-                        Chunk.loading_info["current_saving_obj_current"] = c
-                        Chunk.loading_info["total_percentage"] += object_percentage
-                        DataObject(template, self).save(path)
-                        c += 1
-                        total_saved_objects += 1
-                    c = max(1, c)
-                    Base.log(
-                        "D",
-                        f"历史记录中的{uuid}的分数修改模板保存完成，"
-                        f"耗时{time.time() - t: .5f}秒，共{c}个，"
-                        f"速率{c / (time.time() - t if (time.time() - t) > 0 else 1): .3f}个/秒",
-                        "Chunk.save",
+                    self.storage.write_meta(
+                        uuid,
+                        "weekdays",
+                        {
+                            _class: {k: v.uuid for k, v in item.items()}
+                            for _class, item in current_history.weekdays.items()
+                        },
                     )
-                    t = time.time()
-                    c = 0
-                    total = max(len(achivement_templates), 1)
-                    Chunk.loading_info["current_saving_obj_name"] = "成就模板"
-                    Chunk.loading_info["current_saving_obj_total"] = total
-                    for template in achivement_templates:
-                        Chunk.loading_info["current_saving_obj_current"] = c
-                        Chunk.loading_info["total_percentage"] += object_percentage
-                        DataObject(template, self).save(path)
-                        c += 1
-                        total_saved_objects += 1
-                    c = max(1, c)
-                    Base.log(
-                        "D",
-                        f"历史记录中的{uuid}的成就模板保存完成，"
-                        f"耗时{time.time() - t: .5f}秒，共{c}个，"
-                        f"速率{c / (time.time() - t if (time.time() - t) > 0 else 1): .3f}个/秒",
-                        "Chunk.save",
+                    self.storage.write_meta(
+                        uuid,
+                        "current_day_attendance",
+                        [
+                            (a.target_class, a.uuid)
+                            for a in self.bound_db.current_day_attendance.values()
+                        ],
                     )
-                    t = time.time()
-                    c = 0
-                    total = max(len(day_records), 1)
-                    Chunk.loading_info["current_saving_obj_name"] = "每日记录"
-                    Chunk.loading_info["current_saving_obj_total"] = total
-                    for record in day_records:
-                        Chunk.loading_info["current_saving_obj_current"] = c
-                        Chunk.loading_info["total_percentage"] += object_percentage
-                        DataObject(record, self).save(path)
-                        c += 1
-                        total_saved_objects += 1
-                    c = max(1, c)
-                    Base.log(
-                        "D",
-                        f"历史记录中的{uuid}的每日记录保存完成，"
-                        f"耗时{time.time() - t: .5f}秒，共{c}个，"
-                        f"速率{c / (time.time() - t if (time.time() - t) > 0 else 1): .3f}个/秒",
-                        "Chunk.save",
+                    self.storage.write_meta(
+                        uuid,
+                        "templates",
+                        [(t.key, t.uuid) for t in self.bound_db.templates.values()],
                     )
-                    t = time.time()
-                    c = 0
-                    total = max(len(self.bound_db.current_day_attendance.values()), 1)
-                    Chunk.loading_info["current_saving_obj_name"] = "当前出勤"
-                    Chunk.loading_info["current_saving_obj_total"] = total
-                    for attendance_info in self.bound_db.current_day_attendance.values():
-                        Chunk.loading_info["current_saving_obj_current"] = c
-                        Chunk.loading_info["total_percentage"] += object_percentage
-                        DataObject(attendance_info, self).save(path)
-                        total_saved_objects += 1
-                        c += 1
-                    Base.log(
-                        "D",
-                        f"历史记录中的{uuid}的当前出勤保存完成，"
-                        f"时间耗时{time.time() - t}秒",
-                        "Chunk.save",
+                    self.storage.write_meta(
+                        uuid,
+                        "achievements",
+                        [(a.key, a.uuid) for a in self.bound_db.achievements.values()],
                     )
-
-                    DataObject.relase_connections()
-                    DataObject.cur_list = {}
-                    Base.log("D", "当前数据库连接已关闭", "Chunk.save")
-                    Base.log("D", "保存基本信息", "Chunk.save")
-                    json.dump(
+                    # info最后写，有info就说明这个历史记录是完整的
+                    self.storage.write_meta(
+                        uuid,
+                        "info",
                         {
                             "uuid": uuid if uuid != "Current" else None,
                             "create_time": current_history.time,
@@ -1222,95 +4229,103 @@ class Chunk:
                             "last_start_time": self.bound_db.last_start_time,
                             "last_reset": self.bound_db.last_reset,
                             "user": self.bound_db.user,
-                            "total_objects": total_saved_objects,  # 这个可以在后面用来做加载进度条
+                            "total_objects": archive_objects,  # 这个可以在后面用来做加载进度条
+                            "class_names": {
+                                c.key: c.name
+                                for c in current_history.classes.values()
+                            },
                             "python_version": (
                                 sys.version_info.major,
                                 sys.version_info.minor,
                                 sys.version_info.micro,
                             ),
                         },
-                        open(os.path.join(path, "info.json"), "w", encoding="utf-8"),
-                        indent=4,
-                    )
-                    json.dump(
-                        [(c.key, c.uuid) for c in current_history.classes.values()],
-                        open(os.path.join(path, "classes.json"), "w", encoding="utf-8"),
-                        indent=4,
                     )
 
-                    json.dump(
-                        {
-                            _class: {k: v.uuid for k, v in item.items()}
-                            for _class, item in current_history.weekdays.items()
-                            
-                        },
-                        open(os.path.join(path, "weekdays.json"), "w", encoding="utf-8"),
-                        indent=4,
-                    )
-                    json.dump(
-                        [(a.target_class, a.uuid) for a in self.bound_db.current_day_attendance.values()],
-                        open(os.path.join(path, "current_day_attendance.json"), "w", encoding="utf-8"),             
+                    Base.log(
+                        "I", f"{uuid}的存档信息保存完成({index}/{total_history_count})", "Chunk.save"
                     )
 
-                    json.dump(
-                        [(t.key, t.uuid) for t in self.bound_db.templates.values()],
-                        open(os.path.join(path, "templates.json"), "w", encoding="utf-8"),
-                        indent=4,
+                # 这次保存的所有写入一起提交，中途出错或者断电都不会留下写了一半的存档
+                with (
+                    self.storage.atomic_save(
+                        [None, self.storage.shared_uuid]
+                        + [uuid for uuid, _, _ in save_tasks]
                     )
+                    if Chunk.bulk_save  # 一个一个保存的时候会自己回滚，合并不了
+                    else nullcontext()
+                ):
+                    self.storage.prepare_history(self.storage.shared_uuid)
+                    for name, objects in (
+                        ("分数修改模板", unique_objects(shared_templates, shared_uuids)),
+                        ("成就模板", unique_objects(shared_achievements, shared_uuids)),
+                    ):
+                        self.save_objects(objects, name, self.storage.shared_uuid, 0, codec)
+                    self.clear_prefetched_rows(self.storage.shared_uuid)
 
-                    json.dump(
-                        [(a.key, a.uuid) for a in self.bound_db.achievements.values()],
-                        open(
-                            os.path.join(path, "achievements.json"), "w", encoding="utf-8"
-                        ),
-                        indent=4,
-                    )
+                    i = 1
+                    for uuid, current_history, clear in save_tasks:
+                        save_part(uuid, current_history, clear, i)
+                        i += 1
 
-                    Base.log(
-                        "I", f"{uuid}的存档信息保存完成({index}/{total})", "Chunk.save"
+                    Base.log("D", "所有数据保存完成", "Chunk.save")
+
+                    self.storage.write_meta(
+                        None,
+                        "info",
+                        {
+                            "uuid": uuid if uuid != "Current" else None,
+                            "user": self.bound_db.user,
+                            "create_time": time.time(),
+                            "save_time": self.bound_db.save_time,
+                            "version": self.bound_db.version,
+                            "version_code": self.bound_db.version_code,
+                            "last_start_time": self.bound_db.last_start_time,
+                            "last_reset": self.bound_db.last_reset,
+                            "histories": self.storage.list_histories(),
+                            "codec": codec_name,
+                            "python_version": (
+                                sys.version_info.major,
+                                sys.version_info.minor,
+                                sys.version_info.micro,
+                            ),
+                        },
                     )
 
-                i = 1
-                for uuid, current_history, clear in save_tasks:
-                    save_part(uuid, current_history, clear, i)
-                    i += 1
-
-                Base.log("D", "所有数据保存完成", "Chunk.save")
-
-                history_uuids = []
-                for dir_1 in os.listdir(os.path.join(self.path, "Histories")):
-                    for dir_2 in os.listdir(os.path.join(self.path, "Histories", dir_1)):
-                        history_uuids.append(dir_1 + dir_2)
-
-                json.dump(
-                    {
-                        "uuid": uuid if uuid != "Current" else None,
-                        "user": self.bound_db.user,
-                        "create_time": time.time(),
-                        "save_time": self.bound_db.save_time,
-                        "version": self.bound_db.version,
-                        "version_code": self.bound_db.version_code,
-                        "last_start_time": self.bound_db.last_start_time,
-                        "last_reset": self.bound_db.last_reset,
-                        "histories": history_uuids,
-                        "python_version": (
-                            sys.version_info.major,
-                            sys.version_info.minor,
-                            sys.version_info.micro,
-                        ),
-                    },
-                    open(os.path.join(self.path, "info.json"), "w", encoding="utf-8"),
-                    indent=4,
-                )
+                if self.storage is not target:
+                    target.replace_with(self.storage)
+                    self.storage = target
+
             except Exception as e:
-                self.relase_connections()
+                Chunk.synced_path = None  # 没保存成功，下次需要完整保存
+                if self.storage is not target:
+                    target.discard_staging(self.storage)
+                    self.storage = target
+                self.relase_connections()  # 连接的状态不确定了，全部关掉重开
                 self.is_saving = False
                 raise e
 
             else:
-                self.relase_connections()
+                Chunk.synced_path = os.path.abspath(self.path)
+                # 连接留着给下次保存用，只把WAL合并回去，这样直接复制存档目录也是完整的
+                t = time.time()
+                self.storage.checkpoint()
+                Base.log("D", f"检查点完成，耗时{time.time() - t:.5f}秒", "Chunk.save")
                 self.is_saving = False
 
             finally:
-                self.relase_connections()
                 self.is_saving = False
+
+
+atexit.register(Chunk.relase_connections)
+
+
+if __name__ == "__main__":
+    # 转换存档：python -m utils.dataloader <存档目录> <存档文件.db> [--overwrite]
+    if len(sys.argv) < 3:
+        print(f"用法：python -m utils.dataloader <存档目录> <存档文件{SingleFileStorage.suffix}> [--overwrite]")
+        sys.exit(1)
+    for _history, _count in migrate_archive(
+        sys.argv[1], sys.argv[2], "--overwrite" in sys.argv[3:]
+    ).items():
+        print(f"{_history}: {_count}")
@@ -1,10 +1,12 @@
 """
 事件连接机制
 """
+import sys
 import time
+import traceback
 from typing import Callable, List, Optional, Literal, Any, Dict, Tuple, Iterable, Union
 from concurrent.futures import ThreadPoolExecutor
-from threading import Thread
+from threading import Thread, RLock
 from .event_types import EventType
 
 def addrof(obj) -> str:
@@ -186,10 +188,58 @@ class EventTaskGroup(EventTask):
 
 
 
+def _task_key(func: Callable) -> Any:
+    """任务的标识，绑定方法每次取出来都是新对象，所以按(实例, 函数)算
+
+    :param func: 任务
+    :return: 可以拿来当字典key的标识
+    """
+    owner = getattr(func, "__self__", None)
+    if owner is not None and hasattr(func, "__func__"):
+        return (id(owner), id(func.__func__))
+    return id(func)
+
+
+def _run_task(task: Callable, args: Iterable, kwargs: Dict, name: str):
+    "在线程池里执行任务，出错了把错误打出来（线程池默认会把错误吞掉）"
+    try:
+        task(*args, **kwargs)
+    except Exception:  # pylint: disable=broad-exception-caught
+        print(f"{name} 执行任务 {task!r} 时出错：", file=sys.stderr)
+        traceback.print_exc()
+
+
 class EventSignal:
     "事件信号"
     
-    signal_mapping: Dict[Any, List[Callable]] = {}
+    signal_mapping: Dict[Any, Dict[Any, List[Callable]]] = {}
+    "连接表，signal_mapping[信号标识][任务标识] = [任务, ...]（同一个任务连了几次就有几个）"
+
+    task_mapping: Dict[Any, Dict[Any, None]] = {}
+    "反向的连接表，task_mapping[任务标识] = {信号标识: None}（当有序集合用）"
+
+    mapping_lock = RLock()
+    "修改连接表用的锁"
+
+
+    @staticmethod
+    def _remove(identifier: Any, key: Any, once: bool) -> List[Callable]:
+        "从连接表里删掉任务，返回删掉的任务"
+        tasks = EventSignal.signal_mapping.get(identifier)
+        if tasks is None or key not in tasks:
+            return []
+        funcs = tasks[key]
+        if once and len(funcs) > 1:
+            return [funcs.pop(0)]
+        del tasks[key]
+        if not tasks:
+            del EventSignal.signal_mapping[identifier]
+        ids = EventSignal.task_mapping.get(key)
+        if ids is not None:
+            ids.pop(identifier, None)
+            if not ids:
+                del EventSignal.task_mapping[key]
+        return funcs if not once else funcs[:1]
 
 
     @staticmethod
@@ -200,9 +250,10 @@ class EventSignal:
         :param func: 绑定事件执行的任务
         :param identifier: 绑定任务的标识
         """
-        if identifier not in EventSignal.signal_mapping:
-            EventSignal.signal_mapping[identifier] = []
-        EventSignal.signal_mapping[identifier].append(func)
+        key = _task_key(func)
+        with EventSignal.mapping_lock:
+            EventSignal.signal_mapping.setdefault(identifier, {}).setdefault(key, []).append(func)
+            EventSignal.task_mapping.setdefault(key, {})[identifier] = None
 
     @staticmethod
     def disconnect(
@@ -217,59 +268,32 @@ class EventSignal:
         :param identifier: 绑定任务的标识
         :return List[Tuple[Callable, Any]]: 断开的绑定事件，格式为 [(identifier, func)]
         """
-        if identifier:
-            if identifier not in EventSignal.signal_mapping:
-                if on_error == "strict":
-                    raise KeyError(f"信号连接类 {identifier!r} ({addrof(identifier)}) 不在连接池中")
-                else:
-                    return []
-            elif func not in EventSignal.signal_mapping[identifier]:
-                if on_error == "strict":
-                    raise KeyError(f"任务 {func!r} ({addrof(func)}) 不在信号连接类 {identifier!r} ({addrof(identifier)} 的绑定中")
-                else:
-                    return []
-            result = [(identifier, func) for f in EventSignal.signal_mapping[identifier] if f is func]
-            if if_dumplicated == "remove_all":
-                while func in EventSignal.signal_mapping[identifier]:
-                    EventSignal.signal_mapping[identifier].remove(func)
-            elif if_dumplicated == "remove_once":
-                EventSignal.signal_mapping[identifier].remove(func)
-            if not EventSignal.signal_mapping[identifier]:
-                del EventSignal.signal_mapping[identifier]
-            return result
-
-        else:
-            succeed = False
-            results = []
-
-            for _id, func_list in EventSignal.signal_mapping.items():
-                try:
-                    results.extend([(_id, func) for f in func_list if f is func])
-                    if if_dumplicated == "remove_all":
-                        while func in func_list:
-                            func_list.remove(func)
-                    elif if_dumplicated == "remove_once":
-                        func_list.remove(func)
-                    succeed = True
-                except (ValueError, KeyError):
-                    pass
-
-            if not succeed:
-                if on_error == "strict":
-                    raise KeyError(f"任务 {func!r} ({addrof(func)}) 不在任何信号连接类中")
-                else:
-                    return []
-            
-
-            empty_ids = []
-            for _id, func_list in EventSignal.signal_mapping.items():
-                if not func_list:
-                    empty_ids.append(_id)
-            
-            for _id in empty_ids:   # 不然会报错（RuntimeError: dictionary changed size during iteration）
-                del EventSignal.signal_mapping[_id]
+        key = _task_key(func)
+        once = if_dumplicated == "remove_once"
+        with EventSignal.mapping_lock:
+            if identifier is not None:
+                if identifier not in EventSignal.signal_mapping:
+                    if on_error == "strict":
+                        raise KeyError(f"信号连接类 {identifier!r} ({addrof(identifier)}) 不在连接池中")
+                    else:
+                        return []
+                elif key not in EventSignal.signal_mapping[identifier]:
+                    if on_error == "strict":
+                        raise KeyError(f"任务 {func!r} ({addrof(func)}) 不在信号连接类 {identifier!r} ({addrof(identifier)} 的绑定中")
+                    else:
+                        return []
+                return [(identifier, f) for f in EventSignal._remove(identifier, key, once)]
 
-            return results
+            else:
+                if key not in EventSignal.task_mapping:
+                    if on_error == "strict":
+                        raise KeyError(f"任务 {func!r} ({addrof(func)}) 不在任何信号连接类中")
+                    else:
+                        return []
+                results = []
+                for _id in list(EventSignal.task_mapping[key]):
+                    results.extend((_id, f) for f in EventSignal._remove(_id, key, once))
+                return results
         
     @staticmethod
     def emit(identifier: Any, 
@@ -283,35 +307,37 @@ class EventSignal:
         :param identifier: 信号标识
         :param arguments: 传递给指定的任务的参数, 格式为 [(callable, args, kwargs)]
         :param default_arguments: 默认参数, 格式为 [(args, kwargs)]
-        :param use_thread: 是否使用线程
+        :param use_thread: 是否在线程中执行（用的是EventTask.task_threadpool）
         :return int: 触发的任务数量
         """     
-        if identifier not in EventSignal.signal_mapping:
+        tasks = EventSignal.signal_mapping.get(identifier)
+        if not tasks:
             if on_error == "strict":
                 raise KeyError(f"信号连接类 {identifier!r} ({addrof(identifier)}) 不在连接池中")
             else:
                 return 0
 
         finished = 0
-        arguments = arguments or []
-        default_arguments = default_arguments or ([], {})
-        passed_arguments = [item[0] for item in arguments]
-
-        for task in EventSignal.signal_mapping[identifier]:
-            if task in passed_arguments:
+        default_arguments = default_arguments or ((), {})
+        routes = (
+            {_task_key(item[0]): (item[1], item[2]) for item in arguments}
+            if arguments
+            else None
+        )
+
+        # 先拷一份，免得任务里连接/断开的时候字典大小变了
+        for key, funcs in list(tasks.items()):
+            args, kwargs = (
+                routes.get(key, default_arguments) if routes is not None else default_arguments
+            )
+            for task in tuple(funcs):
                 if use_thread:
-                    Thread( target=task, 
-                            args=arguments[passed_arguments.index(task)][1], 
-                            kwargs=arguments[passed_arguments.index(task)][2],
-                            name=f"EventSignal.emit({identifier!r})").start()
+                    EventTask.task_threadpool.submit(
+                        _run_task, task, args, kwargs, f"EventSignal.emit({identifier!r})"
+                    )
                 else:
-                    task(*arguments[passed_arguments.index(task)][1], **arguments[passed_arguments.index(task)][2])
-            else:
-                if use_thread:
-                    Thread(target=task, args=default_arguments[0], kwargs=default_arguments[1], name=f"EventSignal.emit({identifier!r})").start()
-                else:
-                    task(*default_arguments[0], **default_arguments[1])
-            finished += 1
+                    task(*args, **kwargs)
+                finished += 1
 
         return finished
     
@@ -323,19 +349,23 @@ class EventSignal:
         :param identifier: 信号标识，None表示清除所有信号
         :return List[Tuple[Callable, Any]]: 清除的信号，格式为 [(identifier, func)]
         """
-        if identifier:
-            if identifier not in EventSignal.signal_mapping:
-                raise KeyError(f"信号连接类 {identifier!r} ({addrof(identifier)}) 不在连接池中")
-            result = [(identifier, func) for func in EventSignal.signal_mapping[identifier]]
-            del EventSignal.signal_mapping[identifier]
-            return result
+        with EventSignal.mapping_lock:
+            if identifier is not None:
+                if identifier not in EventSignal.signal_mapping:
+                    raise KeyError(f"信号连接类 {identifier!r} ({addrof(identifier)}) 不在连接池中")
+                result = []
+                for key in list(EventSignal.signal_mapping[identifier]):
+                    result.extend((identifier, f) for f in EventSignal._remove(identifier, key, False))
+                return result
 
-        else:
-            result = []
-            for _id, func_list in EventSignal.signal_mapping.items():
-                result.extend([(identifier, func) for func in func_list])
-                del EventSignal.signal_mapping[_id]
-            return result
+            else:
+                result = []
+                for _id, tasks in EventSignal.signal_mapping.items():
+                    for funcs in tasks.values():
+                        result.extend([(_id, func) for func in funcs])
+                EventSignal.signal_mapping.clear()
+                EventSignal.task_mapping.clear()
+                return result
         
         
     @staticmethod
@@ -351,26 +381,34 @@ class EventSignal:
         :return List[Tuple[Any, Callable]: 绑定连接，格式为 [(identifier, func)]
         """
         result = []
-        if not identifier:
+        keys = None
+        if func is not None:
+            funcs = [func] if callable(func) else func
+            keys = [_task_key(f) for f in funcs]
 
-            if not func:
-                for _id, tasks in EventSignal.signal_mapping.items():
-                    for task in tasks:
-                        result.append((_id, task))
+        if identifier is None:
+
+            if keys is None:
+                for _id, tasks in list(EventSignal.signal_mapping.items()):
+                    for funcs in list(tasks.values()):
+                        result.extend((_id, task) for task in funcs)
 
             else:
-                funcs = func
-                for _id, tasks in EventSignal.signal_mapping.items():
-                    for task in tasks:
-                        if task in funcs:
-                            result.append((_id, task))
+                for key in keys:
+                    for _id in list(EventSignal.task_mapping.get(key, ())):
+                        tasks = EventSignal.signal_mapping.get(_id, {})
+                        result.extend((_id, task) for task in tasks.get(key, ()))
 
             if not result and on_error == "strict":
                     raise KeyError(f"任务 {func!r} ({addrof(func)}) 不在任何信号连接类中")
 
         else:
 
-            ids = identifier if isinstance(identifier, Iterable) else [identifier]
+            ids = (
+                identifier
+                if isinstance(identifier, Iterable) and not isinstance(identifier, str)
+                else [identifier]
+            )
             for _id in ids:
 
                 if _id not in EventSignal.signal_mapping:
@@ -379,15 +417,14 @@ class EventSignal:
                     else:
                         continue
 
-                if not func:
-                    for task in EventSignal.signal_mapping[_id]:
-                        result.append((_id, task))
+                tasks = EventSignal.signal_mapping[_id]
+                if keys is None:
+                    for funcs in list(tasks.values()):
+                        result.extend((_id, task) for task in funcs)
 
                 else:
-                    funcs = func if isinstance(func, Iterable) else [func]
-                    for task in EventSignal.signal_mapping[_id]:
-                        if task in funcs:
-                            result.append((_id, task))
+                    for key in keys:
+                        result.extend((_id, task) for task in tasks.get(key, ()))
 
         return result
 
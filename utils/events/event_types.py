@@ -24,4 +24,8 @@ class EventType:
         if isinstance(other, EventType):
             return self.key == other.key
         return False
+
+    def __hash__(self):
+        # 定义了__eq__之后要自己补上__hash__，不然没法当信号标识用
+        return hash(self.key)
     
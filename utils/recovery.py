@@ -0,0 +1,272 @@
+"""
+增量还原点模块
+
+以前每创建一个还原点都要把``chunks``整个复制一遍，还原的时候再一个文件一个文件地复制回去，
+存档越大越慢，而且两个还原点之间大部分文件其实都没变过。
+
+现在每个还原点带一个清单（``manifest.json``），记着每个文件的大小和修改时间：
+
+- 创建的时候和上一个还原点的清单比较，没变过的文件直接硬链接到上一个还原点里面的那份，
+  变了的才复制（支持的文件系统上用reflink，不支持就普通复制）
+- 还原的时候反过来，当前存档里面和清单一样的文件直接硬链接过去，变了的才从还原点复制
+
+还原点里面的文件永远不会被直接打开写入（SQLite是原地改文件的），
+所以硬链接只会在还原点之间、或者从存档指向新建出来的临时存档，不会从存档链接到还原点。
+删掉某个还原点也不影响别的，硬链接的文件要等所有还原点都删了才会真的释放空间。
+"""
+
+import os
+import json
+import time
+import shutil
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+from utils.basetypes import Base
+
+__all__ = [
+    "manifest_name",
+    "skipped_suffixes",
+    "RecoveryStats",
+    "clone_file",
+    "link_or_copy",
+    "read_manifest",
+    "scan_tree",
+    "create_snapshot",
+    "restore_snapshot",
+]
+
+
+manifest_name: str = "manifest.json"
+"还原点清单的文件名"
+
+manifest_version: int = 1
+"清单格式版本"
+
+skipped_suffixes: Tuple[str, ...] = (
+    "-shm",
+    ".tmp",
+    ".journal",
+)
+"不备份的文件（SQLite的共享内存索引、写了一半的临时文件和保存日志）"
+
+FICLONE = 0x40049409
+"Linux上reflink用的ioctl"
+
+
+class RecoveryStats(Dict[str, int]):
+    "创建/还原的统计：linked（链接的文件数）、copied（复制的文件数）、copied_bytes（复制的字节数）"
+
+    def __init__(self):
+        super().__init__(linked=0, copied=0, copied_bytes=0)
+
+
+def clone_file(source: str, target: str) -> None:
+    """
+    复制一个文件，文件系统支持的话用reflink（btrfs、xfs、apfs这些，只复制元数据，写的时候才真正复制），
+    不支持就普通复制。修改时间会跟着复制过去。
+
+    :param source: 源文件
+    :param target: 目标文件，不能已经存在
+    """
+    try:
+        import fcntl  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        fcntl = None
+    if fcntl is not None:
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, target)
+
+
+def link_or_copy(source: str, target: str, stats: Optional[RecoveryStats] = None) -> bool:
+    """
+    硬链接一个文件，链接不了（跨盘、FAT32之类的）就复制。
+
+    :param source: 源文件
+    :param target: 目标文件，不能已经存在
+    :param stats: 统计
+    :return: 是否链接成功
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        clone_file(source, target)
+        if stats is not None:
+            stats["copied"] += 1
+            stats["copied_bytes"] += os.path.getsize(target)
+        return False
+    if stats is not None:
+        stats["linked"] += 1
+    return True
+
+
+def scan_tree(
+    root: str, exclude: Iterable[str] = ()
+) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    列出目录下面所有要备份的文件。
+
+    :param root: 目录
+    :param exclude: 不要的目录（绝对路径或者相对于root的路径）
+    :return: (相对路径, stat)，相对路径统一用``/``分隔
+    """
+    root = os.path.abspath(root)
+    excluded = {os.path.abspath(os.path.join(root, p)) for p in exclude}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [
+            d for d in dirnames if os.path.join(dirpath, d) not in excluded
+        ]
+        for name in filenames:
+            if name.endswith(skipped_suffixes):
+                continue
+            path = os.path.join(dirpath, name)
+            if path in excluded:
+                continue
+            yield os.path.relpath(path, root).replace(os.sep, "/"), os.stat(path)
+
+
+def read_manifest(point: str) -> Optional[Dict[str, Any]]:
+    """
+    读取还原点的清单。
+
+    :param point: 还原点目录
+    :return: 清单，旧的还原点（没有清单）或者清单坏了就是None
+    """
+    try:
+        with open(os.path.join(point, manifest_name), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or "files" not in manifest:
+        return None
+    return manifest
+
+
+def _same_file(entry: Optional[Dict[str, Any]], stat: os.stat_result) -> bool:
+    "清单里面记的和现在的文件是不是一样（按大小和修改时间判断，跟rsync一样）"
+    return (
+        entry is not None
+        and entry["size"] == stat.st_size
+        and entry["mtime_ns"] == stat.st_mtime_ns
+    )
+
+
+def create_snapshot(
+    source: str,
+    point: str,
+    previous: Optional[str] = None,
+    exclude: Iterable[str] = (),
+    prefix: Optional[str] = None,
+) -> RecoveryStats:
+    """
+    创建还原点，没变过的文件链接到上一个还原点里面的那份。
+
+    调用之前要保证``source``里面没有正在写的文件（先关掉存档的连接，见``Chunk.relase_connections``）。
+
+    :param source: 要备份的目录
+    :param point: 还原点目录，清单放在这下面
+    :param previous: 上一个还原点的目录，没有或者不能用的话就全部复制
+    :param exclude: 不要备份的目录（相对于source）
+    :param prefix: 备份到``point``下面的哪个目录，不填就是source的目录名，空字符串就是直接放在``point``下面
+    :return: 统计
+    """
+    t = time.time()
+    stats = RecoveryStats()
+    if prefix is None:
+        prefix = os.path.basename(os.path.abspath(source))
+    base = read_manifest(previous) if previous is not None else None
+    base_files: Dict[str, Dict[str, Any]] = base["files"] if base is not None else {}
+    files: Dict[str, Dict[str, Any]] = {}
+    os.makedirs(point, exist_ok=True)
+    for rel, stat in scan_tree(source, exclude):
+        key = prefix.strip("/") + "/" + rel if prefix.strip("/") else rel
+        target = os.path.join(point, *key.split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if _same_file(base_files.get(key), stat) and os.path.isfile(
+            os.path.join(previous, *key.split("/"))
+        ):
+            link_or_copy(os.path.join(previous, *key.split("/")), target, stats)
+        else:
+            clone_file(os.path.join(source, *rel.split("/")), target)
+            stats["copied"] += 1
+            stats["copied_bytes"] += stat.st_size
+        files[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    # 清单最后写，有清单就说明还原点是完整的
+    with open(os.path.join(point, manifest_name + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "version": manifest_version,
+                "time": time.time(),
+                "previous": previous,
+                "files": files,
+            },
+            f,
+            indent=4,
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(
+        os.path.join(point, manifest_name + ".tmp"), os.path.join(point, manifest_name)
+    )
+    Base.log(
+        "I",
+        f"还原点{point}创建完成：链接{stats['linked']}个文件，"
+        f"复制{stats['copied']}个（{stats['copied_bytes'] / 1024:.1f}KB），"
+        f"耗时{time.time() - t:.3f}秒",
+        "recovery.create_snapshot",
+    )
+    return stats
+
+
+def restore_snapshot(
+    point: str, subdir: str, target: str, live: Optional[str] = None
+) -> RecoveryStats:
+    """
+    从还原点还原一个目录，当前目录里面和还原点一样的文件直接硬链接过来，变了的才复制。
+
+    :param point: 还原点目录
+    :param subdir: 要还原还原点里面的哪个目录（相对于point，比如``chunks/default``）
+    :param target: 还原到哪里（一个不存在的目录，一般是存档旁边的临时存档，见``ArchiveStorage.restore_from``）
+    :param live: 现在的目录，里面没变过的文件可以直接链接过来，不填就全部从还原点复制
+    :return: 统计
+    """
+    t = time.time()
+    stats = RecoveryStats()
+    manifest = read_manifest(point)
+    subdir = subdir.replace(os.sep, "/").strip("/")
+    source = os.path.join(point, *subdir.split("/"))
+    if manifest is None:
+        # 旧的还原点，只能整个复制
+        shutil.copytree(source, target)
+        return stats
+    os.makedirs(target, exist_ok=True)
+    for key, entry in manifest["files"].items():
+        if not key.startswith(subdir + "/"):
+            continue
+        rel = key[len(subdir) + 1 :].split("/")
+        path = os.path.join(target, *rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        live_path = os.path.join(live, *rel) if live is not None else None
+        if live_path is not None and os.path.isfile(live_path):
+            if _same_file(entry, os.stat(live_path)) and link_or_copy(
+                live_path, path, stats
+            ):
+                continue
+        if os.path.exists(path):
+            os.remove(path)
+        clone_file(os.path.join(point, *key.split("/")), path)
+        stats["copied"] += 1
+        stats["copied_bytes"] += entry["size"]
+    Base.log(
+        "I",
+        f"从还原点{point}还原完成：链接{stats['linked']}个文件，"
+        f"复制{stats['copied']}个（{stats['copied_bytes'] / 1024:.1f}KB），"
+        f"耗时{time.time() - t:.3f}秒",
+        "recovery.restore_snapshot",
+    )
+    return stats
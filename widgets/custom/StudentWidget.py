@@ -185,14 +185,7 @@ class StudentWidget(Ui_Form, MyWidget):
             self.graphWidget.setLabel("bottom", "次数")
             self.graphWidget.showGrid(x=True, y=True)
             self.graphWidget.addLegend()
-            self._x = [0]
-            self._y = [0]
-            score = Student.score_dtype(0)
-            for index, history in enumerate(self.history_data.values(), start=1):
-                if history.executed:
-                    score += history.mod
-                    self._x.append(index)
-                    self._y.append(float(score))
+            self._x, self._y = self.student.score_timeline.series()
             self.graphWidget.plot(self._x, self._y, pen=(255, 0, 0), name="分数")
 
         def show(self):